@@ -2,16 +2,46 @@
 """`pgtools` project.
 
 Provides a nice API over Postgresql common operations.
+
+Submodules (and so gevent) are only imported on first attribute access,
+and importing them has no process wide side effects.
 """
 
 from __future__ import absolute_import
 
+import importlib
+
 __all__ = ('PostgresPool', 'pubsub', 'DBAPIBackend', 'FunctionField', 'ViewField', 'DBAPIError',
-           'UnknownParamError', 'InvalidFunctionParamError', 'DBPoolEngine')
+           'UnknownParamError', 'InvalidFunctionParamError', 'DBPoolEngine', 'APIQuery',
+           'PoolHooks')
+
+EXPORTS = {
+    'PostgresPool': 'pgtools.pool',
+    'DBPoolEngine': 'pgtools.engine',
+    'PoolHooks': 'pgtools.metrics',
+    'DBAPIBackend': 'pgtools.dbapi',
+    'ViewField': 'pgtools.dbapi',
+    'FunctionField': 'pgtools.dbapi',
+    'DBAPIError': 'pgtools.dbapi',
+    'UnknownParamError': 'pgtools.dbapi',
+    'InvalidFunctionParamError': 'pgtools.dbapi',
+    'APIQuery': 'pgtools.dbapi',
+}
+
+SUBMODULES = ('aio', 'cache', 'copyio', 'dbapi', 'dbtypes', 'engine', 'errors', 'jsoncodec',
+              'metrics', 'pool', 'profiler', 'pubsub', 'rows')
+
+
+def __getattr__(name):
+    if name in EXPORTS:
+        value = getattr(importlib.import_module(EXPORTS[name]), name)
+    elif name in SUBMODULES:
+        value = importlib.import_module('pgtools.' + name)
+    else:
+        raise AttributeError("module 'pgtools' has no attribute %r" % (name, ))
+    globals()[name] = value
+    return value
 
 
-from pgtools.pool import PostgresPool
-import pgtools.pubsub as pubsub
-from pgtools.engine import DBPoolEngine
-from pgtools.dbapi import (DBAPIBackend, ViewField, FunctionField, DBAPIError, UnknownParamError,
-                           InvalidFunctionParamError)
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(SUBMODULES))
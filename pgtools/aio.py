@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.aio` module.
+
+Provides an asyncio powered Postgresql connection pool, mirroring the
+:class:`pgtools.pool.ClientPool` API over `psycopg2` asynchronous
+connections.
+
+Example usage::
+
+    >>> pool = AsyncPostgresPool(dsn, maxsize=10)  # doctest: +SKIP
+    >>> rows = await pool.fetchall('SELECT * FROM users WHERE id = %s', (1, ))  # doctest: +SKIP
+    >>> async with pool.connection() as conn:  # doctest: +SKIP
+    ...     await conn.execute('UPDATE users SET name = %s', ('pav', ))
+"""
+
+__all__ = ('AsyncPostgresPool', 'AsyncConnection')
+
+import asyncio
+import contextlib
+import itertools
+import time
+from collections import OrderedDict, deque
+
+import psycopg2
+import psycopg2.extras
+from psycopg2 import extensions, OperationalError
+
+from pgtools.dbapi import APIQuery, prepared_statement
+from pgtools.errors import DBPoolError, PoolTimeoutError, PoolOverloadError
+from pgtools.metrics import Instrumented, PoolMetrics
+from pgtools.rows import row_factory
+from pgtools.jsoncodec import json_decoder, register_json_decoder, register_raw_json
+
+
+CURSOR_FETCH = (
+    ("many", "fetchall"),
+    ("single", "fetchone")
+)
+
+OVERLOAD_POLICIES = ('queue', 'fail')
+
+ISOLATION_LEVELS = {
+    extensions.ISOLATION_LEVEL_READ_UNCOMMITTED: 'READ UNCOMMITTED',
+    extensions.ISOLATION_LEVEL_READ_COMMITTED: 'READ COMMITTED',
+    extensions.ISOLATION_LEVEL_REPEATABLE_READ: 'REPEATABLE READ',
+    extensions.ISOLATION_LEVEL_SERIALIZABLE: 'SERIALIZABLE',
+}
+
+
+async def wait_fd(loop, fileno, write=False):
+    """Waits until `fileno` is readable (or writable).
+    """
+    add, remove = ((loop.add_writer, loop.remove_writer) if write
+                   else (loop.add_reader, loop.remove_reader))
+    ready = loop.create_future()
+
+    def callback():
+        if not ready.done():
+            ready.set_result(None)
+
+    add(fileno, callback)
+    try:
+        await ready
+    finally:
+        remove(fileno)
+
+
+async def wait_conn(conn, loop=None):
+    """Drives an asynchronous `psycopg2` connection until `POLL_OK`.
+
+    Raises:
+        OperationalError, for invalid polling state.
+    """
+    loop = loop or asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        elif state == extensions.POLL_READ:
+            await wait_fd(loop, conn.fileno())
+        elif state == extensions.POLL_WRITE:
+            await wait_fd(loop, conn.fileno(), write=True)
+        else:
+            raise OperationalError("Bad result from poll: %r" % state)
+
+
+class AsyncConnection(object):
+    """Awaitable wrapper of a pooled asynchronous `psycopg2` connection.
+
+    Attributes:
+        conn (instance): The raw `psycopg2.connection` (`async_=True`).
+        pool (AsyncPostgresPool): The owner pool.
+    """
+    __slots__ = ('conn', 'pool')
+
+    def __init__(self, conn, pool):
+        self.conn = conn
+        self.pool = pool
+
+    async def execute(self, query, params=None, cursor_factory=None, raw_json=False):
+        """Executes `query` and returns the (completed) cursor.
+
+        `raw_json` ('str' or `True`, 'bytes') returns `json`/`jsonb` values
+        undecoded.
+        """
+        started = time.time()
+        prepared = False
+        if isinstance(query, APIQuery):
+            query, params = query
+            statement = query
+            if self.pool.statement_cache_size:
+                statement = await self._prepare(query)
+                prepared = True
+        else:
+            statement = query
+        cursor = self.conn.cursor(cursor_factory=row_factory(cursor_factory))
+        if raw_json:
+            register_raw_json(cursor, raw_json)
+        try:
+            cursor.execute(statement, params)
+            await wait_conn(self.conn)
+        except Exception:
+            if prepared:
+                self._evict(query)
+            raise
+        self.pool.emit('on_execute', query, params, time.time() - started, cursor.rowcount)
+        return cursor
+
+    async def _prepare(self, sql):
+        statements = self.pool._statements.setdefault(self.conn, OrderedDict())
+        for name in self.pool._stale_statements.pop(self.conn, ()):
+            await self.execute('DEALLOCATE {};'.format(name))
+        name = statements.pop(sql, None)
+        if name is None:
+            if len(statements) >= self.pool.statement_cache_size:
+                await self.execute('DEALLOCATE {};'.format(statements.popitem(last=False)[1]))
+            name = 'pgtools_{:d}'.format(next(self.pool._statement_ids))
+            await self.execute(prepared_statement(name, sql)[0])
+        statements[sql] = name
+        return prepared_statement(name, sql)[1]
+
+    def _evict(self, sql):
+        """Drops the cached statement of `sql` after a failed execution, see
+        `pgtools.pool.ClientPool._evict`.
+        """
+        name = self.pool._statements.get(self.conn, {}).pop(sql, None)
+        if name is not None:
+            self.pool._stale_statements.setdefault(self.conn, []).append(name)
+
+    async def fetchone(self, query, params=None, cursor_factory=None, raw_json=False):
+        cursor = await self.execute(query, params, cursor_factory, raw_json)
+        row = cursor.fetchone()
+        self.pool.emit('on_fetch', int(row is not None), 0)
+        return row
+
+    async def fetchall(self, query, params=None, cursor_factory=None, raw_json=False):
+        cursor = await self.execute(query, params, cursor_factory, raw_json)
+        rows = cursor.fetchall()
+        self.pool.emit('on_fetch', len(rows), 0)
+        return rows
+
+
+class AsyncPostgresPool(Instrumented):
+    """Asyncio Postgresql Server connection Pooling class.
+
+    Connections are `psycopg2` asynchronous connections driven through
+    ``loop.add_reader``/``loop.add_writer``, so no thread executor and no
+    global wait callback are involved. Asynchronous connections are always
+    in autocommit mode: single statements run as is and `connection` wraps
+    its block in ``BEGIN``/``COMMIT``.
+
+    Attributes:
+        maxsize (int): Connection pool size.
+        minsize (int): Connections opened by `start`.
+        acquire_timeout (float): Seconds to wait for a connection once the
+            pool is exhausted (`None` waits forever).
+        overload (str): Exhausted pool policy, 'queue' or 'fail'.
+        max_waiters (int): Queued requests before `PoolOverloadError`.
+        max_lifetime (float): Seconds before a connection is recycled.
+        statement_cache_size (int): Max prepared statements per connection.
+        itersize (int): Rows fetched per round trip by `fetchiter`.
+        json_loads (str|callable): Decoder registered for `json`/`jsonb`
+            columns on each pool connection, see
+            `pgtools.jsoncodec.json_decoder` (`None` keeps the `psycopg2`
+            defaults).
+        json_lazy (boolean): Return `pgtools.jsoncodec.LazyJSON` values.
+        cursor_type (str|type): Default `query` row factory, see
+            `pgtools.rows.row_factory`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.connect = kwargs.pop('connect', psycopg2.connect)
+        self.maxsize = kwargs.pop('maxsize', 30)
+        self.minsize = kwargs.pop('minsize', 0)
+        self.acquire_timeout = kwargs.pop('acquire_timeout', None)
+        self.overload = kwargs.pop('overload', 'queue')
+        self.max_waiters = kwargs.pop('max_waiters', None)
+        self.max_lifetime = kwargs.pop('max_lifetime', None)
+        self.statement_cache_size = kwargs.pop('statement_cache_size', 100)
+        self.itersize = kwargs.pop('itersize', 2000)
+        self.json_loads = kwargs.pop('json_loads', 'ordered')
+        self.json_lazy = kwargs.pop('json_lazy', False)
+        self.cursor_type = row_factory(kwargs.pop('cursor_type', 'RealDictCursor'))
+        if self.json_loads is not None:
+            self.json_loads = json_decoder(self.json_loads)
+        if self.overload not in OVERLOAD_POLICIES:
+            raise ValueError('Invalid overload policy %r' % (self.overload, ))
+        if not 0 <= self.minsize <= self.maxsize:
+            raise ValueError('Expected 0 <= minsize <= %d, got %r' % (self.maxsize, self.minsize))
+        self.args = args
+        self.kwargs = kwargs
+        self.size = 0
+        self.pool = deque()
+        self._waiters = deque()
+        self._created = {}
+        self._statements = {}
+        self._stale_statements = {}
+        self._statement_ids = itertools.count(1)
+        self._cursor_ids = itertools.count(1)
+        self.metrics = PoolMetrics()
+        self.hooks = [self.metrics]
+
+    async def create_connection(self):
+        conn = self.connect(*self.args, async_=True, **self.kwargs)
+        try:
+            await wait_conn(conn)
+        except BaseException:
+            conn.close()
+            raise
+        if self.json_loads is not None:
+            register_json_decoder(conn, self.json_loads, self.json_lazy)
+        return conn
+
+    async def _create(self):
+        """Creates a connection for an already reserved pool slot.
+        """
+        try:
+            conn = await self.create_connection()
+        except BaseException:
+            self._release()
+            raise
+        self._created[conn] = time.time()
+        return conn
+
+    def _release(self):
+        """Frees a pool slot, handing it to the longest waiting request.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.size -= 1
+
+    async def get(self, acquire_timeout=None):
+        """Acquires a raw connection, waiting in FIFO order once exhausted.
+
+        Raises:
+            PoolTimeoutError, PoolOverloadError.
+        """
+        if not self._waiters:
+            if self.pool:
+                return self.pool.popleft()
+            if self.size < self.maxsize:
+                self.size += 1
+                return await self._create()
+
+        if self.overload == 'fail':
+            raise PoolOverloadError('Pool exhausted (%d connections).' % self.size)
+        if self.max_waiters is not None and len(self._waiters) >= self.max_waiters:
+            raise PoolOverloadError('Too many waiters (%d).' % len(self._waiters))
+
+        timeout = self.acquire_timeout if acquire_timeout is None else acquire_timeout
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait((waiter, ), timeout=timeout)
+        except BaseException:
+            # Cancelled: hand back anything received.
+            self._abandon(waiter)
+            raise
+        if not waiter.done():
+            self._abandon(waiter)
+            raise PoolTimeoutError('No connection available after %ss.' % (timeout, ))
+
+        conn = waiter.result()
+        if conn is None:
+            return await self._create()
+        return conn
+
+    def _abandon(self, waiter):
+        """Cancels a queued `waiter`, or releases the connection (or slot)
+        already handed to it.
+        """
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+        if not waiter.done():
+            waiter.cancel()
+        elif not waiter.cancelled():
+            if waiter.result() is None:
+                self._release()
+            else:
+                self.put(waiter.result())
+
+    def put(self, conn):
+        if conn.closed or (self.max_lifetime is not None and
+                           time.time() - self._created.get(conn, 0) > self.max_lifetime):
+            self.discard(conn)
+            return
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(conn)
+                return
+        self.pool.append(conn)
+
+    def discard(self, conn):
+        """Closes `conn` and releases its pool slot.
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._created.pop(conn, None)
+        self._statements.pop(conn, None)
+        self._stale_statements.pop(conn, None)
+        self._release()
+
+    def closeall(self):
+        while self.pool:
+            self.discard(self.pool.popleft())
+
+    async def start(self):
+        """Opens connections concurrently, up to `minsize`.
+        """
+        count = max(self.minsize - self.size, 0)
+        self.size += count
+        results = await asyncio.gather(*[self._create() for _ in range(count)],
+                                       return_exceptions=True)
+        for conn in results:
+            if not isinstance(conn, BaseException):
+                self.put(conn)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, acquire_timeout=None):
+        """Checks out a connection (in autocommit mode) as `AsyncConnection`.
+        """
+        started = time.time()
+        conn = await self.get(acquire_timeout)
+        self.emit('on_checkout', time.time() - started)
+        try:
+            yield AsyncConnection(conn, self)
+        except BaseException:
+            # Cancelled or failed while executing: the connection state is
+            # unknown, so it is not reused.
+            if conn.closed or conn.isexecuting():
+                self.discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self.put(conn)
+
+    @contextlib.asynccontextmanager
+    async def connection(self, isolation_level=None, acquire_timeout=None):
+        """Checks out a connection inside a transaction block, committed on
+        success and rolled back on error.
+
+        Args:
+            isolation_level (int|str): A `psycopg2.extensions` isolation level
+                constant or its SQL name.
+        """
+        async with self.acquire(acquire_timeout) as conn:
+            level = ISOLATION_LEVELS.get(isolation_level, isolation_level)
+            await conn.execute('BEGIN ISOLATION LEVEL {};'.format(level) if level else 'BEGIN;')
+            try:
+                yield conn
+            except BaseException:
+                if not conn.conn.closed and not conn.conn.isexecuting():
+                    started = time.time()
+                    await conn.execute('ROLLBACK;')
+                    self.emit('on_rollback', time.time() - started)
+                raise
+            started = time.time()
+            await conn.execute('COMMIT;')
+            self.emit('on_commit', time.time() - started)
+
+    async def execute(self, query, params=None, **kwargs):
+        async with self.acquire(kwargs.pop('acquire_timeout', None)) as conn:
+            cursor = await conn.execute(query, params, **kwargs)
+            return cursor.rowcount
+
+    async def fetchone(self, query, params=None, **kwargs):
+        async with self.acquire(kwargs.pop('acquire_timeout', None)) as conn:
+            return await conn.fetchone(query, params, **kwargs)
+
+    async def fetchall(self, query, params=None, **kwargs):
+        async with self.acquire(kwargs.pop('acquire_timeout', None)) as conn:
+            return await conn.fetchall(query, params, **kwargs)
+
+    async def fetchiter(self, query, params=None, itersize=None, **kwargs):
+        """Streams query rows through a server side cursor.
+
+        Asynchronous connections do not support named cursors, so the
+        cursor is declared explicitly inside a transaction and fetched
+        `itersize` rows per round trip.
+        """
+        itersize = itersize or self.itersize
+        cursor_factory = kwargs.pop('cursor_factory', None)
+        name = 'pgtools_cursor_{:d}'.format(next(self._cursor_ids))
+        if isinstance(query, APIQuery):
+            query, params = query
+
+        async with self.connection(**kwargs) as conn:
+            sql = conn.conn.cursor().mogrify(query, params).decode(
+                extensions.encodings[conn.conn.encoding]
+            )
+            await conn.execute('DECLARE {} NO SCROLL CURSOR FOR {};'.format(
+                name, sql.rstrip().rstrip(';')
+            ))
+            count = 0
+            while True:
+                rows = (await conn.execute(
+                    'FETCH FORWARD {:d} FROM {};'.format(itersize, name), None, cursor_factory
+                )).fetchall()
+                if not rows:
+                    break
+                count += len(rows)
+                for row in rows:
+                    yield row
+            self.emit('on_fetch', count, 0)
+            await conn.execute('CLOSE {};'.format(name))
+
+    async def query(self, query, fetch_opts='many', cursor_type=None, raw_json=False):
+        try:
+            return await getattr(self, dict(CURSOR_FETCH).get(fetch_opts))(
+                query, cursor_factory=row_factory(cursor_type or self.cursor_type),
+                raw_json=raw_json
+            )
+        except Exception as e:
+            raise DBPoolError(e.args)
+
+    def stats(self):
+        """Returns a snapshot of the pool state and `metrics` histograms.
+        """
+        idle = len(self.pool)
+        snapshot = {
+            'size': self.size,
+            'maxsize': self.maxsize,
+            'in_use': self.size - idle,
+            'idle': idle,
+            'waiters': len(self._waiters),
+        }
+        snapshot.update(self.metrics.snapshot())
+        return snapshot
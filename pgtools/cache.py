@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.cache` module.
+
+Provides the LRU/TTL result cache used by cached `pgtools.dbapi` fields.
+
+Example usage::
+
+    >>> cache = ResultCache(max_size=2)
+    >>> cache.set('api.settings', ('SELECT * FROM api.settings;', ()), [{'theme': 'dark'}])
+    True
+    >>> cache.get('api.settings', ('SELECT * FROM api.settings;', ()))
+    [{'theme': 'dark'}]
+    >>> cache.invalidate_pattern('api.*')
+    1
+    >>> cache.get('api.settings', ('SELECT * FROM api.settings;', ())) is MISS
+    True
+"""
+
+from __future__ import absolute_import
+
+__all__ = ('MISS', 'ResultCache', 'default_cache')
+
+import fnmatch
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+MISS = object()
+
+
+class ResultCache(object):
+    """**LRU result cache with per entry expiry**
+
+    Entries are keyed by ``(field, key)``, `field` being the qualified
+    database object name (e.g. ``'api.get_user'``) and `key` any hashable
+    normalization of the call arguments. Cached results are returned as
+    stored, callers must not mutate them.
+
+    Invalidations bump a per field `generation`. Callers computing a result
+    read it before and pass it to `set`, which then drops results computed
+    while an invalidation happened, so an in flight query can not store a
+    stale result after the invalidation.
+
+    Instances are thread safe (e.g. the shared `default_cache` used from
+    `pgtools.engine.DBPoolEngine` threads), every operation holds a lock.
+
+    Attributes:
+        max_size (int): Max entries kept, least recently used are evicted.
+        ttl (float): Default seconds to live, `None` never expires.
+        hits (int): Lookups served from the cache.
+        misses (int): Lookups not (or no longer) in the cache.
+    """
+
+    timer = staticmethod(time.time)
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._fields = {}
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, field, key):
+        """Returns the cached result or `MISS`.
+        """
+        entry_key = (field, key)
+        with self._lock:
+            try:
+                expires, value = self._entries[entry_key]
+            except KeyError:
+                self.misses += 1
+                return MISS
+            if expires is not None and expires <= self.timer():
+                self._discard(entry_key)
+                self.misses += 1
+                return MISS
+            self._entries.move_to_end(entry_key)
+            self.hits += 1
+            return value
+
+    def generation(self, field):
+        """Returns the `field` invalidation generation, see `set`.
+        """
+        with self._lock:
+            return self._epoch, self._generations.setdefault(field, 0)
+
+    def set(self, field, key, value, ttl=MISS, generation=None):
+        """Stores a result.
+
+        Args:
+            ttl (float): Seconds to live, defaults to the cache `ttl`,
+                `None` never expires.
+            generation (tuple): The `generation` of `field` read before
+                computing `value`, the result is not stored if the field
+                was invalidated since.
+
+        Returns:
+            boolean, whether the result was stored.
+        """
+        ttl = self.ttl if ttl is MISS else ttl
+        entry_key = (field, key)
+        with self._lock:
+            if generation is not None and generation != self.generation(field):
+                return False
+            self._entries[entry_key] = (None if ttl is None else self.timer() + ttl, value)
+            self._entries.move_to_end(entry_key)
+            self._fields.setdefault(field, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._discard(next(iter(self._entries)))
+            return True
+
+    def _discard(self, entry_key):
+        del self._entries[entry_key]
+        field, key = entry_key
+        keys = self._fields[field]
+        keys.discard(key)
+        if not keys:
+            del self._fields[field]
+
+    def invalidate(self, field, key=MISS, match=None):
+        """Drops the `field` entry of `key`, or every `field` entry (whose
+        key satisfies the `match` predicate, if any).
+
+        Returns:
+            int, the number of dropped entries.
+        """
+        with self._lock:
+            if field in self._generations:
+                self._generations[field] += 1
+            if key is not MISS:
+                keys = [key]
+            else:
+                keys = [key for key in self._fields.get(field, ()) if match is None or match(key)]
+            dropped = 0
+            for key in keys:
+                if (field, key) in self._entries:
+                    self._discard((field, key))
+                    dropped += 1
+            return dropped
+
+    def invalidate_pattern(self, pattern):
+        """Drops the entries of every field matching a shell style pattern,
+        e.g. ``'product.*'`` or ``'*.count_*'``.
+
+        Returns:
+            int, the number of dropped entries.
+        """
+        match = re.compile(fnmatch.translate(pattern)).match
+        with self._lock:
+            fields = set(self._fields).union(self._generations)
+            return sum(self.invalidate(field) for field in fields if match(field))
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._fields.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'fields': len(self._fields),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+default_cache = ResultCache()
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.copyio` module.
+
+Provides streaming encoders for Postgresql ``COPY`` text format and a
+decoder for the ``COPY`` binary format.
+"""
+
+from __future__ import absolute_import
+
+__all__ = ('CopyInStream', 'CopyOutBuffer', 'CopyOutSink', 'BinaryCopyDecoder', 'copy_text_value',
+           'parse_copy_rows', 'quote_ident')
+
+import binascii
+import csv
+import datetime
+import decimal
+import json
+import re
+import struct
+import uuid
+import six
+from pgtools.dbapi import array_literal
+
+
+COPY_NULL = '\\N'
+
+COPY_FORMATS = ('csv', 'text', 'binary')
+
+COPY_ESCAPES = {
+    ord('\\'): '\\\\',
+    ord('\n'): '\\n',
+    ord('\r'): '\\r',
+    ord('\t'): '\\t',
+}
+
+COPY_UNESCAPES = {
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'v': '\v',
+}
+
+COPY_ESCAPE_RE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+
+
+def quote_ident(name):
+    """Quotes a (possibly schema qualified) Postgresql identifier.
+
+    >>> print(quote_ident('public.my"table'))
+    "public"."my""table"
+    """
+    return '.'.join(
+        '"{}"'.format(part.replace('"', '""')) for part in name.split('.')
+    )
+
+
+def copy_text_value(value):
+    """Encodes a python value as a ``COPY`` text format field.
+
+    >>> print(copy_text_value(None), copy_text_value(True), copy_text_value('a\\tb'))
+    \\N t a\\tb
+    """
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, six.integer_types):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (bytearray, memoryview)) or (
+            isinstance(value, bytes) and not isinstance(value, six.string_types)):
+        # `bytea` hex format, the backslash itself is escaped for COPY.
+        return '\\\\x' + binascii.hexlify(bytes(value)).decode('ascii')
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, (list, tuple)):
+        value = array_literal(value)
+    elif hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return six.text_type(value).translate(COPY_ESCAPES)
+
+
+class CopyInStream(object):
+    """File-like object that encodes rows on demand for ``COPY FROM STDIN``.
+
+    Rows are only pulled from the iterable when `psycopg2` reads, and each
+    `read` returns roughly `size` characters, so memory stays bounded no
+    matter how many rows are streamed.
+
+    Attributes:
+        rows (iterator): Row tuples (or dicts when `columns` is given).
+        columns (sequence): Dict keys to extract, in column order.
+        count (int): Rows encoded so far.
+    """
+
+    def __init__(self, rows, columns=None):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.count = 0
+
+    def encode_row(self, row):
+        if self.columns is not None and isinstance(row, dict):
+            row = [row[column] for column in self.columns]
+        return '\t'.join([copy_text_value(value) for value in row]) + '\n'
+
+    def read(self, size=-1):
+        chunks = []
+        length = 0
+        for row in self.rows:
+            line = self.encode_row(row)
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+            if 0 < size <= length:
+                break
+        return ''.join(chunks)
+
+
+def copy_text_unescape(field):
+    """Decodes a ``COPY`` text format field.
+
+    >>> copy_text_unescape('a\\\\tb\\\\\\\\c') == 'a\\tb\\\\c'
+    True
+    >>> copy_text_unescape('\\\\N') is None
+    True
+    """
+    if field == COPY_NULL:
+        return None
+    if '\\' not in field:
+        return field
+
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] == 'x' and len(escape) > 1:
+            return six.unichr(int(escape[1:], 16))
+        if escape[0] in '01234567':
+            return six.unichr(int(escape, 8))
+        return COPY_UNESCAPES.get(escape, escape)
+
+    return COPY_ESCAPE_RE.sub(replace, field)
+
+
+def parse_copy_rows(chunks, format='csv'):
+    """Parses ``COPY TO`` text or csv chunks (one row each) into lists.
+
+    >>> list(parse_copy_rows(['1\\ta\\\\tb\\n', '2\\t\\\\N\\n'], 'text'))
+    [['1', 'a\\tb'], ['2', None]]
+    """
+    if format == 'csv':
+        return csv.reader(chunks)
+    return ([copy_text_unescape(field) for field in chunk.rstrip('\n').split('\t')]
+            for chunk in chunks)
+
+
+class CopyOutBuffer(object):
+    """Bounded, file-like target for ``COPY TO STDOUT``.
+
+    `psycopg2` writes one chunk per row, which blocks on the `queue` (any
+    object with a gevent-like `put`/`get` API) once it is full. Iterating
+    the buffer yields the chunks until the producer calls `close`.
+
+    Attributes:
+        format (str): The ``COPY`` format.
+        text (boolean): Decode chunks to `str`.
+        encoding (str): Python codec of the connection encoding.
+        rowcount (int): Rows copied, set by the producer when done.
+        exc_info (tuple): Producer failure, re-raised to the consumer.
+        description (tuple): Query `cursor.description`, when requested.
+        batch_size (int): Bytes joined before queueing, so a chunk holds
+            several rows (0 queues each row on its own).
+    """
+
+    def __init__(self, queue, format='csv', text=True, batch_size=0):
+        self.queue = queue
+        self.format = format
+        self.text = text
+        self.encoding = 'utf-8'
+        self.rowcount = -1
+        self.exc_info = None
+        self.description = None
+        self.discarding = False
+        self.batch_size = batch_size
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data):
+        if self.discarding:
+            return
+        if self.text and isinstance(data, bytes):
+            data = data.decode(self.encoding)
+        if self.batch_size:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size < self.batch_size:
+                return
+            data = data[:0].join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+        self.queue.put(data)
+
+    def close(self):
+        if self.discarding:
+            # Nobody reads anymore, putting the sentinel in a full queue
+            # would block the producer forever.
+            self.pending = []
+            return
+        if self.pending:
+            self.queue.put(self.pending[0][:0].join(self.pending))
+        self.pending = []
+        self.queue.put(StopIteration)
+
+    def discard(self):
+        """Drops pending and future chunks, so the producer never blocks.
+        """
+        self.discarding = True
+        while not self.queue.empty():
+            self.queue.get()
+
+    def __iter__(self):
+        return iter(self.queue.get, StopIteration)
+
+
+class CopyOutSink(object):
+    """File-like adapter writing ``COPY TO STDOUT`` chunks straight to a
+    `sink`, decoded to `str` for text sinks.
+
+    Attributes:
+        sink (file): The target file-like object.
+        format (str): The ``COPY`` format.
+        text (boolean): Decode chunks to `str`.
+        encoding (str): Python codec of the connection encoding.
+    """
+
+    def __init__(self, sink, format='csv', text=True):
+        self.sink = sink
+        self.format = format
+        self.text = text
+        self.encoding = 'utf-8'
+
+    def write(self, data):
+        if self.text and isinstance(data, bytes):
+            data = data.decode(self.encoding)
+        return self.sink.write(data)
+
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+INT2 = struct.Struct('!h')
+INT4 = struct.Struct('!i')
+INT8 = struct.Struct('!q')
+UINT4 = struct.Struct('!I')
+FLOAT4 = struct.Struct('!f')
+FLOAT8 = struct.Struct('!d')
+NUMERIC_HEADER = struct.Struct('!hhHh')
+
+POSTGRES_EPOCH = datetime.datetime(2000, 1, 1)
+
+POSTGRES_EPOCH_TZ = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+POSTGRES_EPOCH_DATE = datetime.date(2000, 1, 1)
+
+NUMERIC_SPECIAL = {0xC000: 'NaN', 0xD000: 'Infinity', 0xF000: '-Infinity'}
+
+
+def _fixed(fmt):
+    unpack_from = fmt.unpack_from
+    return lambda data, pos, size: unpack_from(data, pos)[0]
+
+
+def _timestamp(epoch, low, high):
+    def decode(data, pos, size):
+        value = INT8.unpack_from(data, pos)[0]
+        if value == 0x7FFFFFFFFFFFFFFF:
+            return high
+        if value == -0x8000000000000000:
+            return low
+        return epoch + datetime.timedelta(microseconds=value)
+    return decode
+
+
+def _date(data, pos, size):
+    value = INT4.unpack_from(data, pos)[0]
+    if value == 0x7FFFFFFF:
+        return datetime.date.max
+    if value == -0x80000000:
+        return datetime.date.min
+    return POSTGRES_EPOCH_DATE + datetime.timedelta(days=value)
+
+
+def decode_numeric(data, pos=0, size=None):
+    """Decodes a binary ``numeric`` value (base 10000 digits).
+
+    >>> decode_numeric(b'\\x00\\x02\\x00\\x00\\x40\\x00\\x00\\x04\\x00\\x0c\\x0d\\x80')
+    Decimal('-12.3456')
+    """
+    ndigits, weight, sign, dscale = NUMERIC_HEADER.unpack_from(data, pos)
+    if sign in NUMERIC_SPECIAL:
+        return decimal.Decimal(NUMERIC_SPECIAL[sign])
+    digits = ('%04d' * ndigits) % struct.unpack_from('!%dh' % ndigits, data, pos + 8)
+    exponent = (weight + 1 - ndigits) * 4
+    if exponent > -dscale:
+        digits += '0' * (exponent + dscale)
+    elif exponent < -dscale:
+        digits = digits[:exponent + dscale]
+    return decimal.Decimal('{}{}E-{:d}'.format('-' if sign == 0x4000 else '', digits or '0', dscale))
+
+
+BINARY_DECODERS = {
+    16: lambda data, pos, size: data[pos] != 0,
+    20: _fixed(INT8),
+    21: _fixed(INT2),
+    23: _fixed(INT4),
+    26: _fixed(UINT4),
+    700: _fixed(FLOAT4),
+    701: _fixed(FLOAT8),
+    1082: _date,
+    1114: _timestamp(POSTGRES_EPOCH, datetime.datetime.min, datetime.datetime.max),
+    1184: _timestamp(
+        POSTGRES_EPOCH_TZ,
+        datetime.datetime.min.replace(tzinfo=datetime.timezone.utc),
+        datetime.datetime.max.replace(tzinfo=datetime.timezone.utc),
+    ),
+    1700: decode_numeric,
+    2950: lambda data, pos, size: uuid.UUID(bytes=bytes(data[pos:pos + 16])),
+    17: lambda data, pos, size: bytes(data[pos:pos + size]),
+}
+
+# `struct` formats of fixed width types, rows made only of them are
+# unpacked with a single precompiled `struct.Struct` call.
+BINARY_FIXED_FORMATS = {16: '?', 20: 'q', 21: 'h', 23: 'i', 26: 'I', 700: 'f', 701: 'd'}
+
+# `text`, `name`, `bpchar` and `varchar` are decoded with the connection
+# encoding.
+BINARY_TEXT_TYPES = (19, 25, 1042, 1043)
+
+
+class BinaryCopyDecoder(object):
+    """Incremental ``COPY ... (FORMAT binary)`` decoder.
+
+    Fields are decoded in place with `struct`, by column type oid (int2/4/8,
+    oid, float4/8, bool, text types, bytea, date, timestamp(tz), uuid and
+    numeric); values of other types are returned as raw `bytes`. Chunks may
+    split rows anywhere.
+
+    >>> decoder = BinaryCopyDecoder([23, 25])
+    >>> decoder.feed(COPY_SIGNATURE + b'\\0' * 8)
+    []
+    >>> decoder.feed(b'\\0\\2\\0\\0\\0\\4\\0\\0\\0\\7\\xff\\xff\\xff\\xff\\xff\\xff')
+    [(7, None)]
+    >>> decoder.finished
+    True
+
+    Attributes:
+        oids (sequence): Column type oids.
+        encoding (str): Python codec of the connection encoding.
+        finished (boolean): The trailer has been decoded.
+    """
+
+    def __init__(self, oids, encoding='utf-8'):
+        self.oids = tuple(oids)
+        self.encoding = encoding
+        self.finished = False
+        self.buffer = bytearray()
+        self.header = False
+        text = self._text
+        self.decoders = tuple(
+            text if oid in BINARY_TEXT_TYPES else BINARY_DECODERS.get(oid, self._raw)
+            for oid in self.oids
+        )
+        self.row_struct = None
+        if self.oids and all(oid in BINARY_FIXED_FORMATS for oid in self.oids):
+            formats = [BINARY_FIXED_FORMATS[oid] for oid in self.oids]
+            self.row_struct = struct.Struct('!h' + ''.join('i' + fmt for fmt in formats))
+            self.row_sizes = tuple(struct.calcsize('!' + fmt) for fmt in formats)
+
+    def _text(self, data, pos, size):
+        return data[pos:pos + size].decode(self.encoding)
+
+    @staticmethod
+    def _raw(data, pos, size):
+        return bytes(data[pos:pos + size])
+
+    def _header(self, data):
+        if len(data) < 19:
+            return None
+        if bytes(data[:11]) != COPY_SIGNATURE:
+            raise ValueError('Invalid binary COPY signature.')
+        extension = INT4.unpack_from(data, 15)[0]
+        if len(data) < 19 + extension:
+            return None
+        self.header = True
+        return 19 + extension
+
+    def feed(self, chunk):
+        """Decodes the rows completed by `chunk` and returns them as tuples.
+        """
+        data = self.buffer
+        data += chunk
+        pos = 0
+        if not self.header:
+            pos = self._header(data)
+            if pos is None:
+                return []
+
+        rows = []
+        append = rows.append
+        decoders = self.decoders
+        unpack_int2 = INT2.unpack_from
+        unpack_int4 = INT4.unpack_from
+        end = len(data)
+        row_struct = self.row_struct
+        if row_struct is not None:
+            unpack_row = row_struct.unpack_from
+            row_size = row_struct.size
+            row_sizes = self.row_sizes
+            fields = len(decoders)
+        while pos + 2 <= end and not self.finished:
+            if row_struct is not None and pos + row_size <= end:
+                # Fast path, falls back below for NULLs and the trailer.
+                values = unpack_row(data, pos)
+                if values[0] == fields and values[1::2] == row_sizes:
+                    append(values[2::2])
+                    pos += row_size
+                    continue
+            count = unpack_int2(data, pos)[0]
+            if count == -1:
+                self.finished = True
+                pos += 2
+                break
+            if count != len(decoders):
+                raise ValueError('Expected %d fields, got %d' % (len(decoders), count))
+            offset = pos + 2
+            row = []
+            for decode in decoders:
+                if offset + 4 > end:
+                    break
+                size = unpack_int4(data, offset)[0]
+                offset += 4
+                if size < 0:
+                    row.append(None)
+                    continue
+                if offset + size > end:
+                    break
+                row.append(decode(data, offset, size))
+                offset += size
+            else:
+                append(tuple(row))
+                pos = offset
+                continue
+            break
+        del data[:pos]
+        return rows
@@ -10,12 +10,17 @@ __date__ = '1-9-015'
 __author__ = 'pav'
 
 __all__ = ['DBAPIBackend', 'FunctionField', 'ViewField', 'DBAPIError', 'UnknownParamError',
-           'InvalidFunctionParamError']
+           'InvalidFunctionParamError', 'APIQuery']
 
 # Try to find the best candidate for JSON serialization.
 # Import order indicates serialization efficiency.
 
+import keyword
+import re
 import six
+from collections import namedtuple
+
+from pgtools.cache import MISS, default_cache
 
 try:
     import ujson as json
@@ -37,6 +42,21 @@ class InvalidFunctionParamError(DBAPIError):
     pass
 
 
+class APIQuery(namedtuple('APIQuery', ('sql', 'params'))):
+    """**Parameterized statement for Database API objects**
+
+    Returned by :class:`ViewField` and :class:`FunctionField` callables when
+    the owner has no `persistence` attribute. Parameters are never rendered
+    into the statement, they are sent as bind parameters, so the instance
+    can be unpacked straight into ``cursor.execute``.
+
+    Attributes:
+        - sql (str): The statement with ``%s`` placeholders.
+        - params (tuple): The validated parameter values.
+    """
+    __slots__ = ()
+
+
 class BaseFuncArg(object):
     """**Base Postgresql Function parameter validator**
 
@@ -45,27 +65,27 @@ class BaseFuncArg(object):
 
 
     Attributes:
-        - formatter (str): The string template corresponding to DB native form.
         - param_type (tuple): The parameter native classes allowed.
+        - adapt (callable): Converts a valid value to its bind parameter
+          value, `None` sends it as is.
     """
 
-    formatter = ''
     param_type = None
 
+    adapt = None
+
     def __init__(self, param):
         self.param = param
 
     def validate(self):
         if not isinstance(self.param, self.param_type):
-            raise InvalidFunctionParamError(
-                "Invalid type for {} param".format(self.param_type)
-            )
-        return self.formatter.format(
-            self.format()
-        )
+            invalid_param(self.param_type)
+        return self.format()
 
     def format(self):
-        return self.param
+        """Returns the bind parameter value for `psycopg2` adaptation.
+        """
+        return self.param if self.adapt is None else self.adapt(self.param)
 
 
 class BaseAPIField(object):
@@ -81,7 +101,16 @@ class BaseAPIField(object):
 
     Attributes:
         - field (str): The descriptor name for instance owner class.
-        - lazyload (boolean): Indicates if result should be cached on instance.
+        - tag (str): The owner class attribute name.
+        - lazyload (boolean): Indicates if results should be cached (set with
+          the ``cache`` init keyword), in the owner `result_cache` if any
+          else in `pgtools.cache.default_cache`, keyed by field, owner
+          `persistence` and bind parameters.
+        - cache_ttl (float): Cached results seconds to live (``cache_ttl``
+          init keyword), defaults to the cache `ttl`.
+        - options (dict): Extra `persistence.query` keyword arguments, e.g.
+          ``raw_json`` (set with the ``raw_json`` init keyword) to get JSON
+          results undecoded.
 
     .. note::
         BaseField will also implement ``lazyload`` functionality. So if you
@@ -104,58 +133,153 @@ class BaseAPIField(object):
     def __init__(self, *args, **kwargs):
         self.args = args
         self.field = None
+        self.tag = None
         self.lazyload = kwargs.get('cache') or False
+        self.cache_ttl = kwargs.get('cache_ttl', MISS)
+        self.options = {'raw_json': kwargs['raw_json']} if kwargs.get('raw_json') else {}
 
     def __get__(self, instance, owner):
         """Implementing descriptor '__get__' method.
         """
         raise NotImplementedError
 
+    def compile(self):
+        """Precomputes the field statements, called by `DBAPIMeta` once the
+        field is tagged.
+        """
+        pass
+
+    def bind_instance(self, instance, bound):
+        """Stores the `bound` callable of `instance` in its ``__dict__`` (if
+        any), later lookups finding it there without calling `__get__`.
+        """
+        if self.tag is not None:
+            try:
+                instance.__dict__[self.tag] = bound
+            except AttributeError:
+                pass
+        return bound
+
+    @staticmethod
+    def dispatch(instance, query, **options):
+        """Runs `query` through the owner `persistence` object if any, else
+        returns the `APIQuery` itself.
+        """
+        persistence = getattr(instance, 'persistence', None)
+        if persistence is None:
+            return query
+        return persistence.query(query, **options)
+
+    @staticmethod
+    def result_cache(instance):
+        cache = getattr(instance, 'result_cache', None)
+        return default_cache if cache is None else cache
+
+    def cached_dispatch(self, instance, query, **options):
+        """`dispatch` through the result cache, `APIQuery` results (no
+        `persistence`) are never cached.
+        """
+        persistence = getattr(instance, 'persistence', None)
+        if persistence is None:
+            return query
+        # Backends on other databases may share the field name.
+        key = (persistence, query)
+        cache = self.result_cache(instance)
+        result = cache.get(self.field, key)
+        if result is MISS:
+            # Not stored if invalidated while the query runs.
+            generation = cache.generation(self.field)
+            result = persistence.query(query, **options)
+            cache.set(self.field, key, result, self.cache_ttl, generation)
+        return result
+
+    def invalidate(self, instance, query=MISS):
+        """Drops the cached result of `query`, or every cached field result,
+        of the owner `persistence`.
+
+        Returns:
+            int, the number of dropped entries.
+        """
+        persistence = getattr(instance, 'persistence', None)
+        cache = self.result_cache(instance)
+        if query is not MISS:
+            return cache.invalidate(self.field, (persistence, query))
+        return cache.invalidate(self.field, match=lambda key: key[0] is persistence)
+
+
+def prepared_statement(name, sql):
+    """Returns the ``PREPARE`` and ``EXECUTE`` statements for a ``%s``
+    parameterized `sql` statement.
+
+    >>> prepared_statement('stmt', 'SELECT * FROM api.fn(%s, %s);')
+    ('PREPARE stmt AS SELECT * FROM api.fn($1, $2);', 'EXECUTE stmt(%s, %s);')
+    """
+    chunks = sql.rstrip().rstrip(';').split('%s')
+    body = chunks[0] + ''.join(
+        '${:d}{}'.format(idx, chunk) for idx, chunk in enumerate(chunks[1:], 1)
+    )
+    if len(chunks) == 1:
+        return 'PREPARE {} AS {};'.format(name, body), 'EXECUTE {};'.format(name)
+    return ('PREPARE {} AS {};'.format(name, body),
+            'EXECUTE {}({});'.format(name, ', '.join(['%s'] * (len(chunks) - 1))))
+
+
+def array_literal(items):
+    """Renders a python sequence as a Postgresql array literal.
+
+    >>> print(array_literal([1, 'a b', None, [2, 'c"']]))
+    {1,"a b",NULL,{2,"c\\""}}
+    """
+    elements = []
+    for item in items:
+        if item is None:
+            elements.append('NULL')
+        elif isinstance(item, (list, tuple)):
+            elements.append(array_literal(item))
+        elif isinstance(item, six.integer_types + (float, )):
+            elements.append(str(item))
+        else:
+            elements.append('"{}"'.format(
+                six.text_type(item).replace('\\', '\\\\').replace('"', '\\"')
+            ))
+    return '{%s}' % ','.join(elements)
+
 
 class NumArg(BaseFuncArg):
     """Numeric Parameters formatter/validator class.
     """
-    formatter = '{}'
     param_type = (int, float)
 
 
 class TextArg(BaseFuncArg):
     """Textual Parameters formatter/validator class.
     """
-    formatter = "'{}'"
-    param_type = (six.string_types, )
+    param_type = six.string_types
 
 
 class BooleanArg(BaseFuncArg):
     """Boolean Parameters formatter/validator class.
     """
-
-    formatter = '{}'
     param_type = (bool, )
 
-    def format(self):
-        return str(self.param)
-
 
 class ArrayArg(BaseFuncArg):
     """Array Parameters formatter/validator class.
+
+    Arrays are sent as literals so the server infers the element type from
+    the function signature, as it does for ``'{1, 2}'``.
     """
-    formatter = "'{}'"
     param_type = (list, tuple)
 
-    def format(self):
-        array_data = str(self.param)[1:-1].replace("u'", "").replace("'", '')
-        return '{%s}' % array_data
+    adapt = staticmethod(array_literal)
 
 
 class JSONArg(BaseFuncArg):
     """JSON Parameters formatter/validator class.
     """
-    formatter = "'{}'"
     param_type = (dict, )
 
-    def format(self):
-        return json.dumps(self.param)
+    adapt = staticmethod(json.dumps)
 
 
 FUNC_TYPES = {
@@ -175,13 +299,29 @@ class UnknownParamError(DBAPIError):
     pass
 
 
+MISSING = object()
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Cast target types, e.g. `bigint`, `public.mood`, `varchar(20)[]`.
+SQL_TYPE = re.compile(r'^[A-Za-z_][\w.]*(?: [A-Za-z_]\w*)*(?:\(\d+(?:, ?\d+)?\))?(?:\[\])*$')
+
+STATEMENT_PREFIX = 'SELECT * FROM '
+
+
+def invalid_param(param_type):
+    raise InvalidFunctionParamError("Invalid type for {} param".format(param_type))
+
+
 def param_validator(param_specs, params, order=None):
     """Parameter validator function.
 
+    Yields the bind parameter values in function argument order.
+
     >>> param_specs = {"email": str, "tags": list}
     >>> params = {"email": "pav@gmail.com", "tags": [1, 2, 3, 4, 5]}
     >>> print(', '.join(sorted(param_validator(param_specs, params))))
-    'pav@gmail.com', '{1, 2, 3, 4, 5}'
+    pav@gmail.com, {1,2,3,4,5}
     """
     if not set(param_specs).issuperset(set(params)) or not params:
         raise UnknownParamError("Invalid function arguments: {} - {}".format(
@@ -205,10 +345,8 @@ class ViewField(BaseAPIField):
     example below).
 
     .. note::
-        ViewField class can be initialized with arguments, but so far they will
-        have no effect. The only reason that it is validated is that soon you
-        could pass parameters that control ``cache_property`` behavior and
-        result pagination. Classes with ``ViewField`` attributes *must* have
+        ViewField class accepts the ``cache``, ``cache_ttl`` and ``raw_json``
+        keywords, other arguments have no effect. Classes with ``ViewField`` attributes *must* have
         a `persistence` attribute that implements
         `pg_utils.bases.BaseConnectionPool`interface.
 
@@ -216,19 +354,36 @@ class ViewField(BaseAPIField):
 
         >>> class MyClass(object):
         ...     test_function = ViewField()
+        ...     # Results kept (up to) 5 minutes, see `pgtools.cache`.
+        ...     settings = ViewField(cache=True, cache_ttl=300)
         ...
+
+    Callables are created once per owner instance, as for `FunctionField`.
+    Cached callables have an ``invalidate`` method dropping the field
+    results.
     """
 
+    query = None
+
+    def compile(self):
+        self.query = APIQuery('SELECT * FROM {};'.format(self.field), ())
+
     def __get__(self, instance, owner):
         """Implementing descriptor '__get__' method.
         """
         if not instance and owner:
             return self
+        if self.query is None:
+            self.compile()
+        query, options = self.query, self.options
+        dispatch = self.cached_dispatch if self.lazyload else self.dispatch
 
         def _callback():
-            return  'SELECT * FROM {};'.format(self.field)
+            return dispatch(instance, query, **options)
 
-        return _callback
+        if self.lazyload:
+            _callback.invalidate = lambda: self.invalidate(instance)
+        return self.bind_instance(instance, _callback)
 
 
 class FunctionField(BaseAPIField):
@@ -240,7 +395,8 @@ class FunctionField(BaseAPIField):
     You must initialize it with python native types that
     correspond to Database function parameter types (as you example below).
     The ``__get__`` method returns a callable object, that acts as the actual
-    database function with parameter validation.
+    database function with parameter validation. It is created once per
+    owner instance and kept in the instance ``__dict__``.
 
     .. note::
         FunctionField can also be initialized with extra parameters with no
@@ -254,32 +410,187 @@ class FunctionField(BaseAPIField):
 
         >>> class MyModel(object):
         ...     get_model_by_pk = FunctionField(pk=int)
+        ...     # JSON results are returned as the server sent them.
+        ...     get_model_json = FunctionField(raw_json=True, pk=int)
+        ...
+
+    Callables also have a ``map`` method running many calls in one
+    statement, results being grouped per call::
+
+        >>> model.get_model_by_pk.map([{'pk': 1}, {'pk': 2}])  # doctest: +SKIP
+        [[RealDictRow([('pk', 1)])], [RealDictRow([('pk', 2)])]]
+
+    Calls run as prepared statements (see `pgtools.pool.ClientPool`), whose
+    parameters are untyped: the server infers their types from the function
+    signature, which is ambiguous for overloaded functions ("function is not
+    unique"). Declare the argument types to cast to with ``casts``::
+
+        >>> class Geo(DBAPIBackend):
+        ...     distance = FunctionField(casts={'a': 'point', 'b': 'point'}, a=str, b=str)
+        ...
+        >>> Geo().distance(a='(0,0)', b='(1,1)').sql
+        'SELECT * FROM public.distance(%s::point, %s::point);'
+
+    With ``cache=True`` results are cached per argument values (``map``
+    calls bypass the cache), ``invalidate(**args)`` drops the entry of
+    these arguments and ``invalidate()`` every field entry::
+
+        >>> class Settings(DBAPIBackend):
+        ...     get_setting = FunctionField(cache=True, cache_ttl=60, name=str)
         ...
+        >>> Settings().get_setting.invalidate(name='theme')  # doctest: +SKIP
+        1
     """
 
-    def __init__(self, order=None, **func_params):
+    def __init__(self, order=None, raw_json=False, cache=False, cache_ttl=MISS, casts=None,
+                 **func_params):
         self.order = order
         self.func_specs = func_params
-        super(FunctionField, self).__init__(**func_params)
+        self.casts = dict(casts or {})
+        for name, sql_type in self.casts.items():
+            if name not in func_params or not SQL_TYPE.match(sql_type):
+                raise ValueError('Invalid cast {}::{}'.format(name, sql_type))
+        self.build = None
+        super(FunctionField, self).__init__(raw_json=raw_json, cache=cache, cache_ttl=cache_ttl,
+                                            **func_params)
+
+    @property
+    def arguments(self):
+        """The function arguments, in call order.
+        """
+        return list(self.order or self.func_specs)
+
+    def call(self, names):
+        """The function call expression passing `names` arguments.
+        """
+        return '{}({})'.format(self.field, ', '.join(
+            '%s::' + self.casts[name] if name in self.casts else '%s' for name in names
+        ))
+
+    def statement(self, names):
+        return STATEMENT_PREFIX + self.call(names) + ';'
+
+    def batch_statement(self, queries):
+        """Merges single call `queries` into one ``UNION ALL`` statement
+        tagging each result row with its call index (``pgtools_ord``).
+        """
+        sql = ' UNION ALL '.join(
+            'SELECT {:d} AS pgtools_ord, * FROM {}'.format(
+                index, query.sql[len(STATEMENT_PREFIX):-1]
+            )
+            for index, query in enumerate(queries)
+        )
+        return APIQuery(sql + ';', tuple(param for query in queries for param in query.params))
+
+    def map(self, instance, calls, chunk_size=500):
+        """Runs the function once per kwargs dict of `calls`, `chunk_size`
+        calls per statement (so one round trip per chunk).
+
+        Every argument set is validated before anything runs. Each call
+        keeps the exact single call semantics (overload resolution,
+        defaults), calls are merged with ``UNION ALL`` rather than a
+        ``VALUES``/``unnest`` join, as untyped parameters would be resolved
+        as `text` there instead of the function argument types.
+
+        Returns:
+            list, the result rows of each call in `calls` order (without
+            the index column, sequence rows becoming tuples), or the chunk
+            `APIQuery` list when the owner has no `persistence`.
+        """
+        queries = [self.build(**args) for args in calls]
+        chunks = [queries[start:start + chunk_size]
+                  for start in six.moves.range(0, len(queries), chunk_size)]
+        if getattr(instance, 'persistence', None) is None:
+            return [self.batch_statement(chunk) for chunk in chunks]
+
+        results = []
+        for chunk in chunks:
+            grouped = [[] for _ in chunk]
+            for row in self.dispatch(instance, self.batch_statement(chunk), **self.options):
+                if isinstance(row, dict):
+                    grouped[row.pop('pgtools_ord')].append(row)
+                else:
+                    row = tuple(row)
+                    grouped[row[0]].append(row[1:])
+            results.extend(grouped)
+        return results
+
+    def build_generic(self, args):
+        """Builds the `APIQuery` of calls passing a subset of the arguments
+        (or non identifier names), validated in call order.
+        """
+        names = [name for name in self.arguments if name in args]
+        params = tuple(param_validator(self.func_specs, args, names))
+        return APIQuery(self.statement(names), params)
+
+    def compile(self):
+        """Compiles `build`, the ``**kwargs`` to `APIQuery` function of the
+        field signature.
+
+        Calls passing every argument run straight line generated code: one
+        ``isinstance`` check and adaptation per argument, a precomputed
+        statement and no intermediate objects. Other calls fall back to
+        `build_generic`.
+        """
+        names = self.arguments
+        if not names or not all(IDENTIFIER.match(name) and not keyword.iskeyword(name)
+                                and self.func_specs.get(name) in FUNC_TYPES for name in names):
+            self.build = lambda **args: self.build_generic(args)
+            return
+
+        namespace = {
+            '_pg_missing': MISSING,
+            '_pg_generic': self.build_generic,
+            '_pg_new': tuple.__new__,
+            '_pg_query': APIQuery,
+            '_pg_sql': self.statement(names),
+            '_pg_invalid': invalid_param,
+        }
+        lines = ['def build({}, **_pg_extra):'.format(
+            ', '.join('{}=_pg_missing'.format(name) for name in names)
+        )]
+        lines.append('    if _pg_extra or {}:'.format(
+            ' or '.join('{} is _pg_missing'.format(name) for name in names)
+        ))
+        lines.append('        _pg_args = dict(_pg_extra)')
+        for name in names:
+            lines.append('        if {0} is not _pg_missing: _pg_args[{0!r}] = {0}'.format(name))
+        lines.append('        return _pg_generic(_pg_args)')
+        values = []
+        for index, name in enumerate(names):
+            arg_type = FUNC_TYPES[self.func_specs[name]]
+            namespace['_pg_type{:d}'.format(index)] = arg_type.param_type
+            lines.append('    if not isinstance({0}, _pg_type{1:d}): _pg_invalid(_pg_type{1:d})'.format(
+                name, index
+            ))
+            if arg_type.adapt is None:
+                values.append(name)
+            else:
+                namespace['_pg_adapt{:d}'.format(index)] = arg_type.adapt
+                values.append('_pg_adapt{:d}({})'.format(index, name))
+        lines.append('    return _pg_new(_pg_query, (_pg_sql, ({}, )))'.format(', '.join(values)))
+        six.exec_('\n'.join(lines) + '\n', namespace)
+        self.build = namespace['build']
 
     def __get__(self, instance, owner):
         """Implementing descriptor '__get__' method.
         """
         if not instance and owner:
             return self
+        if self.build is None:
+            self.compile()
+        build, options = self.build, self.options
+        dispatch = self.cached_dispatch if self.lazyload else self.dispatch
 
         def func_callable(**args):
+            return dispatch(instance, build(**args), **options)
 
-            function_query = 'SELECT * FROM {}({});'.format(
-                self.field,
-                ', '.join(param_validator(
-                    self.func_specs, args, self.order
-                ))
+        if self.lazyload:
+            func_callable.invalidate = lambda **args: self.invalidate(
+                instance, build(**args) if args else MISS
             )
-
-            return function_query
-
-        return func_callable
+        func_callable.map = lambda calls, chunk_size=500: self.map(instance, calls, chunk_size)
+        return self.bind_instance(instance, func_callable)
 
 
 class DBAPIMeta(type):
@@ -289,7 +600,7 @@ class DBAPIMeta(type):
 
     1] Initialized Classes implement `Singleton` pattern.
     2] ViewFields, and FunctionFields auto tagging from class
-       labeling.
+       labeling, and compilation of their statements.
     """
     _instances = {}
 
@@ -297,6 +608,7 @@ class DBAPIMeta(type):
 
         cls_meta = attrs.get('Meta')
         cls_schema = getattr(cls_meta, 'schema', None)
+        api_fields = []
         for cls_tag, attr in attrs.items():
             try:
                 if BaseAPIField in attr.__class__.__mro__:
@@ -305,8 +617,11 @@ class DBAPIMeta(type):
                         cls_tag
                     )
                     attr.tag = cls_tag
+                    api_fields.append(attr)
             except AttributeError:
                 pass
+        for attr in api_fields:
+            attr.compile()
         return super(DBAPIMeta, mcs).__new__(mcs, name, bases, attrs)
 
     def __call__(cls, *args, **kwargs):
@@ -345,9 +660,16 @@ class DBAPIBackend(object):
         ...
         >>> product = ProductModel()
         >>> product.count_products()
-        'SELECT * FROM product.count_products;'
+        APIQuery(sql='SELECT * FROM product.count_products;', params=())
         >>> product.get_product(pk=6526352)
-        'SELECT * FROM product.get_product(6526352);'
+        APIQuery(sql='SELECT * FROM product.get_product(%s);', params=(6526352,))
+
+    Set a `persistence` attribute (any object with a ``query`` method, like
+    :class:`pgtools.pool.PostgresPool`) to execute the calls instead::
+
+        >>> ProductModel.persistence = pool  # doctest: +SKIP
+        >>> product.get_product(pk=6526352)  # doctest: +SKIP
+        [RealDictRow([('pk', 6526352), ('name', 'pgtools')])]
 
 
     """
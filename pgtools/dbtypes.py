@@ -10,8 +10,10 @@ __author__ = 'pav'
 
 
 from collections import OrderedDict
+import array
+import operator
+import re
 import six
-import weakref
 import psycopg2.extensions
 import psycopg2.extras
 
@@ -27,23 +29,175 @@ class ModelError(Exception):
     pass
 
 
+COMPOSITE_FIELD_RE = re.compile(r'"((?:[^"\\]|""|\\.)*)"|((?:[^,()"\\]|\\.)*)', re.DOTALL)
+
+COMPOSITE_ESCAPE_RE = re.compile(r'""|\\(.)', re.DOTALL)
+
+# Unquoted elements keep their inner whitespace, not the surrounding one.
+ARRAY_TOKEN_RE = re.compile(
+    r'\s*(?:(\{)|(\})|(,)|"((?:[^"\\]|\\.)*)"'
+    r'|((?:[^{},"\\\s]|\\.)(?:(?:[^{},"\\]|\\.)*(?:[^{},"\\\s]|\\.))?))\s*',
+    re.DOTALL
+)
+
+ARRAY_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+
+ARRAY_DIMENSIONS_RE = re.compile(r'(?:\[-?\d+:-?\d+\])+=')
+
+
+def _composite_unescape(match):
+    return match.group(1) or '"'
+
+
+def parse_composite(value):
+    """Parses a composite (record) literal into its field strings.
+
+    Empty unquoted fields are NULLs (`None`), quoted (or backslash escaped)
+    fields are unescaped.
+
+    >>> parse_composite('(1,"a ""b"", c",,"","{1,2}")')
+    ['1', 'a "b", c', None, '', '{1,2}']
+
+    Raises:
+        ModelError: Not a composite literal.
+    """
+    if len(value) < 2 or value[0] != '(' or value[-1] != ')':
+        raise ModelError('Invalid composite literal `{}`.'.format(value))
+    match_field = COMPOSITE_FIELD_RE.match
+    fields = []
+    append = fields.append
+    pos = 1
+    end = len(value) - 1
+    while True:
+        match = match_field(value, pos, end)
+        quoted, plain = match.groups()
+        if quoted is not None:
+            if '"' in quoted or '\\' in quoted:
+                quoted = COMPOSITE_ESCAPE_RE.sub(_composite_unescape, quoted)
+            append(quoted)
+        elif '\\' in plain:
+            append(ARRAY_ESCAPE_RE.sub(r'\1', plain))
+        else:
+            append(plain or None)
+        pos = match.end()
+        if pos >= end:
+            return fields
+        if value[pos] != ',':
+            raise ModelError('Invalid composite literal `{}`.'.format(value))
+        pos += 1
+
+
+def parse_array(value):
+    """Parses an array literal into (nested) lists of element strings.
+
+    >>> parse_array('{{1,NULL},{"a,b","c\\\\"d"}}')
+    [['1', None], ['a,b', 'c"d']]
+    >>> parse_array('[0:1]={x y,"NULL"}')
+    ['x y', 'NULL']
+
+    Raises:
+        ModelError: Not an array literal (unbalanced braces or quotes,
+            ragged or mixed dimensions, missing delimiters).
+    """
+    literal = value
+    if value[:1] == '[':
+        match = ARRAY_DIMENSIONS_RE.match(value)
+        if match is None:
+            raise ModelError('Invalid array literal `{}`.'.format(literal))
+        value = value[match.end():]
+    if value[:1] != '{' or value[-1:] != '}':
+        raise ModelError('Invalid array literal `{}`.'.format(literal))
+    match_token = ARRAY_TOKEN_RE.match
+    stack = []
+    current = result = None
+    # Whether an element (or sub-array) may follow, after `{` and `,`.
+    expect_item = True
+    pos = 0
+    end = len(value)
+    while pos < end:
+        match = match_token(value, pos)
+        if match is None or result is not None:
+            raise ModelError('Invalid array literal `{}`.'.format(literal))
+        pos = match.end()
+        opening, closing, comma, quoted, plain = match.groups()
+        if comma:
+            if expect_item:
+                raise ModelError('Invalid array literal `{}`.'.format(literal))
+            expect_item = True
+        elif closing:
+            if expect_item and (current or stack):
+                raise ModelError('Invalid array literal `{}`.'.format(literal))
+            expect_item = False
+            if not stack:
+                result = current
+                continue
+            items, current = current, stack.pop()
+            if len(items) != len(current[0]):
+                raise ModelError('Invalid array literal `{}`.'.format(literal))
+        else:
+            if not expect_item or current and (opening is None) is isinstance(current[0], list):
+                raise ModelError('Invalid array literal `{}`.'.format(literal))
+            if opening:
+                items = []
+                if current is not None:
+                    current.append(items)
+                    stack.append(current)
+                current = items
+                continue
+            expect_item = False
+            if quoted is not None:
+                current.append(ARRAY_ESCAPE_RE.sub(r'\1', quoted) if '\\' in quoted else quoted)
+            elif '\\' in plain:
+                current.append(ARRAY_ESCAPE_RE.sub(r'\1', plain))
+            else:
+                current.append(None if plain.upper() == 'NULL' else plain)
+    if result is None:
+        raise ModelError('Invalid array literal `{}`.'.format(literal))
+    return result
+
+
 class ModelField(object):
     """Base model field.
+
+    Values live in a ``_<name>`` slot of the model instance, bound by
+    `ModelMeta`. `clean_value` validates python values on assignment,
+    `from_text` converts the field Postgresql text representation (as found
+    in composite and array literals). `typecode` is the `array` type code
+    used for `ModelBatch` columns, `None` for list columns.
     """
+    typecode = None
+
     def __init__(self):
-        self._cache = weakref.WeakKeyDictionary()
+        self.name = None
+        self._get = self._set = None
+
+    def bind(self, name, slot):
+        """Binds the field to its model `slot` member descriptor.
+        """
+        self.name = name
+        self._get = slot.__get__
+        self._set = slot.__set__
 
     def __get__(self, instance, owner):
         """Descriptor `__get__` method.
         """
-        if not instance and owner:
+        if instance is None:
             return self
-
-        return self._cache.get(instance, None)
+        try:
+            return self._get(instance)
+        except AttributeError:
+            return None
 
     def __set__(self, instance, value):
-        cleaned_value = self.clean_value(value)
-        self._cache[instance] = cleaned_value
+        self._set(instance, self.clean_value(value))
+
+    def store(self, instance, value):
+        """Stores an already converted value, skipping `clean_value`.
+        """
+        self._set(instance, value)
+
+    def from_text(self, value):
+        return self.clean_value(value)
 
     def raise_error(self, value):
         raise ModelError('Invalid value `{}` for {}.'.format(
@@ -58,6 +212,8 @@ class ModelField(object):
 class IntegerModelField(ModelField):
     """IntegerModelField
     """
+    typecode = 'q'
+
     def clean_value(self, value):
         try:
             return int(value)
@@ -68,9 +224,11 @@ class IntegerModelField(ModelField):
 class FloatModelField(ModelField):
     """FloatModelField
     """
+    typecode = 'd'
+
     def clean_value(self, value):
         try:
-            return int(value)
+            return float(value)
         except ValueError:
             self.raise_error(value)
 
@@ -91,32 +249,141 @@ class JSONModelField(ModelField):
         except Exception:
             return self.raise_error(value)
 
+    def from_text(self, value):
+        try:
+            return json.loads(value)
+        except Exception:
+            return self.raise_error(value)
+
+
+class BooleanModelField(ModelField):
+    """BooleanModelField
+    """
+    def clean_value(self, value):
+        if isinstance(value, bool):
+            return value
+        if value in ('t', 'true'):
+            return True
+        if value in ('f', 'false'):
+            return False
+        self.raise_error(value)
+
+
+class ArrayModelField(ModelField):
+    """ArrayModelField, a (possibly multidimensional) array of `item_field`
+    values.
+    """
+    def __init__(self, item_field):
+        self.item_field = item_field
+        super(ArrayModelField, self).__init__()
+
+    def _convert(self, items, convert):
+        return [None if item is None
+                else self._convert(item, convert) if isinstance(item, list)
+                else convert(item)
+                for item in items]
+
+    def clean_value(self, value):
+        if isinstance(value, six.string_types):
+            return self.from_text(value)
+        if not isinstance(value, (list, tuple)):
+            self.raise_error(value)
+        return self._convert(list(value), self.item_field.clean_value)
+
+    def from_text(self, value):
+        return self._convert(parse_array(value), self.item_field.from_text)
+
+
+class CompositeModelField(ModelField):
+    """CompositeModelField, a nested composite value mapped to `model`.
+    """
+    def __init__(self, model):
+        self.model = model
+        super(CompositeModelField, self).__init__()
+
+    def clean_value(self, value):
+        if value is None or isinstance(value, self.model):
+            return value
+        if isinstance(value, six.string_types):
+            return self.from_text(value)
+        self.raise_error(value)
+
+    def from_text(self, value):
+        return model_converter(self.model)(value)
+
+
+MISSING = object()
+
 
 class ModelMeta(type):
     """Metaclass for model classes.
+
+    Generates a ``_<field>`` slot per `ModelField` (inherited fields
+    first), an ``__init__`` accepting field values positionally or by
+    keyword (cleaned, unknown keywords ignored), and the unchecked `_make`
+    (one row of already converted values) and `from_rows` bulk
+    constructors.
+
+    Generated code names are prefixed with ``_pg_``, field names can be
+    anything else (``self``, ``row``...).
+
+    Raises:
+        ModelError: A field name starts with ``_pg_``.
     """
     @classmethod
     def __prepare__(mcs, name, bases):
         return OrderedDict()
 
     def __new__(mcs, name, bases, attrs):
-        cls_fields = [key for key, value in attrs.items()
+        own_fields = [key for key, value in attrs.items()
                       if ModelField in value.__class__.mro()]
-
-        def cls_init(self, **kwargs):
-            for k, v in kwargs.items():
-                if k in self.fields():
-                    print(k)
-                    setattr(self, k, v)
+        base_fields = []
+        for base in bases:
+            for field in getattr(base, '_fields', ()):
+                if field not in base_fields and field not in own_fields:
+                    base_fields.append(field)
+        cls_fields = tuple(base_fields + own_fields)
+        for field in own_fields:
+            if field.startswith('_pg_'):
+                raise ModelError('Reserved field name `{}`.'.format(field))
+
+        attrs['__slots__'] = tuple(attrs.get('__slots__', ())) + tuple(
+            '_' + field for field in own_fields
+        )
+        attrs['_fields'] = cls_fields
 
         def to_dict(self):
             return {attr: getattr(self, attr, None) for attr in self.fields()}
 
-        attrs['__init__'] = cls_init
-        attrs['fields'] = classmethod(lambda cls: cls_fields)
+        attrs['fields'] = classmethod(lambda cls: list(cls_fields))
         attrs['to_dict'] = property(to_dict)
 
-        return super(ModelMeta, mcs).__new__(mcs, name, bases, attrs)
+        cls = super(ModelMeta, mcs).__new__(mcs, name, bases, attrs)
+        for field in own_fields:
+            attrs[field].bind(field, cls.__dict__['_' + field])
+
+        namespace = {'_pg_missing': MISSING, '_pg_new': object.__new__}
+        namespace.update(('_pg_clean{:d}'.format(index), getattr(cls, field).clean_value)
+                         for index, field in enumerate(cls_fields))
+        six.exec_(mcs.constructors_source(cls_fields), namespace)
+        cls.__init__ = namespace['__init__']
+        cls._make = classmethod(namespace['_make'])
+        return cls
+
+    @staticmethod
+    def constructors_source(fields):
+        args = ''.join(', {}=_pg_missing'.format(field) for field in fields)
+        init = ['def __init__(_pg_self{}, **_pg_ignored):'.format(args)]
+        for index, field in enumerate(fields):
+            init.append('    _pg_self._{0} = None if {0} is _pg_missing else _pg_clean{1:d}({0})'
+                        .format(field, index))
+        make = ['def _make(_pg_cls, _pg_row):', '    _pg_self = _pg_new(_pg_cls)']
+        if fields:
+            make.append('    {}, = _pg_row'.format(
+                ', '.join('_pg_self._' + field for field in fields)
+            ))
+        make.append('    return _pg_self')
+        return '\n'.join(init + ['    pass', ''] + make) + '\n'
 
 
 @six.add_metaclass(ModelMeta)
@@ -143,28 +410,259 @@ class BaseModel(object):
             ', '.join(['{}={}'.format(k, v) for k, v in self])
         )
 
+    @classmethod
+    def from_rows(cls, rows):
+        """Bulk constructor from fetched rows, tuples in field order or
+        mappings (e.g. `RealDictRow`) keyed by field name.
+
+        Values are stored as fetched, without `clean_value`.
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+        if isinstance(rows[0], dict):
+            if len(cls._fields) == 1:
+                key = cls._fields[0]
+                rows = [(row[key], ) for row in rows]
+            else:
+                rows = map(operator.itemgetter(*cls._fields), rows)
+        return list(map(cls._make, rows))
+
+
+class ModelBatchRow(object):
+    """Lazy view of a `ModelBatch` row, values are read from the batch
+    columns on access.
+    """
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __getattr__(self, name):
+        try:
+            column = self.batch.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+        return column[self.index]
+
+    def __getitem__(self, name):
+        return self.batch.columns[name][self.index]
+
+    @property
+    def to_dict(self):
+        index = self.index
+        return {name: column[index] for name, column in self.batch.columns.items()}
+
+    def to_model(self):
+        index = self.index
+        return self.batch.model._make([column[index] for column in self.batch.columns.values()])
+
+    def __repr__(self):
+        return '<{} row {} view>'.format(self.batch.model.__name__, self.index)
+
+
+class ModelBatch(object):
+    """**Columnar container of `BaseModel` rows**
+
+    Holds one column per model field: an `array.array` for fields with a
+    `typecode` (unless the column holds NULLs), a list otherwise. Indexing
+    returns lazy `ModelBatchRow` views, slicing, `filter` and `take` return
+    new batches, no model instance is built unless asked (`to_models`).
+
+    Example usage::
+
+        >>> class Point(BaseModel):
+        ...     x = IntegerModelField()
+        ...     label = TextModelField()
+        ...
+        >>> batch = ModelBatch.from_rows(Point, [(1, 'a'), (2, 'b'), (3, None)])
+        >>> batch.columns['x']
+        array('q', [1, 2, 3])
+        >>> batch[1].label, len(batch[1:])
+        ('b', 2)
+        >>> batch.filter(lambda row: row.x > 1, label='b').to_dicts()
+        [{'x': 2, 'label': 'b'}]
+
+    Attributes:
+        model (BaseModel): The model class.
+        columns (OrderedDict): Field name to column values.
+    """
+
+    def __init__(self, model, columns):
+        self.model = model
+        self.columns = OrderedDict((name, columns[name]) for name in model.fields())
+        lengths = set(len(column) for column in self.columns.values())
+        if len(lengths) > 1:
+            raise ModelError('Column lengths differ for {}.'.format(model.__name__))
+        self.length = lengths.pop() if lengths else 0
+
+    @staticmethod
+    def _column(field, values):
+        if field.typecode is not None:
+            try:
+                return array.array(field.typecode, values)
+            except TypeError:
+                pass
+        return list(values)
+
+    @classmethod
+    def from_columns(cls, model, columns):
+        """Builds a batch from columns keyed by field name (e.g.
+        `ClientPool.fetch_columns` results), converting them as needed.
+        """
+        converted = {}
+        for name in model.fields():
+            column = columns[name]
+            field = getattr(model, name)
+            if not (isinstance(column, array.array) and column.typecode == field.typecode):
+                column = cls._column(field, column)
+            converted[name] = column
+        return cls(model, converted)
+
+    @classmethod
+    def from_rows(cls, model, rows):
+        """Builds a batch from tuples in field order or mappings (e.g.
+        `RealDictRow`) keyed by field name.
+        """
+        rows = list(rows)
+        fields = model.fields()
+        if rows and isinstance(rows[0], dict):
+            values = [[row[name] for row in rows] for name in fields]
+        else:
+            values = list(zip(*rows)) or [()] * len(fields)
+        return cls(model, dict(
+            (name, cls._column(getattr(model, name), column))
+            for name, column in zip(fields, values)
+        ))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for index in six.moves.range(self.length):
+            yield ModelBatchRow(self, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return ModelBatch(self.model, dict(
+                (name, column[key]) for name, column in self.columns.items()
+            ))
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('ModelBatch index out of range')
+        return ModelBatchRow(self, key)
+
+    def take(self, indices):
+        """Returns a new batch holding the rows at `indices`.
+        """
+        indices = list(indices)
+        columns = {}
+        for name, column in self.columns.items():
+            values = [column[index] for index in indices]
+            if isinstance(column, array.array):
+                values = array.array(column.typecode, values)
+            columns[name] = values
+        return ModelBatch(self.model, columns)
+
+    def filter(self, predicate=None, **equals):
+        """Returns the rows matching `predicate` (called with a row view)
+        and whose columns equal the `equals` keyword values.
+        """
+        indices = six.moves.range(self.length)
+        for name, value in equals.items():
+            column = self.columns[name]
+            indices = [index for index in indices if column[index] == value]
+        if predicate is not None:
+            indices = [index for index in indices if predicate(ModelBatchRow(self, index))]
+        return self.take(indices)
+
+    def to_models(self):
+        return self.model.from_rows(zip(*self.columns.values()))
+
+    def to_dicts(self):
+        names = tuple(self.columns)
+        return [dict(zip(names, values)) for values in zip(*self.columns.values())]
+
+    def to_json(self, **kwargs):
+        """Serializes the rows as a JSON array of objects (`kwargs` are
+        passed to ``json.dumps``).
+
+        The rows are built as dicts first (see `to_dicts`), dump `columns`
+        instead where a column wise document will do.
+        """
+        return json.dumps(self.to_dicts(), **kwargs)
+
+    def __repr__(self):
+        return '<{} batch of {} rows>'.format(self.model.__name__, self.length)
+
+
+def model_converter(model):
+    """Returns the (cached) composite literal to `model` instance converter.
+
+    Field converters are looked up once, in declaration order, which must
+    match the composite type attribute order.
+    """
+    try:
+        return model.__dict__['_converter']
+    except KeyError:
+        pass
+
+    converters = tuple(getattr(model, name).from_text for name in model.fields())
+    count = len(converters)
+    make = model._make
 
-def db_cast(model, pg_oid):
+    def convert(value):
+        values = parse_composite(value)
+        if len(values) != count:
+            raise ModelError('Expected {} fields for {}, got `{}`.'.format(
+                count, model.__name__, value
+            ))
+        return make([None if item is None else from_text(item)
+                     for from_text, item in zip(converters, values)])
+
+    model._converter = convert
+    return convert
+
+
+def cast_column(model, values):
+    """Batch mode, converts a fetched column of composite literals (e.g.
+    selected as ``::text`` or without a registered typecaster) at once.
+
+    `None` values stay `None`.
+    """
+    convert = model_converter(model)
+    return [None if value is None else convert(value) for value in values]
+
+
+def db_cast(model, pg_oid, scope=None):
     """Postgresql casting utility function
 
+    Registers a typecaster converting `pg_oid` composite values to `model`
+    instances.
+
     Args:
-        model:
-        pg_oid:
+        model (BaseModel): The model class, fields declared in the composite
+            type attribute order.
+        pg_oid (int): The composite type oid.
+        scope (instance): Connection or cursor to register the typecaster
+            on, `None` registers it globally.
 
     Returns:
-
+        The `psycopg2` typecaster.
     """
+    convert = model_converter(model)
+
     def cast_destination(value, cur=None):
         """A callable that implements `psycopg2.extras.register_type` protocol.
         """
-        if not value:
+        if value is None:
             return None
+        return convert(value)
 
-        python_value = eval(value.replace('""', "'"))
-        instance_data = dict(zip(model.fields(), python_value))
-
-        return model(**instance_data)
-
-    mapping_model = psycopg2.extensions.new_type((pg_oid, ), model.__class__.__name__, cast_destination)
+    mapping_model = psycopg2.extensions.new_type((pg_oid, ), model.__name__.upper(),
+                                                 cast_destination)
 
-    psycopg2.extensions.register_type(mapping_model, None)
+    psycopg2.extensions.register_type(mapping_model, scope)
+    return mapping_model
@@ -11,9 +11,15 @@ __all__ = ['DBPoolEngine']
 
 import logging
 import contextlib
+import time
+import weakref
 import psycopg2
 import psycopg2.pool
 from psycopg2.extras import RealDictCursor
+from pgtools.dbapi import APIQuery
+from pgtools.metrics import Instrumented, PoolMetrics
+from pgtools.rows import row_factory
+from pgtools.jsoncodec import json_decoder, register_json_decoder, register_raw_json
 
 
 POOL_TYPE = (
@@ -34,7 +40,7 @@ class EngineError(Exception):
     pass
 
 
-class DBPoolEngine(object):
+class DBPoolEngine(Instrumented):
     """Postgresql psycopg2 connection pooling class.
 
     `DBPool` class wraps `psycopg2` connection pooling functionality.
@@ -50,6 +56,12 @@ class DBPoolEngine(object):
         - conn_data (dict): Postgresql connection kwargs.
         - debug (boolean): Indicates if database warning must be shown.
         - error_status (str): Holds traceback info of the last error occurred.
+        - metrics (PoolMetrics): Built-in histograms, see `stats`.
+        - hooks (list): Registered `pgtools.metrics.PoolHooks`.
+        - json_loads (str|callable): `json`/`jsonb` decoder registered on each
+          pool connection (see `pgtools.jsoncodec.json_decoder`), `None` keeps
+          the `psycopg2` defaults.
+        - json_lazy (boolean): Return `pgtools.jsoncodec.LazyJSON` values.
 
 
     Example is the following::
@@ -74,18 +86,25 @@ class DBPoolEngine(object):
 
     pool_uid = "pg://{}@{}.{}/{}"
 
-    __slots__ = ('db', 'pool_size', 'pool_type', 'debug', 'conn_data', 'logger', 'cursor_type')
+    __slots__ = ('db', 'pool_size', 'pool_type', 'debug', 'conn_data', 'logger', 'cursor_type',
+                 'metrics', 'hooks', 'json_loads', 'json_lazy', '_configured')
 
-    def __init__(self, pool_size, pool_type, debug=False, cursor_type=RealDictCursor, **conn_data):
+    def __init__(self, pool_size, pool_type, debug=False, cursor_type=RealDictCursor,
+                 json_loads=None, json_lazy=False, **conn_data):
         """Initialization data.
         """
         self.db = None
         self.pool_size = pool_size
         self.pool_type = pool_type
         self.conn_data = conn_data
-        self.cursor_type = cursor_type
+        self.cursor_type = row_factory(cursor_type)
         self.debug = debug
         self.logger = logging.getLogger(__name__)
+        self.metrics = PoolMetrics()
+        self.hooks = [self.metrics]
+        self.json_loads = json_decoder(json_loads) if json_loads is not None else None
+        self.json_lazy = json_lazy
+        self._configured = weakref.WeakKeyDictionary()
 
     def __repr__(self):
         return self._pool_uid_maker(
@@ -110,41 +129,84 @@ class DBPoolEngine(object):
         )
 
     @contextlib.contextmanager
-    def _get_cursor(self):
+    def _get_cursor(self, cursor_type=None):
         """Returns an active connection from persistence pool as
         context manager and returns the connection back to pool when finishes.
 
-        :param cursor_type (str):
+        :param cursor_type (str|type): Row factory overriding `cursor_type`.
         :return: Context manager instance.
 
         """
         if not self.db or self.db.closed:
             self._init_connection()
 
+        started = time.time()
         connection = self.db.getconn()
+        self.emit('on_checkout', time.time() - started)
+        if self.json_loads is not None and connection not in self._configured:
+            register_json_decoder(connection, self.json_loads, self.json_lazy)
+            self._configured[connection] = True
         connection.autocommit = True
 
         try:
             yield connection.cursor(
-                cursor_factory=self.cursor_type
+                cursor_factory=row_factory(cursor_type) or self.cursor_type
             )
+            started = time.time()
             connection.commit()
+            self.emit('on_commit', time.time() - started)
         except (psycopg2.ProgrammingError, psycopg2.DatabaseError, psycopg2.DatabaseError) as error:
 
             self.logger.warn(error.message)
 
             if self.debug:
                 warnings.warn('\n' + self.error_status)
+            started = time.time()
             connection.rollback()
+            self.emit('on_rollback', time.time() - started)
         finally:
             self.db.putconn(connection)
 
-    def query(self, query, fetch_opts="many"):
+    def query(self, query, fetch_opts="many", raw_json=False, cursor_type=None):
         """Execute postgresql query.
+
+        `cursor_type` overrides the engine row factory for this call, see
+        `pgtools.rows.row_factory` ('dict', 'tuple', 'namedtuple', 'record').
+
+        `raw_json` ('str' or `True`, 'bytes') returns `json`/`jsonb` values
+        undecoded, ready to be written to a response as is.
+        """
+        params = None
+        if isinstance(query, APIQuery):
+            query, params = query
+
+        with self._get_cursor(cursor_type) as cursor:
+            if raw_json:
+                register_raw_json(cursor, raw_json)
+            started = time.time()
+            cursor.execute(query, params)
+            self.emit('on_execute', query, params, time.time() - started, cursor.rowcount)
+
+            started = time.time()
+            result = getattr(cursor, dict(CURSOR_FETCH).get(fetch_opts))()
+            self.emit('on_fetch', len(result) if fetch_opts == 'many' else int(result is not None),
+                      time.time() - started)
+            return result
+
+    def stats(self):
+        """Returns a snapshot of the pool state and `metrics` histograms.
         """
-        with self._get_cursor() as cursor:
-            cursor.execute(query)
-            return getattr(cursor, dict(CURSOR_FETCH).get(fetch_opts))()
+        used = len(getattr(self.db, '_used', ()))
+        idle = len(getattr(self.db, '_pool', ()))
+        snapshot = {
+            'size': used + idle,
+            'maxsize': self.pool_size,
+            'in_use': used,
+            'idle': idle,
+            'waiters': 0,
+        }
+        snapshot.update(self.metrics.snapshot())
+        return snapshot
 
     @classmethod
     def _pool_uid_maker(cls, user, host, port, database):
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.errors` module.
+
+Provides the connection pool exceptions shared by the gevent and asyncio
+pool backends.
+"""
+
+__all__ = ('DBPoolError', 'PoolTimeoutError', 'PoolOverloadError')
+
+
+class DBPoolError(Exception):
+    """Raises when a storage client error occurs.
+    """
+    pass
+
+
+class PoolTimeoutError(DBPoolError):
+    """Raises when no connection could be acquired within the timeout.
+    """
+    pass
+
+
+class PoolOverloadError(DBPoolError):
+    """Raises when the pool is exhausted and the overload policy refuses to
+    queue the request.
+    """
+    pass
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.jsoncodec` module.
+
+Provides pluggable `json`/`jsonb` column decoders and lazily decoded
+values, registered per connection.
+
+Example usage::
+
+    >>> loads = json_decoder('fast')
+    >>> loads('{"id": 1}')['id']
+    1
+    >>> doc = LazyJSON('{"id": 1, "tags": ["a"]}')
+    >>> doc.decoded
+    False
+    >>> doc['tags'], doc.decoded
+    (['a'], True)
+"""
+
+from __future__ import absolute_import
+
+__all__ = ('JSON_DECODERS', 'LazyJSON', 'json_decoder', 'register_json_decoder',
+           'register_raw_json')
+
+import functools
+import json
+from collections import OrderedDict
+
+import psycopg2.extras
+from psycopg2 import extensions
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+JSON_DECODERS = {
+    'ordered': functools.partial(json.loads, object_pairs_hook=OrderedDict),
+    'stdlib': json.loads,
+}
+
+if ujson is not None:
+    JSON_DECODERS['ujson'] = ujson.loads
+
+if orjson is not None:
+    JSON_DECODERS['orjson'] = orjson.loads
+
+JSON_DECODERS['fast'] = JSON_DECODERS.get('orjson') or JSON_DECODERS.get('ujson') or json.loads
+
+# Builtin `json`, `jsonb` and their array type oids.
+JSON_OIDS = ((114, 199), (3802, 3807))
+
+
+def _raw_typecasters(name, cast):
+    typecasters = []
+    for oid, array_oid in JSON_OIDS:
+        typecaster = extensions.new_type((oid, ), 'RAW{}_{:d}'.format(name, oid), cast)
+        typecasters.append(typecaster)
+        typecasters.append(extensions.new_array_type(
+            (array_oid, ), 'RAW{}ARRAY_{:d}'.format(name, oid), typecaster))
+    return tuple(typecasters)
+
+
+RAW_JSON_TYPES = {
+    'str': _raw_typecasters('JSON', lambda value, cursor: value),
+    'bytes': _raw_typecasters(
+        'JSONBYTES', lambda value, cursor: value if value is None else value.encode('utf-8')),
+}
+
+
+def json_decoder(decoder='ordered'):
+    """Resolves a decoder name to a ``loads`` callable.
+
+    Args:
+        decoder (str|callable): 'ordered' (stdlib, `OrderedDict` objects),
+            'stdlib', 'orjson', 'ujson', 'fast' (best installed) or a callable.
+            Note that orjson/ujson keep the document key order in plain dicts.
+
+    Raises:
+        ValueError: Unknown or not installed decoder.
+    """
+    if callable(decoder):
+        return decoder
+    try:
+        return JSON_DECODERS[decoder]
+    except KeyError:
+        raise ValueError('Unknown (or not installed) JSON decoder %r' % (decoder, ))
+
+
+class LazyJSON(object):
+    """A `json` value kept as raw text until first accessed.
+
+    Mapping and sequence access decode the document once and delegate to
+    the decoded value, while `raw` can be forwarded untouched.
+
+    Attributes:
+        raw (str): The column text, as sent by the server.
+        loads (callable): Decoder used on first access.
+    """
+    __slots__ = ('raw', 'loads', '_value')
+
+    _pending = object()
+
+    def __init__(self, raw, loads=json.loads):
+        self.raw = raw
+        self.loads = loads
+        self._value = self._pending
+
+    @property
+    def value(self):
+        if self._value is self._pending:
+            self._value = self.loads(self.raw)
+        return self._value
+
+    @property
+    def decoded(self):
+        return self._value is not self._pending
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __bool__(self):
+        return bool(self.value)
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJSON):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __getattr__(self, name):
+        # Delegates `get`, `keys`, `items`, `index`, ... to the decoded value.
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __str__(self):
+        return self.raw
+
+    def __repr__(self):
+        if self.decoded:
+            return 'LazyJSON(%r)' % (self._value, )
+        return 'LazyJSON(<%d chars>)' % (len(self.raw), )
+
+
+def register_json_decoder(conn, decoder='ordered', lazy=False):
+    """Registers `json` and `jsonb` typecasters on a single connection.
+
+    Args:
+        conn (psycopg2.connection): Target connection.
+        decoder (str|callable): See `json_decoder`.
+        lazy (boolean): Return `LazyJSON` values, decoded on first access.
+    """
+    loads = json_decoder(decoder)
+    if lazy:
+        loads = functools.partial(LazyJSON, loads=loads)
+    psycopg2.extras.register_default_json(conn, loads=loads)
+    psycopg2.extras.register_default_jsonb(conn, loads=loads)
+
+
+def register_raw_json(conn_or_curs, raw='str'):
+    """Makes `json`/`jsonb` values come back undecoded, as sent by the server.
+
+    Registered on a cursor it only affects that cursor, overriding any
+    connection decoder, so the text can be written straight to a response.
+
+    Args:
+        conn_or_curs (instance): Target `psycopg2` connection or cursor.
+        raw (str|boolean): 'str' (or `True`) or 'bytes' (UTF-8 encoded).
+
+    Raises:
+        ValueError: Invalid `raw` mode.
+    """
+    try:
+        typecasters = RAW_JSON_TYPES['str' if raw is True else raw]
+    except KeyError:
+        raise ValueError('Invalid raw JSON mode %r' % (raw, ))
+    for typecaster in typecasters:
+        extensions.register_type(typecaster, conn_or_curs)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.metrics` module.
+
+Provides instrumentation hooks and in-process latency histograms for
+connection pools.
+"""
+
+from __future__ import absolute_import
+
+__all__ = ('Histogram', 'PoolHooks', 'PoolMetrics', 'Instrumented')
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """HDR-style log-linear histogram.
+
+    Values are scaled by `unit` to integers and counted in buckets whose
+    width doubles every `2 ** sub_bits` buckets, so the relative error stays
+    under ``2 ** -sub_bits`` whatever the magnitude, in constant memory.
+
+    >>> hist = Histogram(unit=1)
+    >>> for value in range(1, 101):
+    ...     hist.record(value)
+    >>> hist.count, hist.min, hist.max, hist.percentile(50)
+    (100, 1, 100, 50)
+
+    Attributes:
+        unit (float): Recorded value resolution, 1e-6 records microseconds.
+        sub_bits (int): Bucket precision bits.
+    """
+
+    def __init__(self, unit=1e-6, sub_bits=5):
+        self.unit = unit
+        self.sub_bits = sub_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.sub_bits
+        if shift <= 0:
+            return value
+        return (shift << self.sub_bits) + (value >> shift)
+
+    def _value(self, index):
+        shift = index >> self.sub_bits
+        if not shift:
+            return index
+        low = (index - (shift << self.sub_bits)) << shift
+        return low + (((1 << shift) - 1) >> 1)
+
+    def record(self, value):
+        scaled = int(value / self.unit)
+        if scaled < 0:
+            scaled = 0
+        index = self._index(scaled)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns the (bucket approximated) value at `percent`.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(max(self._value(index) * self.unit, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / float(self.count) if self.count else None
+
+    def reset(self):
+        self.__init__(self.unit, self.sub_bits)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class PoolHooks(object):
+    """**Base instrumentation hooks class**
+
+    Subclass it and override the events you need, then register an
+    instance with ``pool.add_hook``. `source` is the emitting pool (or
+    `PubSub`), durations are in seconds.
+    """
+
+    def on_checkout(self, source, wait):
+        pass
+
+    def on_execute(self, source, query, params, duration, rowcount):
+        pass
+
+    def on_fetch(self, source, rows, duration):
+        pass
+
+    def on_commit(self, source, duration):
+        pass
+
+    def on_rollback(self, source, duration):
+        pass
+
+
+class PoolMetrics(PoolHooks):
+    """Built-in hooks keeping acquire wait, query time and rows histograms.
+    """
+
+    def __init__(self):
+        self.acquire_wait = Histogram()
+        self.query_time = Histogram()
+        self.rows = Histogram(unit=1)
+        self.commits = 0
+        self.rollbacks = 0
+
+    def on_checkout(self, source, wait):
+        self.acquire_wait.record(wait)
+
+    def on_execute(self, source, query, params, duration, rowcount):
+        self.query_time.record(duration)
+
+    def on_fetch(self, source, rows, duration):
+        self.rows.record(rows)
+
+    def on_commit(self, source, duration):
+        self.commits += 1
+
+    def on_rollback(self, source, duration):
+        self.rollbacks += 1
+
+    def reset(self):
+        self.__init__()
+
+    def snapshot(self):
+        return {
+            'acquire_wait': self.acquire_wait.snapshot(),
+            'query_time': self.query_time.snapshot(),
+            'rows': self.rows.snapshot(),
+            'commits': self.commits,
+            'rollbacks': self.rollbacks,
+        }
+
+
+class Instrumented(object):
+    """Mixin dispatching events to registered `PoolHooks`.
+
+    Subclasses must set a `metrics` (`PoolMetrics`) and a `hooks` list
+    attribute, the built-in metrics being the first hook.
+    """
+    __slots__ = ()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def emit(self, event, *args):
+        for hook in self.hooks:
+            try:
+                getattr(hook, event)(self, *args)
+            except Exception:
+                logger.exception('Hook %r failed on %s.', hook, event)
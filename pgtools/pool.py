@@ -9,30 +9,48 @@ from __future__ import absolute_import
 
 __date__ = '2016-1-22'
 __version__ = '1.1'
-__all__ = ('PostgresPool', )
+__all__ = ('PostgresPool', 'DBPoolError', 'PoolTimeoutError', 'PoolOverloadError')
 
 import six
 import contextlib
-import json
+import io
+import itertools
+import logging
+import re
+import time
+import weakref
 import gevent
-from collections import OrderedDict
+import gevent.event
+import gevent.pool
+from collections import OrderedDict, deque
+import gevent.queue
 from gevent.queue import Queue
 import gevent.socket as g_socket
 from psycopg2 import (extensions, OperationalError, connect)
-import psycopg2.extras
 import sys
+from pgtools.dbapi import APIQuery, prepared_statement
+from pgtools.errors import DBPoolError, PoolTimeoutError, PoolOverloadError
+from pgtools.metrics import Instrumented, PoolMetrics
+from pgtools.rows import ColumnBuffers, row_factory
+from pgtools.jsoncodec import (JSON_DECODERS, json_decoder, register_json_decoder,
+                               register_raw_json)
+from pgtools.copyio import (BinaryCopyDecoder, CopyInStream, CopyOutBuffer, CopyOutSink,
+                            COPY_FORMATS, parse_copy_rows, quote_ident)
 
 
+logger = logging.getLogger(__name__)
+
 wait_read = getattr(g_socket, 'wait_read')
 wait_write = getattr(g_socket, 'wait_write')
 
 integer_types = six.integer_types
 
 
-class DBPoolError(Exception):
-    """Raises when a storage client error occurs.
-    """
-    pass
+OVERLOAD_POLICIES = ('queue', 'fail')
+
+POOL_OPTIONS = ('statement_cache_size', 'itersize', 'acquire_timeout', 'overload',
+                'max_waiters', 'minsize', 'max_lifetime', 'max_idle', 'maintenance_interval',
+                'wait_callback', 'cursor_type')
 
 
 CURSOR_FETCH = (
@@ -40,15 +58,13 @@ CURSOR_FETCH = (
     ("single", "fetchone")
 )
 
+VALUES_PLACEHOLDER = re.compile(r'\bVALUES\s+%s', re.IGNORECASE)
 
-def jsonb_loads(stream):
-    return json.loads(stream, object_pairs_hook=OrderedDict)
 
-
-set_callback = getattr(extensions, 'set_wait_callback')
+jsonb_loads = JSON_DECODERS['ordered']
 
 
-psycopg2.extras.register_default_json(globally=True, loads=jsonb_loads)
+set_callback = getattr(extensions, 'set_wait_callback')
 
 
 def gevent_wait_callback(conn, timeout=None):
@@ -75,57 +91,348 @@ def gevent_wait_callback(conn, timeout=None):
                 "Bad result from poll: %r" % state)
 
 
-set_callback(gevent_wait_callback)
+def install_wait_callback(callback=gevent_wait_callback):
+    """Installs the (process wide) `psycopg2` wait callback.
+
+    Nothing is installed at import time: pools install the gevent callback
+    when created, so plain `psycopg2` users keep native blocking I/O.
+    """
+    if blocking_io.depth:
+        blocking_io.callback = callback
+    elif extensions.get_wait_callback() is not callback:
+        set_callback(callback)
+
+
+class BlockingIO(object):
+    """Reentrant context manager suspending the installed wait callback.
+
+    `psycopg2` refuses ``COPY`` while a wait callback is installed. While
+    suspended, queries started by other greenlets run in blocking mode, so
+    no greenlet switch may happen inside a block (see `CopyStart`). The
+    callback is restored when the last block exits.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.callback = None
+
+    def __enter__(self):
+        if not self.depth:
+            self.callback = extensions.get_wait_callback()
+            set_callback(None)
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if not self.depth:
+            set_callback(self.callback)
+            self.callback = None
+
+
+blocking_io = BlockingIO()
+
+
+class CopyStart(object):
+    """File wrapper suspending the wait callback only while a ``COPY``
+    starts.
 
+    `psycopg2` only checks the wait callback when ``copy_expert`` sends the
+    statement, the data transfer itself ignores it. The `blocking_io` block
+    entered on ``with`` is thus left on the first `read` or `write` call,
+    before any python code (and so any greenlet switch) runs: rows pulled
+    from generators and writes to the target may use gevent I/O without
+    blocking the other greenlets queries.
 
-class ClientPool(object):
+    >>> with CopyStart(io.StringIO()) as stream:
+    ...     suspended = extensions.get_wait_callback() is None
+    ...     _ = stream.write('1\\n')
+    ...     restored = not blocking_io.depth
+    >>> suspended, restored
+    (True, True)
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.suspended = False
+
+    def __enter__(self):
+        blocking_io.__enter__()
+        self.suspended = True
+        return self
+
+    def __exit__(self, *exc_info):
+        self.resume()
+
+    def resume(self):
+        if self.suspended:
+            self.suspended = False
+            blocking_io.__exit__(None, None, None)
+
+    def read(self, size=-1):
+        self.resume()
+        return self.stream.read(size)
+
+    def write(self, data):
+        self.resume()
+        return self.stream.write(data)
+
+
+class ClientPool(Instrumented):
     """Base Interface for Gevent-coroutine based DBAPI2 connection pooling.
 
     Implementation uses `gevent` Queueing mechanism so we can ensure that
     a DB tasks will be not be claimed from more that one Greenlet.
 
+    Checkouts, executions, fetches, commits and rollbacks are reported to
+    the registered `pgtools.metrics.PoolHooks` (see `add_hook`), the first
+    one being the built-in `metrics` histograms.
+
 
     Attributes:
         maxsize (int): Greenlet pool size.
+        statement_cache_size (int): Max prepared statements kept per
+            connection for `APIQuery` execution (0 disables preparing).
+        itersize (int): Rows fetched per round trip by `fetchiter`.
+        acquire_timeout (float): Seconds to wait for a connection once the
+            pool is exhausted (`None` waits forever).
+        overload (str): Exhausted pool policy, 'queue' waits in FIFO order,
+            'fail' raises `PoolOverloadError` at once.
+        max_waiters (int): Queued requests before `PoolOverloadError`.
+        minsize (int): Connections opened by `start` and kept open.
+        max_lifetime (float): Seconds before a connection is recycled.
+        max_idle (float): Seconds an idle connection above `minsize` is kept.
+        maintenance_interval (float): Seconds between maintenance runs.
+        wait_callback (callable): `psycopg2` wait callback installed by the
+            pool (`None` leaves the current one), gevent's by default.
+        cursor_type (str|type): Default `query` row factory, see
+            `pgtools.rows.row_factory` ('dict', 'tuple', 'namedtuple',
+            'record' or a cursor class).
     """
 
-    def __init__(self, maxsize=20):
+    def __init__(self, maxsize=20, statement_cache_size=100, itersize=2000,
+                 acquire_timeout=None, overload='queue', max_waiters=None,
+                 minsize=0, max_lifetime=None, max_idle=None, maintenance_interval=30,
+                 wait_callback=gevent_wait_callback, cursor_type='RealDictCursor'):
         if not isinstance(maxsize, integer_types):
             raise TypeError('Expected integer, got %r' % (maxsize, ))
+        if not isinstance(statement_cache_size, integer_types):
+            raise TypeError('Expected integer, got %r' % (statement_cache_size, ))
+        if overload not in OVERLOAD_POLICIES:
+            raise ValueError('Invalid overload policy %r' % (overload, ))
+        if not 0 <= minsize <= maxsize:
+            raise ValueError('Expected 0 <= minsize <= %d, got %r' % (maxsize, minsize))
         self.maxsize = maxsize
         self.pool = Queue()
         self.size = 0
+        self.acquire_timeout = acquire_timeout
+        self.overload = overload
+        self.max_waiters = max_waiters
+        self._waiters = deque()
+        self.minsize = minsize
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.maintenance_interval = maintenance_interval
+        self._created = weakref.WeakKeyDictionary()
+        self._idle_since = weakref.WeakKeyDictionary()
+        self._maintainer = None
+        self.metrics = PoolMetrics()
+        self.hooks = [self.metrics]
+        self.cursor_type = row_factory(cursor_type)
+        if wait_callback is not None:
+            install_wait_callback(wait_callback)
+        self.statement_cache_size = statement_cache_size
+        self._statements = weakref.WeakKeyDictionary()
+        self._stale_statements = weakref.WeakKeyDictionary()
+        self._statement_ids = itertools.count(1)
+        self.itersize = itersize
+        self._cursor_ids = itertools.count(1)
 
     def create_connection(self):
         raise NotImplemented("Must implement `create_connection` method.")
 
-    def get(self):
-        pool = self.pool
-        if self.size >= self.maxsize or pool.qsize():
-            return pool.get()
+    def _create(self):
+        """Creates a connection for an already reserved pool slot.
+        """
+        try:
+            conn = self.create_connection()
+        except:
+            self._release()
+            raise
+        self._created[conn] = time.time()
+        return conn
+
+    def _release(self):
+        """Frees a pool slot, handing it to the longest waiting request.
+        """
+        if self._waiters:
+            self._waiters.popleft().set(None)
         else:
-            self.size += 1
-            try:
-                new_item = self.create_connection()
-            except:
-                self.size -= 1
-                raise
-            return new_item
+            self.size -= 1
+
+    def get(self, acquire_timeout=None):
+        """Acquires a connection.
+
+        Once the pool is exhausted requests wait in FIFO order, released
+        connections (or freed slots) are handed to the oldest waiter.
+
+        Args:
+            acquire_timeout (float): Overrides the pool `acquire_timeout`.
+
+        Raises:
+            PoolTimeoutError, PoolOverloadError.
+        """
+        if not self._waiters:
+            if self.pool.qsize():
+                return self.pool.get_nowait()
+            if self.size < self.maxsize:
+                self.size += 1
+                return self._create()
+
+        if self.overload == 'fail':
+            raise PoolOverloadError('Pool exhausted (%d connections).' % self.size)
+        if self.max_waiters is not None and len(self._waiters) >= self.max_waiters:
+            raise PoolOverloadError('Too many waiters (%d).' % len(self._waiters))
+
+        timeout = self.acquire_timeout if acquire_timeout is None else acquire_timeout
+        waiter = gevent.event.AsyncResult()
+        self._waiters.append(waiter)
+        try:
+            waiter.wait(timeout)
+        except BaseException:
+            # Killed (or an outer timeout): hand back anything received.
+            self._abandon(waiter)
+            raise
+        if not waiter.ready():
+            self._waiters.remove(waiter)
+            raise PoolTimeoutError('No connection available after %ss.' % (timeout, ))
+
+        conn = waiter.value
+        if conn is None:
+            return self._create()
+        return conn
+
+    def _abandon(self, waiter):
+        """Removes a queued `waiter`, or releases the connection (or slot)
+        already handed to it.
+        """
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+        elif waiter.ready():
+            if waiter.value is None:
+                self._release()
+            else:
+                self.put(waiter.value)
 
     def put(self, item):
-        self.pool.put(item)
+        if self._waiters:
+            self._waiters.popleft().set(item)
+        else:
+            self._idle_since[item] = time.time()
+            self.pool.put(item)
+
+    def discard(self, conn):
+        """Closes `conn` and releases its pool slot.
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._release()
 
     def closeall(self):
         while not self.pool.empty():
-            conn = self.pool.get_nowait()
+            self.discard(self.pool.get_nowait())
+
+    def _expired(self, conn, now=None):
+        return (self.max_lifetime is not None and
+                (now or time.time()) - self._created.get(conn, 0) > self.max_lifetime)
+
+    def _warm(self):
+        try:
+            conn = self._create()
+        except Exception:
+            logger.exception('Could not open a pool connection.')
+        else:
+            self.put(conn)
+
+    def warmup(self, wait=True):
+        """Opens connections in parallel greenlets, up to `minsize`.
+
+        Args:
+            wait (boolean): Block until the connections are open.
+        """
+        group = gevent.pool.Group()
+        while self.size < self.minsize:
+            self.size += 1
+            group.spawn(self._warm)
+        if wait:
+            group.join()
+
+    def _check(self, conn, now):
+        """Returns `conn` if it is still worth keeping, else discards it.
+        """
+        if conn.closed or self._expired(conn, now):
+            self.discard(conn)
+            return
+        if (self.max_idle is not None and self.size > self.minsize and
+                now - self._idle_since.get(conn, now) > self.max_idle):
+            self.discard(conn)
+            return
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+            conn.rollback()
+        except Exception:
+            logger.warning('Discarding broken pool connection %r.', conn)
+            self.discard(conn)
+            return
+        return conn
+
+    def maintain(self):
+        """Pings idle connections, recycles expired or idle ones and opens
+        replacements up to `minsize`, off the request path.
+        """
+        now = time.time()
+        for _ in range(self.pool.qsize()):
             try:
-                conn.close()
+                conn = self.pool.get_nowait()
+            except gevent.queue.Empty:
+                break
+            idle_since = self._idle_since.get(conn, now)
+            if self._check(conn, now) is not None:
+                self.put(conn)
+                self._idle_since[conn] = idle_since
+        self.warmup(wait=False)
+
+    def _maintenance_loop(self):
+        while True:
+            gevent.sleep(self.maintenance_interval)
+            try:
+                self.maintain()
             except Exception:
-                pass
+                logger.exception('Pool maintenance failed.')
+
+    def start(self, wait=True):
+        """Warms up `minsize` connections and starts the maintenance greenlet.
+        """
+        self.warmup(wait)
+        if self._maintainer is None and self.maintenance_interval:
+            self._maintainer = gevent.spawn(self._maintenance_loop)
+
+    def close(self):
+        """Stops the maintenance greenlet and closes idle connections.
+        """
+        if self._maintainer is not None:
+            self._maintainer.kill()
+            self._maintainer = None
+        self.closeall()
 
     @contextlib.contextmanager
-    def connection(self, isolation_level=None):
-        conn = self.get()
+    def connection(self, isolation_level=None, acquire_timeout=None):
+        started = time.time()
+        conn = self.get(acquire_timeout)
+        self.emit('on_checkout', time.time() - started)
         try:
             if isolation_level is not None:
                 if conn.isolation_level == isolation_level:
@@ -135,8 +442,13 @@ class ClientPool(object):
             yield conn
         except:
             if conn.closed:
+                interrupted = issubclass(sys.exc_info()[0], (gevent.Timeout, gevent.GreenletExit))
+                self.discard(conn)
                 conn = None
-                self.closeall()
+                # A server failure likely broke the idle connections too, an
+                # interrupted (e.g. timed out) greenlet only its own.
+                if not interrupted:
+                    self.closeall()
             else:
                 conn = self._rollback(conn)
             raise
@@ -145,57 +457,537 @@ class ClientPool(object):
                 raise OperationalError(
                     "Cannot commit because connection was closed: %r" % conn
                 )
+            started = time.time()
             conn.commit()
+            self.emit('on_commit', time.time() - started)
         finally:
-            if conn is not None and not conn.closed:
-                if isolation_level is not None:
-                    conn.set_isolation_level(isolation_level)
-                self.put(conn)
+            if conn is not None:
+                if conn.closed or self._expired(conn):
+                    self.discard(conn)
+                else:
+                    if isolation_level is not None:
+                        conn.set_isolation_level(isolation_level)
+                    self.put(conn)
 
     @contextlib.contextmanager
     def cursor(self, *args, **kwargs):
+        """Yields a cursor inside a `connection` transaction.
+
+        Args:
+            isolation_level (int): Transaction isolation level.
+            acquire_timeout (float): See `get`.
+            cursor_factory (str|type): Cursor class or row factory name,
+                see `pgtools.rows.row_factory`.
+            raw_json (str|boolean): Return `json`/`jsonb` values undecoded,
+                as 'str' (or `True`) or 'bytes', see
+                `pgtools.jsoncodec.register_raw_json`.
+        """
         isolation_level = kwargs.pop('isolation_level', None)
-        with self.connection(isolation_level) as conn:
-            yield conn.cursor(*args, **kwargs)
+        acquire_timeout = kwargs.pop('acquire_timeout', None)
+        raw_json = kwargs.pop('raw_json', False)
+        if kwargs.get('cursor_factory') is not None:
+            kwargs['cursor_factory'] = row_factory(kwargs['cursor_factory'])
+        with self.connection(isolation_level, acquire_timeout) as conn:
+            cursor = conn.cursor(*args, **kwargs)
+            if raw_json:
+                register_raw_json(cursor, raw_json)
+            yield cursor
 
     def _rollback(self, conn):
+        started = time.time()
         try:
             conn.rollback()
         except:
             gevent.get_hub().handle_error(conn, *sys.exc_info())
+            self.discard(conn)
             return
+        self.emit('on_rollback', time.time() - started)
         return conn
 
+    def _prepare(self, cursor, sql):
+        """Returns an ``EXECUTE`` statement for `sql`, preparing it on the
+        cursor connection first if it is not in the connection LRU cache.
+
+        Args:
+            cursor (instance): A `psycopg2.cursor` instance.
+            sql (str): Statement with ``%s`` placeholders.
+        """
+        statements = self._statements.get(cursor.connection)
+        if statements is None:
+            statements = self._statements[cursor.connection] = OrderedDict()
+        for name in self._stale_statements.pop(cursor.connection, ()):
+            cursor.execute('DEALLOCATE {};'.format(name))
+
+        name = statements.pop(sql, None)
+        if name is None:
+            if len(statements) >= self.statement_cache_size:
+                cursor.execute('DEALLOCATE {};'.format(
+                    statements.popitem(last=False)[1]
+                ))
+            name = 'pgtools_{:d}'.format(next(self._statement_ids))
+            cursor.execute(prepared_statement(name, sql)[0])
+        statements[sql] = name
+        return prepared_statement(name, sql)[1]
+
+    def _evict(self, conn, sql):
+        """Drops the cached statement of `sql` after a failed execution
+        (e.g. "cached plan must not change result type" once a function
+        result type changed), so the next call prepares it again. The old
+        statement is deallocated on the next `_prepare`, out of the failed
+        transaction.
+        """
+        name = self._statements.get(conn, {}).pop(sql, None)
+        if name is not None:
+            self._stale_statements.setdefault(conn, []).append(name)
+
+    def _execute(self, cursor, query, params=None):
+        """Executes `query` on `cursor`. `APIQuery` instances run as
+        prepared statements, cached per connection.
+        """
+        started = time.time()
+        prepared = False
+        if isinstance(query, APIQuery):
+            query, params = query
+            statement = query
+            # Named cursors only DECLARE plain queries, not `EXECUTE`.
+            if self.statement_cache_size and not cursor.name:
+                statement = self._prepare(cursor, query)
+                prepared = True
+        else:
+            statement = query
+        try:
+            cursor.execute(statement, params)
+        except Exception:
+            if prepared:
+                self._evict(cursor.connection, query)
+            raise
+        self.emit('on_execute', query, params, time.time() - started, cursor.rowcount)
+
     def execute(self, *args, **kwargs):
         with self.cursor(**kwargs) as cursor:
-            cursor.execute(*args)
+            self._execute(cursor, *args)
             return cursor.rowcount
 
     def fetchone(self, *args, **kwargs):
         with self.cursor(**kwargs) as cursor:
-            cursor.execute(*args)
-            return cursor.fetchone()
+            self._execute(cursor, *args)
+            started = time.time()
+            row = cursor.fetchone()
+            self.emit('on_fetch', int(row is not None), time.time() - started)
+            return row
 
     def fetchall(self, *args, **kwargs):
         with self.cursor(**kwargs) as cursor:
-            cursor.execute(*args)
-            return cursor.fetchall()
+            self._execute(cursor, *args)
+            started = time.time()
+            rows = cursor.fetchall()
+            self.emit('on_fetch', len(rows), time.time() - started)
+            return rows
 
     def fetchiter(self, *args, **kwargs):
+        """Streams query rows through a named (server side) cursor.
+
+        Rows are fetched `itersize` at a time inside the connection
+        transaction, so the result set is never held in memory. Closing the
+        generator early (or dropping it) rolls back and releases the
+        connection.
+
+        Args:
+            itersize (int): Rows per round trip (defaults to `self.itersize`).
+            server_side (boolean): Set `False` to use a client side cursor.
+        """
+        itersize = kwargs.pop('itersize', None) or self.itersize
+        if kwargs.pop('server_side', True):
+            kwargs.setdefault('name', 'pgtools_cursor_{:d}'.format(next(self._cursor_ids)))
+
+        with self.cursor(**kwargs) as cursor:
+            try:
+                self._execute(cursor, *args)
+                count = 0
+                elapsed = 0
+                while True:
+                    started = time.time()
+                    items = cursor.fetchmany(itersize)
+                    elapsed += time.time() - started
+                    if not items:
+                        break
+                    count += len(items)
+                    for item in items:
+                        yield item
+                self.emit('on_fetch', count, elapsed)
+            finally:
+                if not cursor.connection.closed:
+                    cursor.close()
+
+    def fetch_columns(self, *args, **kwargs):
+        """Fetches query results column wise.
+
+        Rows are fetched `itersize` at a time (through a named cursor by
+        default) and each batch is transposed straight into the column
+        containers, so no row objects outlive their batch. Fixed width
+        numeric and boolean columns are `array.array` instances (or NumPy
+        arrays sharing their buffer), the rest, and numeric columns holding
+        NULLs, are lists.
+
+        Args:
+            itersize (int): Rows per batch (defaults to `self.itersize`).
+            server_side (boolean): Set `False` to use a client side cursor.
+            numpy (boolean): Return NumPy arrays for the numeric columns.
+
+        Returns:
+            OrderedDict, column name to column values.
+        """
+        itersize = kwargs.pop('itersize', None) or self.itersize
+        as_numpy = kwargs.pop('numpy', False)
+        if as_numpy:
+            import numpy  # noqa: F401, fail before fetching anything.
+        kwargs['cursor_factory'] = extensions.cursor
+        if kwargs.pop('server_side', True):
+            kwargs.setdefault('name', 'pgtools_cursor_{:d}'.format(next(self._cursor_ids)))
+
+        with self.cursor(**kwargs) as cursor:
+            try:
+                self._execute(cursor, *args)
+                started = time.time()
+                rows = cursor.fetchmany(itersize)
+                columns = ColumnBuffers(cursor.description or ())
+                count = 0
+                while rows:
+                    count += len(rows)
+                    columns.extend(rows)
+                    rows = cursor.fetchmany(itersize)
+                self.emit('on_fetch', count, time.time() - started)
+            finally:
+                if not cursor.connection.closed:
+                    cursor.close()
+        return columns.result(as_numpy)
+
+    def copy_in(self, table, rows, columns=None, batch_size=10000, buffer_size=65536, **kwargs):
+        """Streams `rows` into `table` with ``COPY ... FROM STDIN``.
+
+        Rows are encoded incrementally into `buffer_size` reads and sent in
+        batches of `batch_size`, yielding to other greenlets between batches
+        (the data transfer itself blocks on the socket). The wait callback is
+        only suspended while each ``COPY`` statement starts (see `CopyStart`),
+        so `rows` may be a generator doing gevent I/O. All batches share a
+        single transaction.
+
+        Args:
+            table (str): Target table, optionally schema qualified.
+            rows (iterable): Tuples in column order, or dicts.
+            columns (sequence): Target columns. Defaults to the first row
+                keys for dict rows, else all table columns.
+            batch_size (int): Rows per ``COPY`` statement.
+            buffer_size (int): Characters per read from the encoder.
+
+        Returns:
+            int, the number of rows copied.
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return 0
+        if columns is None and isinstance(first, dict):
+            columns = list(first)
+        rows = itertools.chain((first, ), rows)
+
+        sql = 'COPY {}{} FROM STDIN;'.format(
+            quote_ident(table),
+            ' ({})'.format(', '.join(quote_ident(column) for column in columns)) if columns else ''
+        )
+
+        count = 0
+        with self.cursor(**kwargs) as cursor:
+            while True:
+                stream = CopyInStream(itertools.islice(rows, batch_size), columns)
+                started = time.time()
+                with CopyStart(stream) as started_stream:
+                    cursor.copy_expert(sql, started_stream, buffer_size)
+                self.emit('on_execute', sql, None, time.time() - started, stream.count)
+                count += stream.count
+                if stream.count < batch_size:
+                    break
+                gevent.sleep(0)
+        return count
+
+    def execute_batch(self, sql, param_iter, page_size=100, template=None, fetch=False,
+                      **kwargs):
+        """Executes `sql` for every parameter set, one round trip per page.
+
+        Statements with a single ``VALUES %s`` placeholder are sent as one
+        multi-row ``VALUES`` statement per page, any other statement is
+        repeated and joined with ``;`` per page. All pages run in a single
+        transaction.
+
+        Args:
+            sql (str): The statement.
+            param_iter (iterable): Parameter sequences (or dicts).
+            page_size (int): Parameter sets per round trip.
+            template (str): Row template for ``VALUES`` statements,
+                e.g. ``'(%(id)s, %(name)s)'``. Defaults to one ``%s`` per
+                parameter.
+            fetch (boolean): Return the ``RETURNING`` rows (``VALUES``
+                statements only).
+
+        Returns:
+            list of rows with `fetch`, else the affected rows count (`None`
+            for joined statements, where psycopg2 only reports the last one).
+        """
+        match = VALUES_PLACEHOLDER.search(sql)
+        if fetch and not match:
+            raise ValueError('RETURNING rows need a `VALUES %s` statement.')
+
+        param_iter = iter(param_iter)
+        rows = []
+        count = 0
         with self.cursor(**kwargs) as cursor:
-            cursor.execute(*args)
             while True:
-                items = cursor.fetchmany()
-                if not items:
+                page = list(itertools.islice(param_iter, page_size))
+                if not page:
+                    break
+                if match:
+                    row_template = template or '({})'.format(', '.join(['%s'] * len(page[0])))
+                    started = time.time()
+                    cursor.execute(''.join((
+                        sql[:match.end() - 2].replace('%%', '%'),
+                        b','.join(cursor.mogrify(row_template, args) for args in page).decode(
+                            extensions.encodings[cursor.connection.encoding]
+                        ),
+                        sql[match.end():].replace('%%', '%')
+                    )))
+                    self.emit('on_execute', sql, page, time.time() - started, cursor.rowcount)
+                    count += cursor.rowcount
+                    if fetch:
+                        rows.extend(cursor.fetchall())
+                else:
+                    started = time.time()
+                    cursor.execute(b';'.join(cursor.mogrify(sql, args) for args in page))
+                    self.emit('on_execute', sql, page, time.time() - started, cursor.rowcount)
+
+        if fetch:
+            return rows
+        return count if match else None
+
+    def _copy_producer(self, cursor, sql, buffer):
+        started = time.time()
+        try:
+            with CopyStart(buffer) as stream:
+                cursor.copy_expert(sql, stream)
+            buffer.rowcount = cursor.rowcount
+            self.emit('on_execute', sql, None, time.time() - started, cursor.rowcount)
+        except Exception:
+            # Cancelled COPY of abandoned generators is expected.
+            if not buffer.discarding:
+                buffer.exc_info = sys.exc_info()
+        finally:
+            buffer.close()
+
+    @staticmethod
+    def _copy_statement(cursor, query, buffer, describe=False):
+        """Returns the ``COPY (query) TO STDOUT`` statement, setting
+        `buffer.encoding` (and with `describe` the query columns, looked up
+        with ``LIMIT 0``, into `buffer.description`).
+        """
+        buffer.encoding = extensions.encodings[cursor.connection.encoding]
+        if isinstance(query, APIQuery):
+            query = cursor.mogrify(*query).decode(buffer.encoding)
+        query = query.rstrip().rstrip(';')
+        if describe:
+            cursor.execute('SELECT * FROM ({}) AS pgtools_copy LIMIT 0;'.format(query))
+            buffer.description = cursor.description
+        return 'COPY ({}) TO STDOUT WITH (FORMAT {});'.format(query, buffer.format)
+
+    def _copy_chunks(self, query, buffer, describe=False, **kwargs):
+        """Yields raw ``COPY ... TO STDOUT`` chunks from a producer greenlet
+        writing into the bounded `buffer`.
+        """
+        with self.cursor(**kwargs) as cursor:
+            sql = self._copy_statement(cursor, query, buffer, describe)
+            producer = gevent.spawn(self._copy_producer, cursor, sql, buffer)
+            try:
+                for chunk in buffer:
+                    yield chunk
+                producer.join()
+                if buffer.exc_info is not None:
+                    six.reraise(*buffer.exc_info)
+            finally:
+                if not producer.ready():
+                    # Abandoned by the consumer: cancel the running COPY so
+                    # the connection can be rolled back and reused.
+                    buffer.discard()
+                    cursor.connection.cancel()
+                    producer.join()
+
+    def _binary_batches(self, chunks, buffer):
+        """Decodes binary ``COPY`` chunks, yielding lists of typed tuples.
+        """
+        decoder = None
+        for chunk in chunks:
+            if decoder is None:
+                decoder = BinaryCopyDecoder(
+                    [column.type_code for column in buffer.description], buffer.encoding
+                )
+            rows = decoder.feed(chunk)
+            if rows:
+                yield rows
+        if decoder is None or not decoder.finished:
+            raise OperationalError('Truncated binary COPY stream.')
+
+    def _binary_columns(self, chunks, buffer):
+        batches = self._binary_batches(chunks, buffer)
+        pending = []
+        columns = None
+        for rows in batches:
+            if columns is None:
+                columns = ColumnBuffers(buffer.description)
+            pending.extend(rows)
+            if len(pending) >= self.itersize:
+                columns.extend(pending)
+                pending = []
+        if columns is None:
+            columns = ColumnBuffers(buffer.description or ())
+        columns.extend(pending)
+        return columns.result()
+
+    def copy_out(self, query, sink=None, format='csv', parse=False, maxchunks=64, **kwargs):
+        """Streams a query result with ``COPY (query) TO STDOUT``.
+
+        Without `sink`, ``COPY`` runs in a producer greenlet feeding a buffer
+        of at most `maxchunks` rows, so the result is never materialized in
+        python. With a `sink`, ``COPY`` writes to it directly. Either way
+        the wait callback is only suspended while the statement starts (see
+        `CopyStart`).
+
+        Args:
+            query (str|APIQuery): The query to export.
+            sink (file): File-like object to write to. Text files receive
+                decoded `str` chunks, other objects `bytes`.
+            format (str): One of 'csv', 'text' or 'binary'.
+            parse (boolean|str): Without `sink`, yield rows instead of raw
+                chunks: lists of strings or `None` for 'text'/'csv', typed
+                tuples for 'binary' (see `pgtools.copyio.BinaryCopyDecoder`).
+                'columns' ('binary' only) returns an `OrderedDict` of column
+                buffers, as `fetch_columns` does.
+            maxchunks (int): Buffered chunks before the producer waits.
+
+        Returns:
+            The number of rows written to `sink`, else a generator of raw
+            chunks or parsed rows, or the parsed columns.
+        """
+        if format not in COPY_FORMATS:
+            raise ValueError('Invalid COPY format %r' % (format, ))
+        if parse and sink is not None:
+            raise ValueError('Row parsing is only available for generators.')
+        if parse == 'columns' and format != 'binary':
+            raise ValueError('Column parsing is only available for the binary format.')
+
+        if sink is None:
+            text = format != 'binary'
+        else:
+            text = isinstance(sink, io.TextIOBase)
+
+        if sink is not None:
+            return self._copy_to_sink(query, CopyOutSink(sink, format, text), **kwargs)
+
+        binary = bool(parse) and format == 'binary'
+        buffer = CopyOutBuffer(Queue(maxchunks), format, text, 65536 if binary else 0)
+        chunks = self._copy_chunks(query, buffer, describe=binary, **kwargs)
+        if parse == 'columns':
+            return self._binary_columns(chunks, buffer)
+        if binary:
+            return (row for rows in self._binary_batches(chunks, buffer) for row in rows)
+        return parse_copy_rows(chunks, format) if parse else chunks
+
+    def _copy_to_sink(self, query, sink, **kwargs):
+        with self.cursor(**kwargs) as cursor:
+            sql = self._copy_statement(cursor, query, sink)
+            started = time.time()
+            with CopyStart(sink) as stream:
+                cursor.copy_expert(sql, stream)
+            self.emit('on_execute', sql, None, time.time() - started, cursor.rowcount)
+            return cursor.rowcount
+
+    def gather(self, queries, concurrency=None, timeout=None, return_exceptions=False,
+               fetch_opts='many', cursor_type=None):
+        """Runs independent queries concurrently on separate connections.
+
+        Each query runs through `query` in its own greenlet, at most
+        `concurrency` (capped to `maxsize`) at a time.
+
+        Args:
+            queries (iterable): Query strings or `APIQuery` instances.
+            concurrency (int): Max concurrent queries, defaults to `maxsize`.
+            timeout (float): Per query timeout in seconds, including the
+                connection checkout. Timed out queries fail with their
+                `gevent.Timeout`, their connections are discarded.
+            return_exceptions (boolean): Return failures in place of their
+                results instead of raising the first one (the still running
+                queries are then killed, returning their connections).
+
+        Returns:
+            list, the results in `queries` order.
+        """
+        queries = list(queries)
+        results = [None] * len(queries)
+        outcome = gevent.event.AsyncResult()
+        pending = [len(queries)]
+        if not queries:
+            return results
+
+        def run(index, query):
+            try:
+                with gevent.Timeout(timeout):
+                    results[index] = self.query(query, fetch_opts, cursor_type)
+            except (Exception, gevent.Timeout) as error:
+                results[index] = error
+                if not return_exceptions and not outcome.ready():
+                    outcome.set_exception(error)
+            pending[0] -= 1
+            if not pending[0] and not outcome.ready():
+                outcome.set(results)
+
+        group = gevent.pool.Pool(min(concurrency or self.maxsize, self.maxsize))
+        try:
+            for index, query in enumerate(queries):
+                if outcome.ready():
                     break
-                for item in items:
-                    yield item
+                group.spawn(run, index, query)
+            return outcome.get()
+        finally:
+            group.kill()
+
+    def stats(self):
+        """Returns a snapshot of the pool state and `metrics` histograms.
+        """
+        idle = self.pool.qsize()
+        snapshot = {
+            'size': self.size,
+            'maxsize': self.maxsize,
+            'in_use': self.size - idle,
+            'idle': idle,
+            'waiters': len(self._waiters),
+        }
+        snapshot.update(self.metrics.snapshot())
+        return snapshot
+
+    def query(self, query, fetch_opts='many', cursor_type=None, raw_json=False):
+        """Runs `query` (a SQL string or `APIQuery`) and fetches its rows.
 
-    def query(self, query, fetch_opts='many', cursor_type='RealDictCursor'):
+        Args:
+            fetch_opts (str): 'many' (all rows) or 'single' (first row).
+            cursor_type (str|type): Row factory, defaults to the pool
+                `cursor_type`, see `pgtools.rows.row_factory`.
+            raw_json (str|boolean): Return `json`/`jsonb` values (e.g.
+                ``json_agg`` results) undecoded, as 'str' (or `True`) or 'bytes'.
+
+        Raises:
+            DBPoolError: The query failed.
+        """
         try:
             return getattr(self, dict(CURSOR_FETCH).get(fetch_opts))(
                 *(query, ),
-                cursor_factory=getattr(psycopg2.extras, cursor_type)
+                cursor_factory=row_factory(cursor_type or self.cursor_type),
+                raw_json=raw_json
             )
         except Exception as e:
             raise DBPoolError(e.args)
@@ -203,14 +995,32 @@ class ClientPool(object):
 
 class PostgresPool(ClientPool):
     """Postgresql Server connection Pooling class.
+
+    Attributes:
+        json_loads (str|callable): Decoder registered for `json`/`jsonb`
+            columns on each pool connection, see
+            `pgtools.jsoncodec.json_decoder` (`None` keeps the `psycopg2`
+            defaults).
+        json_lazy (boolean): Return `pgtools.jsoncodec.LazyJSON` values,
+            only decoded when first accessed.
     """
 
     def __init__(self, *args, **kwargs):
         self.connect = kwargs.pop('connect', connect)
+        self.json_loads = kwargs.pop('json_loads', 'ordered')
+        self.json_lazy = kwargs.pop('json_lazy', False)
+        if self.json_loads is not None:
+            self.json_loads = json_decoder(self.json_loads)
         maxsize = kwargs.pop('maxsize', 30)
+        options = dict((key, kwargs.pop(key)) for key in POOL_OPTIONS if key in kwargs)
         self.args = args
         self.kwargs = kwargs
-        ClientPool.__init__(self, maxsize)
+        ClientPool.__init__(self, maxsize, **options)
+        if self.minsize or self.max_lifetime is not None or self.max_idle is not None:
+            self.start(wait=False)
 
     def create_connection(self):
-        return self.connect(*self.args, **self.kwargs)
+        conn = self.connect(*self.args, **self.kwargs)
+        if self.json_loads is not None:
+            register_json_decoder(conn, self.json_loads, self.json_lazy)
+        return conn
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.profiler` module.
+
+Provides an opt-in slow query profiler aggregating executions per
+normalized statement fingerprint.
+
+Example usage::
+
+    >>> profiler = QueryProfiler(slowest=20)
+    >>> pool.add_hook(profiler)  # doctest: +SKIP
+    >>> profiler.report(limit=5)  # doctest: +SKIP
+"""
+
+from __future__ import absolute_import
+
+__all__ = ('QueryProfiler', 'fingerprint')
+
+import heapq
+import itertools
+import re
+import time
+import six
+from pgtools.metrics import Histogram, PoolHooks
+
+
+FINGERPRINT_RULES = (
+    # Literals and bind placeholders.
+    (re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*|)\$.*?\$\1\$", re.DOTALL), '?'),
+    (re.compile(r"\b[Ee]'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r"(?:\b[BbXxUu]&?)?'(?:[^']|'')*'"), '?'),
+    (re.compile(r"%\([^)]*\)s|%s|\$\d+"), '?'),
+    (re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"), '?'),
+    (re.compile(r"\b(?:true|false|null)\b", re.IGNORECASE), '?'),
+    # Value lists, e.g. `IN (?, ?, ?)` and multi-row `VALUES`.
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), '(?)'),
+    (re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+"), '(?)'),
+    (re.compile(r"\s+"), ' '),
+)
+
+
+def fingerprint(sql):
+    """Normalizes a statement, stripping literals and parameter lists.
+
+    >>> print(fingerprint("SELECT * FROM api.get_user(12, 'pav''s')  WHERE id IN (1, 2, 3);"))
+    select * from api.get_user(?) where id in (?);
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    for pattern, replacement in FINGERPRINT_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip().lower()
+
+
+class FingerprintStats(object):
+    """Aggregated executions of a single fingerprint.
+    """
+    __slots__ = ('fingerprint', 'count', 'total', 'rows', 'histogram')
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.total = 0
+        self.rows = 0
+        self.histogram = Histogram()
+
+    def record(self, duration, rowcount):
+        self.count += 1
+        self.total += duration
+        if rowcount > 0:
+            self.rows += rowcount
+        self.histogram.record(duration)
+
+    def snapshot(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'max': self.histogram.max,
+            'p99': self.histogram.percentile(99),
+            'rows': self.rows,
+        }
+
+
+class QueryProfiler(PoolHooks):
+    """**Slow query profiler hooks**
+
+    Register it on a pool (``pool.add_hook(profiler)``) to aggregate count,
+    total, mean and p99 time per statement fingerprint, and keep the
+    `slowest` executions (with their parameters) at or above `threshold`.
+
+    Attributes:
+        slowest (int): Slowest executions kept.
+        threshold (float): Min seconds for an execution to be kept.
+        max_fingerprints (int): Distinct fingerprints tracked, the rest are
+            aggregated under ``'<other>'``.
+    """
+
+    fingerprint_cache_size = 4096
+
+    def __init__(self, slowest=50, threshold=0, max_fingerprints=1000):
+        self.slowest = slowest
+        self.threshold = threshold
+        self.max_fingerprints = max_fingerprints
+        self.reset()
+
+    def reset(self):
+        self.statements = {}
+        self._slowest = []
+        self._fingerprints = {}
+        self._sequence = itertools.count()
+
+    def fingerprint(self, sql):
+        """Cached `fingerprint`, repeated statements are only parsed once.
+        """
+        try:
+            return self._fingerprints[sql]
+        except KeyError:
+            if len(self._fingerprints) >= self.fingerprint_cache_size:
+                self._fingerprints.clear()
+            result = self._fingerprints[sql] = fingerprint(sql)
+            return result
+
+    def on_execute(self, source, query, params, duration, rowcount):
+        key = self.fingerprint(query if isinstance(query, (six.string_types, bytes))
+                               else str(query))
+        stats = self.statements.get(key)
+        if stats is None:
+            if len(self.statements) >= self.max_fingerprints:
+                key = '<other>'
+                stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = FingerprintStats(key)
+        stats.record(duration, rowcount)
+
+        if duration < self.threshold or not self.slowest:
+            return
+        entry = (duration, next(self._sequence), {
+            'fingerprint': key,
+            'query': query,
+            'params': params,
+            'duration': duration,
+            'rowcount': rowcount,
+            'time': time.time(),
+        })
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, entry)
+        elif duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def slowest_executions(self):
+        """Returns the kept executions, slowest first.
+        """
+        return [entry[2] for entry in sorted(self._slowest, reverse=True)]
+
+    def report(self, limit=None, order='total'):
+        """Returns fingerprint statistics sorted by `order` (descending).
+
+        Args:
+            limit (int): Max fingerprints returned.
+            order (str): One of 'total', 'count', 'mean', 'max' or 'p99'.
+        """
+        rows = sorted((stats.snapshot() for stats in self.statements.values()),
+                      key=lambda row: row[order], reverse=True)
+        return rows[:limit] if limit else rows
@@ -2,37 +2,60 @@
 """`pgtools.pubsub` module.
 
 Provides a nice API over Postgresql LISTEN / NOTIFY.
+
+`PubSub` wraps a connection per user, while `Listener` shares a single
+LISTEN connection per process (see `shared_listener`) between any number
+of channel subscriptions, each with its own bounded queue::
+
+    >>> listener = shared_listener(dsn)  # doctest: +SKIP
+    >>> subscription = listener.subscribe(['orders'], handler=print)  # doctest: +SKIP
 """
 
 from __future__ import absolute_import
 
+__all__ = ('PubSub', 'Listener', 'Subscription', 'CacheInvalidator', 'connect',
+           'shared_listener', 'parse_payload')
 
-import select
+import os
+import re
 import logging
+import time
 
+import gevent
+import gevent.event
+import gevent.queue
+from gevent import select
 import psycopg2
+from pgtools.cache import default_cache
+from pgtools.metrics import Instrumented, PoolMetrics
+from pgtools.pool import install_wait_callback
 
 logger = logging.getLogger(__name__)
 
 NOT_READY = ([], [], [])
 
 
-class PubSub(object):
+class PubSub(Instrumented):
     def __init__(self, conn):
         assert conn.autocommit, "Connection must be in autocommit mode."
         self.conn = conn
+        self.metrics = PoolMetrics()
+        self.hooks = [self.metrics]
 
-    def listen(self, channel):
+    def _execute(self, query, params=None):
+        started = time.time()
         with self.conn.cursor() as cur:
-            cur.execute('LISTEN %s;' % channel)
+            cur.execute(query, params)
+        self.emit('on_execute', query, params, time.time() - started, -1)
+
+    def listen(self, channel):
+        self._execute('LISTEN %s;' % channel)
 
     def unlisten(self, channel):
-        with self.conn.cursor() as cur:
-            cur.execute('UNLISTEN %s;' % channel)
+        self._execute('UNLISTEN %s;' % channel)
 
     def notify(self, channel, payload):
-        with self.conn.cursor() as cur:
-            cur.execute('SELECT pg_notify(%s, %s);', (channel, payload))
+        self._execute('SELECT pg_notify(%s, %s);', (channel, payload))
 
     def get_event(self, select_timeout=0):
         # poll the connection, then return one event, if we have one.  Else
@@ -40,6 +63,7 @@ class PubSub(object):
         select.select([self.conn], [], [], select_timeout)
         self.conn.poll()
         if self.conn.notifies:
+            self.emit('on_fetch', 1, 0)
             return self.conn.notifies.pop(0)
 
     def get_events(self, select_timeout=0):
@@ -51,6 +75,7 @@ class PubSub(object):
         while self.conn.notifies:
             events.append(self.conn.notifies.pop(0))
         if events:
+            self.emit('on_fetch', len(events), 0)
             return events
 
     def events(self, select_timeout=5, yield_timeouts=False):
@@ -60,13 +85,351 @@ class PubSub(object):
                     yield None
             else:
                 self.conn.poll()
+                if self.conn.notifies:
+                    self.emit('on_fetch', len(self.conn.notifies), 0)
                 while self.conn.notifies:
                     yield self.conn.notifies.pop(0)
 
+    def stats(self):
+        """Returns a snapshot of the `metrics` histograms.
+        """
+        return self.metrics.snapshot()
+
     def close(self):
         self.conn.close()
 
 
+PAYLOAD_SEPARATOR = re.compile(r'[\s,]+')
+
+
+def parse_payload(payload):
+    """Splits an invalidation payload into names (or patterns).
+
+    >>> parse_payload(' public.users, api.get_user *.count_*')
+    ['public.users', 'api.get_user', '*.count_*']
+    """
+    return [name for name in PAYLOAD_SEPARATOR.split(payload) if name]
+
+
+def quote_channel(channel):
+    """Quotes a channel name, channels being case sensitive.
+
+    >>> print(quote_channel('Orders"v2'))
+    "Orders""v2"
+    """
+    return '"{}"'.format(channel.replace('"', '""'))
+
+
+class Subscription(object):
+    """**A `Listener` channels subscription**
+
+    Notifications are put in a bounded queue, consumed by iterating (or
+    ``get``), or by a `handler` greenlet. When the queue is full new
+    notifications are dropped (and counted), so a slow subscriber never
+    blocks the listener nor the other subscribers.
+
+    Attributes:
+        channels (tuple): Subscribed channels.
+        queue (gevent.queue.Queue): Pending notifications.
+        dropped (int): Notifications dropped on a full queue.
+        on_gap (callable): Called (without arguments) when notifications
+            may have been missed: on listener connection loss, and again
+            once the channels are listened on the new connection.
+    """
+
+    def __init__(self, listener, channels, handler=None, maxsize=1000, on_gap=None):
+        self.listener = listener
+        self.channels = tuple(channels)
+        self.queue = gevent.queue.Queue(maxsize)
+        self.dropped = 0
+        self.on_gap = on_gap
+        self.greenlet = None if handler is None else gevent.spawn(self._consume, handler)
+
+    def put(self, notify):
+        try:
+            self.queue.put_nowait(notify)
+        except gevent.queue.Full:
+            self.dropped += 1
+            if self.dropped == 1:
+                logger.warning('Subscription %r queue is full, dropping notifications.',
+                               self.channels)
+
+    def get(self, block=True, timeout=None):
+        """Returns the next notification, `None` once closed.
+
+        Raises:
+            gevent.queue.Empty: No notification within `timeout`.
+        """
+        return self.queue.get(block, timeout)
+
+    def __iter__(self):
+        for notify in self.queue:
+            if notify is None:
+                return
+            yield notify
+
+    def _consume(self, handler):
+        for notify in self:
+            try:
+                handler(notify)
+            except Exception:
+                logger.exception('Subscription %r handler failed.', self.channels)
+
+    def close(self):
+        self.listener.unsubscribe(self)
+        self.queue.queue.clear()
+        self.queue.put(None)
+        if self.greenlet is not None and self.greenlet is not gevent.getcurrent():
+            self.greenlet.join()
+        self.greenlet = None
+
+
+class Listener(Instrumented):
+    """**Multiplexed gevent LISTEN connection**
+
+    A single reader greenlet owns the connection: it waits on the socket
+    (no `select` call blocking the hub), keeps the server LISTEN set in
+    sync with the subscribed channels and fans notifications out to the
+    channel subscriptions. On connection loss it reconnects every
+    `retry_interval` seconds, subscriptions' `on_gap` being called on
+    failure and once listening again.
+
+    Args:
+        *args, **kwargs: `psycopg2.connect` arguments.
+
+    Attributes:
+        retry_interval (float): Seconds between reconnection attempts.
+        subscriptions (dict): Channel to `Subscription` list mapping.
+    """
+
+    retry_interval = 1.0
+
+    _key = None
+
+    def __init__(self, *args, **kwargs):
+        self.connect_args = (args, kwargs)
+        self.conn = None
+        self.subscriptions = {}
+        self.listening = set()
+        self.metrics = PoolMetrics()
+        self.hooks = [self.metrics]
+        self.greenlet = None
+        self._wakeup = gevent.event.Event()
+        self._watcher = None
+
+    def subscribe(self, channels, handler=None, maxsize=1000, on_gap=None):
+        """Subscribes to `channels` (names or a single name).
+
+        Args:
+            handler (callable): Called with each notification in a
+                dedicated greenlet, else consume the subscription.
+            maxsize (int): Queue bound, `None` for unbounded.
+            on_gap (callable): See `Subscription`.
+
+        Returns:
+            Subscription, close it to unsubscribe.
+        """
+        if isinstance(channels, str):
+            channels = (channels, )
+        subscription = Subscription(self, channels, handler, maxsize, on_gap)
+        for channel in subscription.channels:
+            self.subscriptions.setdefault(channel, []).append(subscription)
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.run)
+        self._wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for channel in subscription.channels:
+            subscriptions = self.subscriptions.get(channel, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(channel, None)
+        self._wakeup.set()
+
+    def _execute(self, query):
+        started = time.time()
+        with self.conn.cursor() as cur:
+            cur.execute(query)
+        self.emit('on_execute', query, None, time.time() - started, -1)
+
+    def _connect(self):
+        args, kwargs = self.connect_args
+        install_wait_callback()
+        self.conn = psycopg2.connect(*args, **kwargs)
+        self.conn.autocommit = True
+        self.listening = set()
+        self._watcher = gevent.get_hub().loop.io(self.conn.fileno(), 1)
+        self._watcher.start(self._wakeup.set)
+
+    def _disconnect(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _sync(self):
+        channels = set(self.subscriptions)
+        for channel in channels - self.listening:
+            self._execute('LISTEN {};'.format(quote_channel(channel)))
+            self.listening.add(channel)
+        for channel in self.listening - channels:
+            self._execute('UNLISTEN {};'.format(quote_channel(channel)))
+            self.listening.discard(channel)
+
+    def _dispatch(self):
+        self.conn.poll()
+        notifies = self.conn.notifies
+        if not notifies:
+            return
+        self.emit('on_fetch', len(notifies), 0)
+        while notifies:
+            notify = notifies.pop(0)
+            for subscription in self.subscriptions.get(notify.channel, ()):
+                subscription.put(notify)
+
+    def _gap(self):
+        for subscription in {sub for subs in self.subscriptions.values() for sub in subs}:
+            if subscription.on_gap is not None:
+                try:
+                    subscription.on_gap()
+                except Exception:
+                    logger.exception('Subscription %r gap handler failed.',
+                                     subscription.channels)
+
+    def run(self):
+        reconnected = False
+        while True:
+            try:
+                if self.conn is None:
+                    self._connect()
+                self._sync()
+                if reconnected:
+                    # Results cached while nobody listened may be stale.
+                    reconnected = False
+                    self._gap()
+                while True:
+                    self._dispatch()
+                    self._wakeup.wait()
+                    self._wakeup.clear()
+                    self._sync()
+            except Exception:
+                logger.exception('Listener connection failed, reconnecting.')
+                self._disconnect()
+                reconnected = True
+                self._gap()
+                gevent.sleep(self.retry_interval)
+
+    def stats(self):
+        """Returns a snapshot of the `metrics` histograms.
+        """
+        return self.metrics.snapshot()
+
+    def close(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        self._disconnect()
+        for subscriptions in list(self.subscriptions.values()):
+            for subscription in list(subscriptions):
+                subscription.close()
+        if self._key is not None:
+            _listeners.pop(self._key, None)
+
+
+_listeners = {}
+
+
+def shared_listener(*args, **kwargs):
+    """Returns the process `Listener` of the `psycopg2.connect` arguments,
+    created on first call (and again in forked children).
+    """
+    key = (os.getpid(), args, tuple(sorted(kwargs.items())))
+    listener = _listeners.get(key)
+    if listener is None:
+        listener = _listeners[key] = Listener(*args, **kwargs)
+        listener._key = key
+    return listener
+
+
+class CacheInvalidator(object):
+    """**LISTEN / NOTIFY driven result cache invalidation**
+
+    A background greenlet listens on `channels` and evicts the cached
+    results named by each notification payload: comma or space separated
+    field names or shell style patterns (e.g. ``api.get_user``,
+    ``api.*``), or names listed in `dependencies` (typically tables),
+    mapped to the field patterns depending on them. An empty payload names
+    the channel itself. So, with a trigger like::
+
+        CREATE FUNCTION notify_invalidate() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('pgtools_invalidate', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+
+    and ``dependencies={'public.users': ['api.get_user', 'api.count_users']}``
+    any ``users`` write evicts both fields results.
+
+    Whenever the listener connection is lost the whole cache is cleared, as
+    notifications may have been missed, and cleared again once listening on
+    the new connection (dropping results cached in between).
+
+    Example usage::
+
+        >>> invalidator = CacheInvalidator(shared_listener(dsn), dependencies={  # doctest: +SKIP
+        ...     'public.users': ['api.get_user', 'api.count_users'],
+        ... }).start()
+
+    Attributes:
+        listener (Listener): The (usually shared) listener.
+        channels (tuple): Channels listened.
+        cache (pgtools.cache.ResultCache): Evicted cache, defaults to
+            `pgtools.cache.default_cache`.
+        dependencies (dict): Name to field patterns mapping.
+        parse (callable): Payload to names function.
+        evicted (int): Entries evicted so far.
+    """
+
+    def __init__(self, listener, channels=('pgtools_invalidate', ), cache=None,
+                 dependencies=None, parse=parse_payload):
+        self.listener = listener
+        self.channels = tuple(channels)
+        self.cache = default_cache if cache is None else cache
+        self.dependencies = dependencies or {}
+        self.parse = parse
+        self.evicted = 0
+        self.subscription = None
+
+    def invalidate(self, names):
+        """Evicts the entries of `names`, returns the evicted count.
+        """
+        evicted = 0
+        for name in names:
+            for pattern in self.dependencies.get(name, (name, )):
+                evicted += self.cache.invalidate_pattern(pattern)
+        self.evicted += evicted
+        return evicted
+
+    def handle(self, notify):
+        return self.invalidate(self.parse(notify.payload) or [notify.channel])
+
+    def start(self):
+        # Unbounded, as a dropped notification would leave stale entries.
+        self.subscription = self.listener.subscribe(
+            self.channels, handler=self.handle, maxsize=None, on_gap=self.cache.clear
+        )
+        return self
+
+    def stop(self):
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+
+
 def connect(*args, **kwargs):
     conn = psycopg2.connect(*args, **kwargs)
     conn.autocommit = True
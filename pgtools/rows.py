@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.rows` module.
+
+Provides compact row factories (cursor classes) selectable by name.
+
+Example usage::
+
+    >>> Point = record_class(('x', 'y'))
+    >>> point = Point._make((1, 2))
+    >>> point
+    Record(x=1, y=2)
+    >>> point.y, point[0], point['x'], tuple(point)
+    (2, 1, 1, (1, 2))
+    >>> record_class(('x', 'y')) is Point
+    True
+"""
+
+from __future__ import absolute_import
+
+__all__ = ('ROW_FACTORIES', 'Record', 'RecordCursor', 'NamedTupleCursor', 'ColumnBuffers',
+           'record_class', 'namedtuple_class', 'row_factory')
+
+import re
+import array
+import keyword
+from collections import namedtuple, OrderedDict
+import six
+import psycopg2.extras
+from psycopg2 import extensions
+
+
+IDENTIFIER_RE = re.compile(r'\W|^(?=\d)')
+
+# `array` type codes of fixed width column types, by type oid
+# (bool, int8, int2, int4, oid, float4, float8).
+COLUMN_TYPECODES = {16: 'B', 20: 'q', 21: 'h', 23: 'i', 26: 'I', 700: 'f', 701: 'd'}
+
+COLUMN_DTYPES = {16: '?'}
+
+
+class Record(object):
+    """**Base `__slots__` row class**
+
+    Subclasses are generated by `record_class`, one per distinct column
+    list, with a slot per column and a positional ``__init__``. Records
+    support attribute, index and key access, iteration and ``_asdict``.
+    """
+    __slots__ = ()
+
+    _fields = ()
+
+    @classmethod
+    def _make(cls, row):
+        return cls(*row)
+
+    def __iter__(self):
+        for field in self._fields:
+            yield getattr(self, field)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, key):
+        if isinstance(key, six.string_types):
+            return getattr(self, key)
+        if isinstance(key, slice):
+            return tuple(self)[key]
+        return getattr(self, self._fields[key])
+
+    def __eq__(self, other):
+        if not isinstance(other, (Record, tuple, list)):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    def __repr__(self):
+        return 'Record({})'.format(', '.join(
+            '{}={!r}'.format(field, getattr(self, field)) for field in self._fields
+        ))
+
+
+def _field_names(columns):
+    names = []
+    for index, column in enumerate(columns):
+        name = IDENTIFIER_RE.sub('_', column) or 'f'
+        if keyword.iskeyword(name) or name.startswith('_') or name in names:
+            name = 'f{:d}_{}'.format(index, name)
+        names.append(name)
+    return tuple(names)
+
+
+_record_classes = {}
+
+_namedtuple_classes = {}
+
+
+def namedtuple_class(columns, cache_size=1024):
+    """Returns the (cached) `namedtuple` class for a column names tuple,
+    column names being sanitized as in `record_class`.
+    """
+    columns = tuple(columns)
+    try:
+        return _namedtuple_classes[columns]
+    except KeyError:
+        pass
+    cls = namedtuple('Record', _field_names(columns))
+    if len(_namedtuple_classes) >= cache_size:
+        _namedtuple_classes.clear()
+    _namedtuple_classes[columns] = cls
+    return cls
+
+
+def record_class(columns, cache_size=1024):
+    """Returns the (cached) `Record` subclass for a column names tuple.
+
+    Column names that are not valid (or are duplicate) attribute names are
+    sanitized and prefixed with their position, e.g. ``?column?`` in first
+    position becomes ``f0__column_``.
+    """
+    columns = tuple(columns)
+    try:
+        return _record_classes[columns]
+    except KeyError:
+        pass
+
+    # Field names never start with `_`, unlike the generated names.
+    fields = _field_names(columns)
+    source = 'def __init__(_pg_self{}):\n{}\n    pass\n'.format(
+        ''.join(', ' + field for field in fields),
+        ''.join('    _pg_self.{0} = {0}\n'.format(field) for field in fields)
+    )
+    namespace = {}
+    six.exec_(source, namespace)
+    cls = type('Record', (Record, ), {
+        '__slots__': fields,
+        '_fields': fields,
+        '__init__': namespace['__init__'],
+    })
+    if len(_record_classes) >= cache_size:
+        _record_classes.clear()
+    _record_classes[columns] = cls
+    return cls
+
+
+class NamedTupleCursor(psycopg2.extras.NamedTupleCursor):
+    """A `psycopg2.extras.NamedTupleCursor` that also accepts duplicate
+    column names (e.g. two ``?column?``).
+    """
+
+    def _make_nt(self):
+        return namedtuple_class(column[0] for column in self.description or ())
+
+
+class RecordCursor(psycopg2.extras.NamedTupleCursor):
+    """A cursor returning `Record` rows, the class being cached per column
+    list (so per query shape), not per execution.
+    """
+
+    def _make_nt(self):
+        return record_class(column[0] for column in self.description or ())
+
+
+ROW_FACTORIES = {
+    'tuple': extensions.cursor,
+    'namedtuple': NamedTupleCursor,
+    'record': RecordCursor,
+    'dict': psycopg2.extras.RealDictCursor,
+}
+
+
+def row_factory(cursor_type):
+    """Resolves a row factory to a cursor class.
+
+    Args:
+        cursor_type (str|type): 'tuple', 'namedtuple', 'record', 'dict', a
+            `psycopg2.extras` cursor class name (e.g. 'RealDictCursor') or a
+            cursor class. `None` returns `None` (the connection default).
+
+    Raises:
+        ValueError: Unknown row factory name.
+    """
+    if cursor_type is None or not isinstance(cursor_type, six.string_types):
+        return cursor_type
+    try:
+        return ROW_FACTORIES.get(cursor_type) or getattr(psycopg2.extras, cursor_type)
+    except AttributeError:
+        raise ValueError('Unknown row factory %r' % (cursor_type, ))
+
+
+class ColumnBuffers(object):
+    """Accumulates row batches column wise.
+
+    Fixed width numeric and boolean columns fill `array.array` buffers, the
+    rest (and numeric columns holding NULLs) lists.
+
+    >>> buffers = ColumnBuffers([('id', 23), ('name', 25)])
+    >>> buffers.extend([(1, 'a'), (2, None)])
+    >>> buffers.result()
+    OrderedDict([('id', array('i', [1, 2])), ('name', ['a', None])])
+
+    Attributes:
+        description (sequence): `(name, type_code, ...)` column items, like
+            `cursor.description`.
+        columns (list): The column containers.
+    """
+
+    def __init__(self, description):
+        self.description = [(column[0], column[1]) for column in description]
+        self.columns = [array.array(COLUMN_TYPECODES[oid]) if oid in COLUMN_TYPECODES else []
+                        for _, oid in self.description]
+
+    def extend(self, rows):
+        columns = self.columns
+        for index, values in enumerate(zip(*rows)):
+            column = columns[index]
+            length = len(column)
+            try:
+                column.extend(values)
+            except TypeError:
+                # A NULL, the column falls back to a list.
+                del column[length:]
+                column = columns[index] = column.tolist()
+                column.extend(values)
+
+    def result(self, numpy=False):
+        """Returns an `OrderedDict` of column name to column values.
+
+        Args:
+            numpy (boolean): Wrap array columns as NumPy arrays (no copy).
+        """
+        columns = self.columns
+        if numpy:
+            import numpy
+            columns = [
+                numpy.frombuffer(column, dtype=COLUMN_DTYPES.get(oid, column.typecode))
+                if isinstance(column, array.array) else column
+                for (_, oid), column in zip(self.description, columns)
+            ]
+        return OrderedDict(zip((name for name, _ in self.description), columns))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.aio` pool tests, against fake connections."""
+
+import asyncio
+
+import pytest
+
+from pgtools.aio import AsyncPostgresPool
+from pgtools.errors import PoolTimeoutError
+
+
+class FakeConnection(object):
+    closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool(AsyncPostgresPool):
+
+    async def create_connection(self):
+        return FakeConnection()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_get_hands_off_in_fifo_order():
+    async def scenario():
+        pool = FakePool(maxsize=1)
+        conn = await pool.get()
+        order = []
+
+        async def wait(name):
+            got = await pool.get()
+            order.append(name)
+            pool.put(got)
+
+        tasks = [asyncio.ensure_future(wait(name)) for name in ('first', 'second')]
+        await asyncio.sleep(0)
+        pool.put(conn)
+        await asyncio.gather(*tasks)
+        return pool, order
+
+    pool, order = run(scenario())
+    assert order == ['first', 'second']
+    assert pool.size == 1 and len(pool.pool) == 1
+
+
+def test_get_timeout():
+    async def scenario():
+        pool = FakePool(maxsize=1, acquire_timeout=0.01)
+        await pool.get()
+        with pytest.raises(PoolTimeoutError):
+            await pool.get()
+        return pool
+
+    pool = run(scenario())
+    assert not pool._waiters and pool.size == 1
+
+
+def test_get_zero_timeout():
+    async def scenario():
+        pool = FakePool(maxsize=1, acquire_timeout=60)
+        await pool.get()
+        with pytest.raises(PoolTimeoutError):
+            await asyncio.wait_for(pool.get(acquire_timeout=0), 1)
+        return pool
+
+    pool = run(scenario())
+    assert not pool._waiters
+
+
+def test_cancelled_waiter_returns_handed_connection():
+    async def scenario():
+        pool = FakePool(maxsize=1, acquire_timeout=1)
+        conn = await pool.get()
+        task = asyncio.ensure_future(pool.get())
+        await asyncio.sleep(0)
+        # Cancelled after the hand-off, before resuming.
+        pool.put(conn)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert pool.size == 1 and list(pool.pool) == [conn]
+        assert await pool.get() is conn
+
+    run(scenario())
+
+
+def test_cancelled_waiter_releases_handed_slot():
+    async def scenario():
+        pool = FakePool(maxsize=1, acquire_timeout=1)
+        conn = await pool.get()
+        task = asyncio.ensure_future(pool.get())
+        await asyncio.sleep(0)
+        pool.discard(conn)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert pool.size == 0 and not pool._waiters
+        assert await pool.get() is not conn
+
+    run(scenario())
+
+
+def test_cancelled_queued_waiter():
+    async def scenario():
+        pool = FakePool(maxsize=1)
+        conn = await pool.get()
+        task = asyncio.ensure_future(pool.get())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not pool._waiters
+        pool.put(conn)
+        assert list(pool.pool) == [conn]
+
+    run(scenario())
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.cache` and cached `pgtools.dbapi` fields tests."""
+
+import sys
+import threading
+
+from pgtools.cache import MISS, ResultCache
+from pgtools.dbapi import DBAPIBackend, FunctionField, ViewField
+
+
+class FakePersistence(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = []
+
+    def query(self, query, **options):
+        self.queries.append(query)
+        return [{'db': self.name, 'params': query.params}]
+
+
+def test_lru_eviction():
+    cache = ResultCache(max_size=2)
+    cache.set('api.a', 1, 'a')
+    cache.set('api.b', 1, 'b')
+    assert cache.get('api.a', 1) == 'a'
+    cache.set('api.c', 1, 'c')
+    assert cache.get('api.b', 1) is MISS
+    assert cache.get('api.a', 1) == 'a' and cache.get('api.c', 1) == 'c'
+    assert len(cache) == 2
+
+
+def test_ttl():
+    cache = ResultCache(ttl=10)
+    now = [100.0]
+    cache.timer = lambda: now[0]
+    cache.set('api.a', 1, 'a')
+    cache.set('api.b', 1, 'b', ttl=None)
+    now[0] += 11
+    assert cache.get('api.a', 1) is MISS
+    assert cache.get('api.b', 1) == 'b'
+    assert cache.snapshot()['size'] == 1
+
+
+def test_invalidation():
+    cache = ResultCache()
+    for field in ('api.get_user', 'api.get_order', 'shop.get_user'):
+        cache.set(field, 1, field)
+        cache.set(field, 2, field)
+    assert cache.invalidate('api.get_user', 1) == 1
+    assert cache.invalidate('api.get_user', 1) == 0
+    assert cache.invalidate('api.get_order', match=lambda key: key == 2) == 1
+    assert cache.invalidate_pattern('*.get_user') == 3
+    assert len(cache) == 1 and cache.get('api.get_order', 1) == 'api.get_order'
+
+
+def test_cached_fields_are_scoped_per_persistence():
+    cache = ResultCache()
+
+    class First(DBAPIBackend):
+        get_user = FunctionField(cache=True, pk=int)
+        settings = ViewField(cache=True)
+        persistence = FakePersistence('first')
+        result_cache = cache
+
+    class Second(DBAPIBackend):
+        get_user = FunctionField(cache=True, pk=int)
+        persistence = FakePersistence('second')
+        result_cache = cache
+
+    first, second = First(), Second()
+    assert first.get_user(pk=1) is first.get_user(pk=1)
+    assert second.get_user(pk=1)[0]['db'] == 'second'
+    assert len(First.persistence.queries) == len(Second.persistence.queries) == 1
+    assert first.settings() is first.settings()
+
+    assert first.get_user.invalidate(pk=1) == 1
+    assert first.get_user(pk=1)[0]['db'] == 'first'
+    assert first.get_user.invalidate() == 1
+    assert second.get_user(pk=1) and len(Second.persistence.queries) == 1
+    assert first.settings.invalidate() == 1
+
+
+def test_uncached_and_unbound_fields():
+    class Plain(DBAPIBackend):
+        get_user = FunctionField(pk=int)
+        cached = FunctionField(cache=True, cache_ttl=5, pk=int)
+
+    assert Plain.cached.func_specs == {'pk': int} and Plain.cached.cache_ttl == 5
+    # Without persistence calls return their `APIQuery`, never cached.
+    assert Plain().cached(pk=1).params == (1, )
+    Plain.persistence = FakePersistence('plain')
+    Plain().get_user(pk=1)
+    Plain().get_user(pk=1)
+    assert len(Plain.persistence.queries) == 2
+
+
+def test_set_after_invalidation_is_dropped():
+    cache = ResultCache()
+    for invalidate in (
+        lambda: cache.invalidate('api.get_user', 2),
+        lambda: cache.invalidate('api.get_user'),
+        lambda: cache.invalidate_pattern('api.*'),
+        cache.clear,
+    ):
+        generation = cache.generation('api.get_user')
+        invalidate()
+        assert not cache.set('api.get_user', 1, 'stale', generation=generation)
+        assert cache.get('api.get_user', 1) is MISS
+    generation = cache.generation('api.get_user')
+    cache.invalidate('api.get_order')
+    assert cache.set('api.get_user', 1, 'fresh', generation=generation)
+    assert cache.get('api.get_user', 1) == 'fresh'
+
+
+def test_invalidation_during_query_is_not_lost():
+    cache = ResultCache()
+
+    class Notifying(FakePersistence):
+        def query(self, query, **options):
+            # As a `CacheInvalidator` NOTIFY handled while the query runs.
+            cache.invalidate_pattern('api.*')
+            return super(Notifying, self).query(query, **options)
+
+    class Api(DBAPIBackend):
+        get_user = FunctionField(cache=True, pk=int)
+        persistence = Notifying('api')
+        result_cache = cache
+
+        class Meta:
+            schema = 'api'
+
+    api = Api()
+    api.get_user(pk=1)
+    api.get_user(pk=1)
+    assert len(Api.persistence.queries) == 2 and len(cache) == 0
+
+
+def test_concurrent_threads():
+    cache = ResultCache(max_size=50)
+    errors = []
+
+    def hammer(seed):
+        try:
+            for index in range(10000):
+                field = 'api.f{:d}'.format((seed + index) % 7)
+                cache.get(field, index % 60)
+                cache.set(field, index % 60, index)
+                if not index % 50:
+                    cache.invalidate_pattern('api.f[0-3]')
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=hammer, args=(seed, )) for seed in range(8)]
+    interval = sys.getswitchinterval()
+    # Switch threads as often as possible.
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert not errors
+    assert len(cache) <= 50
+    assert sum(len(keys) for keys in cache._fields.values()) == len(cache)
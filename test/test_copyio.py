@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.copyio` binary ``COPY`` decoder tests.
+
+Streams are encoded here as the server sends them, see the Postgresql
+``COPY`` binary format and the ``*send`` functions of each type.
+"""
+
+import datetime
+import decimal
+import random
+import struct
+import uuid
+
+import pytest
+
+from pgtools.copyio import COPY_SIGNATURE, BinaryCopyDecoder, decode_numeric
+
+EPOCH = datetime.datetime(2000, 1, 1)
+
+EPOCH_TZ = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def encode_numeric(value):
+    if value.is_nan():
+        return struct.pack('!hhHh', 0, 0, 0xC000, 0)
+    if value.is_infinite():
+        return struct.pack('!hhHh', 0, 0, 0xF000 if value < 0 else 0xD000, 0)
+    integer, _, fraction = format(value.copy_abs(), 'f').partition('.')
+    dscale = len(fraction)
+    integer = integer.lstrip('0')
+    integer = '0' * (-len(integer) % 4) + integer
+    fraction += '0' * (-len(fraction) % 4)
+    digits = [int(integer[index:index + 4]) for index in range(0, len(integer), 4)]
+    weight = len(digits) - 1
+    digits += [int(fraction[index:index + 4]) for index in range(0, len(fraction), 4)]
+    while digits and not digits[0]:
+        digits.pop(0)
+        weight -= 1
+    while digits and not digits[-1]:
+        digits.pop()
+    if not digits:
+        weight = 0
+    sign = 0x4000 if value < 0 else 0
+    return struct.pack('!hhHh%dh' % len(digits), len(digits), weight, sign, dscale, *digits)
+
+
+ENCODERS = {
+    16: lambda value: struct.pack('!?', value),
+    17: bytes,
+    20: lambda value: struct.pack('!q', value),
+    21: lambda value: struct.pack('!h', value),
+    23: lambda value: struct.pack('!i', value),
+    25: lambda value: value.encode('utf-8'),
+    26: lambda value: struct.pack('!I', value),
+    700: lambda value: struct.pack('!f', value),
+    701: lambda value: struct.pack('!d', value),
+    1082: lambda value: struct.pack('!i', (value - EPOCH.date()).days),
+    1114: lambda value: struct.pack('!q', microseconds(value - EPOCH)),
+    1184: lambda value: struct.pack('!q', microseconds(value - EPOCH_TZ)),
+    1700: encode_numeric,
+    2950: lambda value: value.bytes,
+    # json, decoded as raw bytes.
+    114: bytes,
+}
+
+
+def random_value(rnd, oid):
+    if oid == 16:
+        return rnd.random() < 0.5
+    if oid in (17, 114):
+        return bytes(bytearray(rnd.randrange(256) for _ in range(rnd.randrange(10))))
+    if oid == 20:
+        return rnd.randrange(-2 ** 63, 2 ** 63)
+    if oid == 21:
+        return rnd.randrange(-2 ** 15, 2 ** 15)
+    if oid == 23:
+        return rnd.randrange(-2 ** 31, 2 ** 31)
+    if oid == 25:
+        return u''.join(rnd.choice(u'ab ,"\\\né€😀') for _ in range(rnd.randrange(10)))
+    if oid == 26:
+        return rnd.randrange(2 ** 32)
+    if oid == 700:
+        return struct.unpack('!f', struct.pack('!f', rnd.uniform(-1e6, 1e6)))[0]
+    if oid == 701:
+        return rnd.uniform(-1e300, 1e300)
+    if oid == 1082:
+        return EPOCH.date() + datetime.timedelta(days=rnd.randrange(-700000, 700000))
+    if oid == 1114:
+        return EPOCH + datetime.timedelta(microseconds=rnd.randrange(-10 ** 16, 10 ** 16))
+    if oid == 1184:
+        return EPOCH_TZ + datetime.timedelta(microseconds=rnd.randrange(-10 ** 16, 10 ** 16))
+    if oid == 1700:
+        return random_decimal(rnd)
+    if oid == 2950:
+        return uuid.UUID(int=rnd.getrandbits(128))
+
+
+def random_decimal(rnd):
+    special = rnd.random()
+    if special < 0.05:
+        return decimal.Decimal(rnd.choice(['NaN', 'Infinity', '-Infinity']))
+    digits = ''.join(rnd.choice('0123456789') for _ in range(rnd.randrange(1, 30)))
+    return decimal.Decimal('{}{}E{:d}'.format(
+        rnd.choice(['', '-']), digits, rnd.randrange(-20, 10)
+    )).normalize() if special < 0.1 else decimal.Decimal('{}{}E{:d}'.format(
+        rnd.choice(['', '-']), digits, rnd.randrange(-20, 1)
+    ))
+
+
+def encode_stream(oids, rows, extension=b''):
+    chunks = [COPY_SIGNATURE, struct.pack('!ii', 0, len(extension)), extension]
+    for row in rows:
+        chunks.append(struct.pack('!h', len(row)))
+        for oid, value in zip(oids, row):
+            if value is None:
+                chunks.append(struct.pack('!i', -1))
+            else:
+                data = ENCODERS[oid](value)
+                chunks.append(struct.pack('!i', len(data)) + data)
+    chunks.append(struct.pack('!h', -1))
+    return b''.join(chunks)
+
+
+def random_rows(rnd, oids, count, nulls=0.1):
+    return [tuple(None if rnd.random() < nulls else random_value(rnd, oid) for oid in oids)
+            for _ in range(count)]
+
+
+def decode_split(decoder, stream, rnd):
+    rows = []
+    pos = 0
+    while pos < len(stream):
+        size = rnd.choice([1, 2, 3, 7, rnd.randrange(1, 64), rnd.randrange(1, 4096)])
+        rows.extend(decoder.feed(stream[pos:pos + size]))
+        pos += size
+    return rows
+
+
+def assert_same_rows(decoded, rows):
+    assert len(decoded) == len(rows)
+    for decoded_row, row in zip(decoded, rows):
+        for decoded_value, value in zip(decoded_row, row):
+            if isinstance(value, decimal.Decimal) and value.is_nan():
+                assert decoded_value.is_nan()
+            else:
+                assert decoded_value == value and type(decoded_value) is type(value)
+
+
+ALL_OIDS = sorted(ENCODERS)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_round_trip(seed):
+    rnd = random.Random(seed)
+    oids = [rnd.choice(ALL_OIDS) for _ in range(rnd.randrange(1, 8))]
+    rows = random_rows(rnd, oids, rnd.randrange(0, 200))
+    decoder = BinaryCopyDecoder(oids)
+    decoded = decode_split(decoder, encode_stream(oids, rows, b'x' * rnd.randrange(3)), rnd)
+    assert_same_rows(decoded, rows)
+    assert decoder.finished and not decoder.buffer
+
+
+class CountingStruct(object):
+    """`struct.Struct` proxy counting `unpack_from` calls."""
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.size = wrapped.size
+        self.calls = 0
+
+    def unpack_from(self, data, pos):
+        self.calls += 1
+        return self.wrapped.unpack_from(data, pos)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_fixed_width_fast_path(seed):
+    rnd = random.Random(seed)
+    oids = [rnd.choice([16, 20, 21, 23, 26, 700, 701]) for _ in range(rnd.randrange(1, 6))]
+    rows = random_rows(rnd, oids, 100, nulls=0)
+    decoder = BinaryCopyDecoder(oids)
+    assert decoder.row_struct is not None
+    decoder.row_struct = counting = CountingStruct(decoder.row_struct)
+    # Whole stream at once, every row goes through the fast path.
+    assert_same_rows(decoder.feed(encode_stream(oids, rows)), rows)
+    assert counting.calls == 100 and decoder.finished
+
+
+def test_fixed_width_null_fallback():
+    rnd = random.Random(1)
+    oids = [23, 701, 16]
+    rows = random_rows(rnd, oids, 300, nulls=0.2)
+    rows.append((None, None, None))
+    decoder = BinaryCopyDecoder(oids)
+    assert decoder.row_struct is not None
+    assert_same_rows(decode_split(decoder, encode_stream(oids, rows), rnd), rows)
+    assert decoder.finished
+
+
+def test_mixed_columns_have_no_fast_path():
+    assert BinaryCopyDecoder([23, 25]).row_struct is None
+    assert BinaryCopyDecoder([]).row_struct is None
+
+
+def test_text_encoding():
+    decoder = BinaryCopyDecoder([25, 1043], encoding='latin-1')
+    assert decoder.feed(encode_stream([25], [])[:19]) == []
+    row = struct.pack('!hi', 2, 3) + b'\xe9t\xe9' + struct.pack('!i', 0)
+    assert decoder.feed(row) == [(u'\xe9t\xe9', u'')]
+
+
+def test_invalid_streams():
+    with pytest.raises(ValueError):
+        BinaryCopyDecoder([23]).feed(b'PGCOPY\n\xff\r\n\x01' + b'\0' * 8)
+    decoder = BinaryCopyDecoder([23, 23])
+    with pytest.raises(ValueError):
+        decoder.feed(encode_stream([23], [(1, )]))
+
+
+def test_infinite_dates_and_timestamps():
+    decoder = BinaryCopyDecoder([1082, 1082, 1114, 1114, 1184])
+    row = struct.pack('!hiiiiiqiqiq', 5, 4, 0x7FFFFFFF, 4, -0x80000000,
+                      8, 0x7FFFFFFFFFFFFFFF, 8, -0x8000000000000000, 8, 0x7FFFFFFFFFFFFFFF)
+    assert decoder.feed(COPY_SIGNATURE + b'\0' * 8 + row) == [(
+        datetime.date.max, datetime.date.min, datetime.datetime.max, datetime.datetime.min,
+        datetime.datetime.max.replace(tzinfo=datetime.timezone.utc),
+    )]
+
+
+def assert_same_numeric(decoded, value):
+    if value.is_nan():
+        assert decoded.is_nan()
+    else:
+        # Same value and scale (fractional digits), as `numeric::text`.
+        assert decoded == value
+        assert decoded.is_infinite() or decoded.as_tuple().exponent == min(
+            0, value.as_tuple().exponent
+        )
+
+
+@pytest.mark.parametrize('value', [
+    '0', '0.00', '1', '-1', '10000', '9999.9999', '0.0001', '-0.00010', '1.5', '1.0000',
+    '123456789012345678901234567890.123456789', '1E+20', '1.000E+8', '0.000000000000001',
+    '-12.3456', '100000000.00000001', 'NaN', 'Infinity', '-Infinity',
+])
+def test_decode_numeric(value):
+    value = decimal.Decimal(value)
+    data = b'xx' + encode_numeric(value)
+    assert_same_numeric(decode_numeric(data, 2, len(data) - 2), value)
+
+
+def test_decode_numeric_random():
+    rnd = random.Random(0)
+    for _ in range(2000):
+        value = random_decimal(rnd)
+        assert_same_numeric(decode_numeric(encode_numeric(value)), value)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.dbapi` field tests, without persistence (calls return `APIQuery`)."""
+
+import itertools
+
+import pytest
+
+from pgtools.dbapi import (
+    APIQuery, DBAPIBackend, FunctionField, InvalidFunctionParamError, UnknownParamError, ViewField,
+)
+
+
+class Backend(DBAPIBackend):
+    get_user = FunctionField(pk=int, name=str)
+    search = FunctionField(order=['query', 'tags', 'options', 'active', 'limit'],
+                           limit=int, active=bool, tags=list, options=dict, query=str)
+    # Keyword and non identifier argument names use `build_generic` only.
+    keywords = FunctionField(**{'from': int, 'to': int})
+    dashed = FunctionField(**{'user-id': int, 'name': str})
+    settings = ViewField()
+
+    class Meta:
+        schema = 'api'
+
+
+VALUES = {
+    int: [1, -2, 2.5, True, 'x', None],
+    str: ['a', u'é', 1, None],
+    bool: [True, False, 1, None],
+    list: [[1, 'a b'], (2, None), [], 'x', None],
+    dict: [{'a': [1]}, {}, [], None],
+}
+
+
+def outcome(call, *args, **kwargs):
+    try:
+        return call(*args, **kwargs)
+    except Exception as error:
+        return type(error)
+
+
+@pytest.mark.parametrize('tag', ['get_user', 'search', 'keywords', 'dashed'])
+def test_build_matches_generic(tag):
+    field = Backend.__dict__[tag]
+    names = field.arguments
+    choices = [[None] + [(name, value) for value in VALUES[field.func_specs[name]]]
+               for name in names]
+    combinations = list(itertools.product(*choices))
+    # Keep the larger signatures fast, every `search` argument still varies.
+    for args in combinations[::max(1, len(combinations) // 2000)]:
+        args = dict(arg for arg in args if arg is not None)
+        built = outcome(field.build, **args)
+        assert built == outcome(field.build_generic, args)
+        assert built == outcome(getattr(Backend(), tag), **args)
+
+
+def test_build_full_and_partial_calls():
+    backend = Backend()
+    assert backend.get_user(name='bob', pk=1) == APIQuery(
+        'SELECT * FROM api.get_user(%s, %s);', (1, 'bob')
+    )
+    # Passed arguments only, in call order.
+    assert backend.get_user(name='bob') == APIQuery('SELECT * FROM api.get_user(%s);', ('bob', ))
+    assert backend.search(limit=5, query='x', tags=[1, 'a b'], options={}, active=True) == (
+        APIQuery('SELECT * FROM api.search(%s, %s, %s, %s, %s);',
+                 ('x', '{1,"a b"}', '{}', True, 5))
+    )
+    assert backend.search(limit=5, query='x').params == ('x', 5)
+
+
+def test_build_keyword_names():
+    backend = Backend()
+    assert backend.keywords(**{'to': 2, 'from': 1}) == APIQuery(
+        'SELECT * FROM api.keywords(%s, %s);', (1, 2)
+    )
+    assert backend.dashed(**{'user-id': 1}).params == (1, )
+
+
+@pytest.mark.parametrize('tag, args, error', [
+    ('get_user', {'pk': '1', 'name': 'bob'}, InvalidFunctionParamError),
+    ('get_user', {'pk': None}, InvalidFunctionParamError),
+    ('search', {'tags': 'a', 'query': 'x'}, InvalidFunctionParamError),
+    ('keywords', {'from': '1'}, InvalidFunctionParamError),
+    ('get_user', {'pk': 1, 'email': 'x'}, UnknownParamError),
+    ('get_user', {}, UnknownParamError),
+    ('dashed', {'user_id': 1}, UnknownParamError),
+])
+def test_build_errors(tag, args, error):
+    with pytest.raises(error):
+        getattr(Backend(), tag)(**args)
+
+
+def test_callables_are_bound_once():
+    backend = Backend()
+    get_user = backend.get_user
+    assert backend.get_user is get_user and backend.settings is backend.settings
+    assert Backend.get_user is Backend.__dict__['get_user']
+    assert get_user(pk=1) == APIQuery('SELECT * FROM api.get_user(%s);', (1, ))
+    assert backend.settings() == APIQuery('SELECT * FROM api.settings;', ())
+
+    class Persistence(object):
+        def query(self, query, **options):
+            return [{'pgtools_ord': index, 'pk': pk} for index, pk in enumerate(query.params)]
+
+    # The owner persistence is looked up on every call.
+    Backend.persistence = Persistence()
+    try:
+        assert get_user(pk=1) == [{'pgtools_ord': 0, 'pk': 1}]
+        assert get_user.map([{'pk': 1}, {'pk': 2}]) == [[{'pk': 1}], [{'pk': 2}]]
+    finally:
+        del Backend.persistence
+
+
+def test_casts_disambiguate_overloads():
+
+    class Geo(DBAPIBackend):
+        distance = FunctionField(casts={'b': 'point'}, a=str, b=str)
+        area = FunctionField(casts={'shape': 'public.shape[]'}, shape=list)
+
+    geo = Geo()
+    assert geo.distance(a='(0,0)', b='(1,1)') == APIQuery(
+        'SELECT * FROM public.distance(%s, %s::point);', ('(0,0)', '(1,1)')
+    )
+    # Partial calls cast the passed arguments only.
+    assert geo.distance(b='(1,1)').sql == 'SELECT * FROM public.distance(%s::point);'
+    assert geo.area(shape=[]).sql == 'SELECT * FROM public.area(%s::public.shape[]);'
+    assert geo.distance.map([{'a': '(0,0)', 'b': '(1,1)'}])[0].sql == (
+        'SELECT 0 AS pgtools_ord, * FROM public.distance(%s, %s::point);'
+    )
+
+
+@pytest.mark.parametrize('casts', [
+    {'c': 'point'},
+    {'a': 'point; DROP TABLE users'},
+    {'a': ''},
+])
+def test_invalid_casts(casts):
+    with pytest.raises(ValueError):
+        FunctionField(casts=casts, a=str, b=str)
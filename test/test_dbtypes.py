@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.dbtypes` literal parser and converter tests.
+
+Literals are the Postgresql text output of the corresponding values.
+"""
+
+import array
+import json
+
+import psycopg2.extensions
+import pytest
+
+from pgtools.dbtypes import (
+    ArrayModelField, BaseModel, BooleanModelField, CompositeModelField, FloatModelField,
+    IntegerModelField, JSONModelField, ModelBatch, ModelError, TextModelField, cast_column,
+    db_cast, model_converter, parse_array, parse_composite,
+)
+
+
+@pytest.mark.parametrize('literal, fields', [
+    ('(1,abc)', ['1', 'abc']),
+    # NULL is an empty unquoted field, the empty string is quoted.
+    ('(,"",)', [None, '', None]),
+    ('()', [None]),
+    # ROW('a)b', 'x y', E'\\', 'a,b', 'q\\"')
+    (r'("a)b","x y","\\",a\,b,"q\\""")', ['a)b', 'x y', '\\', 'a,b', 'q\\"']),
+    # Nested composite and array values stay literals.
+    (r'(1,"(2,""x """"y"""""")","{""a b"",NULL}")',
+     ['1', '(2,"x ""y""")', '{"a b",NULL}']),
+])
+def test_parse_composite(literal, fields):
+    assert parse_composite(literal) == fields
+
+
+@pytest.mark.parametrize('literal', [
+    '', '(', '1,2', '(1,2', '("unterminated)', '(a)b)', '(a,"b"c)', '("a""b)',
+])
+def test_parse_composite_malformed(literal):
+    with pytest.raises(ModelError):
+        parse_composite(literal)
+
+
+@pytest.mark.parametrize('literal, items', [
+    ('{}', []),
+    ('{1,2,3}', ['1', '2', '3']),
+    ('{NULL,"NULL","",null}', [None, 'NULL', '', None]),
+    # Unquoted elements keep their inner whitespace.
+    ('{ a b , c }', ['a b', 'c']),
+    (r'{"a\\b","c\"d",e\,f,\NULL}', ['a\\b', 'c"d', 'e,f', 'NULL']),
+    ('{"{x}","(1,2)",(3)}', ['{x}', '(1,2)', '(3)']),
+    ('{{1,NULL},{"a,b",c}}', [['1', None], ['a,b', 'c']]),
+    ('{{{1},{2}},{{3},{4}}}', [[['1'], ['2']], [['3'], ['4']]]),
+    ('[0:1]={x,y}', ['x', 'y']),
+    ('[-1:0][1:2]={{a,b},{c,d}}', [['a', 'b'], ['c', 'd']]),
+])
+def test_parse_array(literal, items):
+    assert parse_array(literal) == items
+
+
+@pytest.mark.parametrize('literal', [
+    '', '{', '1,2}', '{1,2', '{1}}', '{1,{2}', '{{}}', '{1,}', '{,1}', '{1 2,}',
+    '{"unterminated}', '{a"b}', '{"a" b}',
+    # Mixed and ragged dimensions.
+    '{{1},2}', '{1,{2}}', '{{1,2},{3}}',
+    # Dimension prefixes.
+    '[0:1]', '[x]={1}', '[0:1]{1,2}',
+])
+def test_parse_array_malformed(literal):
+    with pytest.raises(ModelError):
+        parse_array(literal)
+
+
+class Address(BaseModel):
+    street = TextModelField()
+    number = IntegerModelField()
+
+
+class User(BaseModel):
+    id = IntegerModelField()
+    name = TextModelField()
+    active = BooleanModelField()
+    tags = ArrayModelField(TextModelField())
+    scores = ArrayModelField(IntegerModelField())
+    settings = JSONModelField()
+    address = CompositeModelField(Address)
+
+
+def test_model_converter():
+    convert = model_converter(User)
+    assert model_converter(User) is convert
+    user = convert(
+        r'(1,"O\"Brien, ""Bob""",t,"{admin,""a b"",NULL}","{{1,2},{3,4}}",'
+        r'"{""theme"": ""dark""}","(""Main St"",5)")'
+    )
+    assert user.to_dict == {
+        'id': 1,
+        'name': 'O"Brien, "Bob"',
+        'active': True,
+        'tags': ['admin', 'a b', None],
+        'scores': [[1, 2], [3, 4]],
+        'settings': {'theme': 'dark'},
+        'address': user.address,
+    }
+    assert user.address.to_dict == {'street': 'Main St', 'number': 5}
+
+
+def test_model_converter_nulls():
+    user = model_converter(User)('(2,"",,,{},,)')
+    assert user.to_dict == {
+        'id': 2, 'name': '', 'active': None, 'tags': None, 'scores': [],
+        'settings': None, 'address': None,
+    }
+
+
+@pytest.mark.parametrize('literal', [
+    '(1,a,t,{},{},{},)(',
+    # Field count.
+    '(1,a)',
+    '(1,a,t,{},{},{},,)',
+    # Field values.
+    '(x,a,t,{},{},{},)',
+    '(1,a,yes,{},{},{},)',
+    '(1,a,t,{},"{1,{2}}",{},)',
+    '(1,a,t,{},{},{},"(x,y)")',
+])
+def test_model_converter_malformed(literal):
+    with pytest.raises(ModelError):
+        model_converter(User)(literal)
+
+
+def test_cast_column():
+    addresses = cast_column(Address, ['(a,1)', None, '("b c",)'])
+    assert addresses[1] is None
+    assert [address.to_dict for address in addresses[::2]] == [
+        {'street': 'a', 'number': 1}, {'street': 'b c', 'number': None},
+    ]
+
+
+def test_db_cast():
+    caster = db_cast(Address, 123456, scope=None)
+    try:
+        assert caster(None, None) is None
+        assert caster('("x, y",7)', None).to_dict == {'street': 'x, y', 'number': 7}
+    finally:
+        psycopg2.extensions.string_types.pop(123456, None)
+
+
+class Point(BaseModel):
+    x = IntegerModelField()
+    y = IntegerModelField()
+
+
+class Point3D(Point):
+    z = IntegerModelField()
+
+
+def test_init_positional_and_keyword():
+    assert Point3D.fields() == ['x', 'y', 'z']
+    assert Point3D(1, 2, 3).to_dict == {'x': 1, 'y': 2, 'z': 3}
+    # Values are cleaned, missing ones are None, unknown keywords ignored.
+    point = Point3D('1', z=3.5, color='red')
+    assert point.to_dict == {'x': 1, 'y': None, 'z': 3}
+    with pytest.raises(TypeError):
+        Point3D(1, 2, 3, 4)
+    with pytest.raises(TypeError):
+        Point3D(1, x=1)
+    with pytest.raises(ModelError):
+        Point('x')
+
+
+def test_make_and_from_rows():
+    point = Point3D._make(('1', 2, 3))
+    # Stored as given, without `clean_value`.
+    assert point.to_dict == {'x': '1', 'y': 2, 'z': 3}
+    with pytest.raises(ValueError):
+        Point._make((1, 2, 3))
+
+    assert [point.to_dict for point in Point.from_rows([(1, 2), (3, 4)])] == [
+        {'x': 1, 'y': 2}, {'x': 3, 'y': 4},
+    ]
+    rows = [{'y': 2, 'x': 1, 'extra': 0}, {'x': 3, 'y': None}]
+    assert [point.to_dict for point in Point.from_rows(iter(rows))] == [
+        {'x': 1, 'y': 2}, {'x': 3, 'y': None},
+    ]
+    assert [address.street for address in Address.from_rows([('a', 1)])] == ['a']
+
+    class Single(BaseModel):
+        value = TextModelField()
+
+    assert [row.value for row in Single.from_rows([{'value': 'a'}, {'value': None}])] == [
+        'a', None,
+    ]
+    assert Point.from_rows([]) == []
+
+
+def test_generated_names_do_not_collide_with_fields():
+
+    class Odd(BaseModel):
+        self = IntegerModelField()
+        ignored = TextModelField()
+        MISSING = TextModelField()
+        row = IntegerModelField()
+        cls = IntegerModelField()
+        new = TextModelField()
+        clean_row = TextModelField()
+
+    odd = Odd(1, 'a', 'b', '2', '3', 'c', 'd')
+    assert odd.to_dict == {
+        'self': 1, 'ignored': 'a', 'MISSING': 'b', 'row': 2, 'cls': 3, 'new': 'c',
+        'clean_row': 'd',
+    }
+    assert Odd(self=5, MISSING='m').to_dict['MISSING'] == 'm'
+    assert Odd._make(range(7)).to_dict['cls'] == 4
+    assert Odd.from_rows([odd.to_dict])[0].to_dict == odd.to_dict
+
+    with pytest.raises(ModelError):
+        class Reserved(BaseModel):
+            _pg_self = IntegerModelField()
+
+
+class Sample(BaseModel):
+    id = IntegerModelField()
+    score = FloatModelField()
+    name = TextModelField()
+
+
+ROWS = [(1, 0.5, 'a'), (2, None, 'b'), (3, 2.5, None)]
+
+
+def test_batch_from_rows():
+    batch = ModelBatch.from_rows(Sample, ROWS)
+    assert len(batch) == 3 and list(batch.columns) == ['id', 'score', 'name']
+    assert batch.columns['id'] == array.array('q', [1, 2, 3])
+    # Columns holding NULLs are lists.
+    assert batch.columns['score'] == [0.5, None, 2.5]
+    assert batch.columns['name'] == ['a', 'b', None]
+
+    rows = [dict(zip(('name', 'id', 'score'), (name, pk, score))) for pk, score, name in ROWS]
+    assert ModelBatch.from_rows(Sample, iter(rows)).to_dicts() == batch.to_dicts()
+    empty = ModelBatch.from_rows(Sample, [])
+    assert len(empty) == 0 and empty.columns['id'] == array.array('q')
+    assert empty.to_dicts() == [] and empty.to_json() == '[]'
+
+
+def test_batch_from_columns():
+    ids = array.array('q', [1, 2])
+    batch = ModelBatch.from_columns(Sample, {
+        'id': ids, 'score': array.array('i', [1, 2]), 'name': ('a', 'b'), 'extra': [0, 0],
+    })
+    # Matching arrays are kept as is, the rest converted.
+    assert batch.columns['id'] is ids
+    assert batch.columns['score'] == array.array('d', [1.0, 2.0])
+    assert batch.columns['name'] == ['a', 'b']
+    batch = ModelBatch.from_columns(Sample, {
+        'id': [1, None], 'score': [0.5, 1], 'name': ['a', 'b'],
+    })
+    assert batch.columns['id'] == [1, None]
+    assert batch.columns['score'] == array.array('d', [0.5, 1])
+    with pytest.raises(ModelError):
+        ModelBatch.from_columns(Sample, {'id': [1], 'score': [], 'name': []})
+    with pytest.raises(KeyError):
+        ModelBatch.from_columns(Sample, {'id': [1]})
+
+
+def test_batch_rows_and_slices():
+    batch = ModelBatch.from_rows(Sample, ROWS)
+    row = batch[-1]
+    assert (row.id, row['score'], row.name) == (3, 2.5, None)
+    assert row.to_dict == {'id': 3, 'score': 2.5, 'name': None}
+    assert repr(row) == '<Sample row 2 view>' and repr(batch) == '<Sample batch of 3 rows>'
+    with pytest.raises(AttributeError):
+        row.missing
+    with pytest.raises(IndexError):
+        batch[3]
+    assert [row.id for row in batch] == [1, 2, 3]
+
+    tail = batch[1:]
+    assert isinstance(tail, ModelBatch) and len(tail) == 2
+    assert tail.columns['id'] == array.array('q', [2, 3]) and tail[0].name == 'b'
+    assert len(batch[::2]) == 2 and batch[::-1].columns['name'] == [None, 'b', 'a']
+    assert len(batch[5:]) == 0
+
+
+def test_batch_take_and_filter():
+    batch = ModelBatch.from_rows(Sample, ROWS)
+    taken = batch.take([2, 0, 2])
+    assert taken.columns['id'] == array.array('q', [3, 1, 3])
+    assert taken.columns['name'] == [None, 'a', None]
+    assert len(batch.take([])) == 0
+
+    assert batch.filter(name='b').to_dicts() == [{'id': 2, 'score': None, 'name': 'b'}]
+    assert batch.filter(lambda row: row.id > 1).columns['id'] == array.array('q', [2, 3])
+    assert len(batch.filter(lambda row: row.id > 1, name='a')) == 0
+    assert batch.filter().to_dicts() == batch.to_dicts()
+
+
+def test_batch_to_models_and_json():
+    batch = ModelBatch.from_rows(Sample, ROWS)
+    models = batch.to_models()
+    assert all(isinstance(model, Sample) for model in models)
+    assert [model.to_dict for model in models] == batch.to_dicts()
+    assert batch[0].to_model().to_dict == {'id': 1, 'score': 0.5, 'name': 'a'}
+    assert json.loads(batch.to_json()) == [
+        {'id': 1, 'score': 0.5, 'name': 'a'},
+        {'id': 2, 'score': None, 'name': 'b'},
+        {'id': 3, 'score': 2.5, 'name': None},
+    ]
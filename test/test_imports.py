@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Import side effects tests, each run in a fresh interpreter."""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(source):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, (ROOT, os.environ.get('PYTHONPATH')))
+    ))
+    subprocess.check_call([sys.executable, '-c', textwrap.dedent(source)], env=env)
+
+
+def test_import_has_no_side_effects():
+    run('''
+        import sys
+        from psycopg2 import extensions
+        import pgtools
+        from pgtools import APIQuery, DBAPIBackend, DBPoolEngine, PoolHooks
+        from pgtools import aio, cache, copyio, dbtypes, jsoncodec, profiler, rows
+        assert 'gevent' not in sys.modules, 'gevent imported'
+        assert extensions.get_wait_callback() is None
+    ''')
+
+
+def test_pool_import_installs_no_wait_callback():
+    run('''
+        import sys
+        from psycopg2 import extensions
+        from pgtools import PostgresPool
+        assert 'gevent' in sys.modules
+        assert extensions.get_wait_callback() is None
+    ''')
+
+
+@pytest.mark.parametrize('source', [
+    # Plain `psycopg2` I/O is kept.
+    '''
+        from psycopg2 import extensions
+        from pgtools.pool import PostgresPool
+        PostgresPool(wait_callback=None)
+        assert extensions.get_wait_callback() is None
+    ''',
+    # A callback installed by the application is kept.
+    '''
+        from psycopg2 import extensions
+        from pgtools.pool import PostgresPool
+        def callback(conn):
+            pass
+        extensions.set_wait_callback(callback)
+        PostgresPool(wait_callback=None)
+        assert extensions.get_wait_callback() is callback
+    ''',
+    # Pools install gevent's by default.
+    '''
+        from psycopg2 import extensions
+        from pgtools.pool import PostgresPool, gevent_wait_callback
+        PostgresPool()
+        assert extensions.get_wait_callback() is gevent_wait_callback
+    ''',
+])
+def test_pool_wait_callback(source):
+    run(source)
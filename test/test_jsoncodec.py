@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.jsoncodec` tests, without a server."""
+
+import importlib.util
+import json
+import sys
+import types
+from collections import OrderedDict
+
+import psycopg2._json
+import pytest
+from psycopg2 import extensions
+
+from pgtools import jsoncodec
+from pgtools.jsoncodec import LazyJSON, json_decoder, register_json_decoder, register_raw_json
+
+
+def load_jsoncodec(monkeypatch, **modules):
+    """Imports a private copy of `pgtools.jsoncodec` with `modules`
+    replacing the installed (`None` hiding them) decoder packages.
+    """
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    spec = importlib.util.spec_from_file_location('jsoncodec_copy', jsoncodec.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_fast_decoder_without_packages(monkeypatch):
+    module = load_jsoncodec(monkeypatch, orjson=None, ujson=None)
+    assert module.json_decoder('fast') is json.loads
+    assert sorted(module.JSON_DECODERS) == ['fast', 'ordered', 'stdlib']
+    for name in ('orjson', 'ujson'):
+        with pytest.raises(ValueError):
+            module.json_decoder(name)
+
+
+def test_fast_decoder_fallback_order(monkeypatch):
+    ujson = types.ModuleType('ujson')
+    ujson.loads = lambda raw: json.loads(raw)
+    module = load_jsoncodec(monkeypatch, orjson=None, ujson=ujson)
+    assert module.json_decoder('fast') is ujson.loads is module.json_decoder('ujson')
+
+    orjson = types.ModuleType('orjson')
+    orjson.loads = lambda raw: json.loads(raw)
+    module = load_jsoncodec(monkeypatch, orjson=orjson, ujson=ujson)
+    assert module.json_decoder('fast') is orjson.loads
+
+
+def test_json_decoder_names():
+    ordered = json_decoder()
+    assert isinstance(ordered('{"b": 1, "a": 2}'), OrderedDict)
+    assert list(ordered('{"b": 1, "a": 2}')) == ['b', 'a']
+    assert json_decoder('stdlib') is json.loads
+    assert json_decoder(len) is len
+    for name in ('simplejson', 'Ordered', None):
+        with pytest.raises(ValueError):
+            json_decoder(name)
+
+
+class CountingLoads(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, raw):
+        self.calls += 1
+        return json.loads(raw)
+
+
+def test_lazy_json_decodes_once_on_access():
+    loads = CountingLoads()
+    doc = LazyJSON('{"id": 1, "tags": ["a", "b"]}', loads=loads)
+    assert str(doc) == doc.raw and repr(doc) == 'LazyJSON(<29 chars>)'
+    assert loads.calls == 0 and not doc.decoded
+    assert doc['id'] == 1 and doc.decoded
+    assert 'tags' in doc and len(doc) == 2 and sorted(doc) == ['id', 'tags']
+    assert doc.get('missing') is None and doc == {'id': 1, 'tags': ['a', 'b']}
+    assert doc == LazyJSON(doc.raw) and bool(doc)
+    assert loads.calls == 1
+    assert repr(doc) == 'LazyJSON(%r)' % (doc.value, )
+
+
+def test_lazy_json_is_not_hashable():
+    doc = LazyJSON('[]')
+    with pytest.raises(TypeError):
+        hash(doc)
+    assert not doc and doc != [1]
+    with pytest.raises(AttributeError):
+        doc.__missing__
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_register_json_decoder_is_connection_scoped(monkeypatch, lazy):
+    registered = []
+    monkeypatch.setattr(psycopg2._json, 'register_type',
+                        lambda typecaster, scope=None: registered.append((typecaster, scope)))
+    conn = object()
+    register_json_decoder(conn, 'stdlib', lazy=lazy)
+    assert sorted(typecaster.values for typecaster, _ in registered) == [
+        (114, ), (199, ), (3802, ), (3807, )
+    ]
+    # A `None` scope would replace the process wide typecasters.
+    assert all(scope is conn for _, scope in registered)
+
+    json_typecaster = registered[0][0]
+    value = json_typecaster('{"id": 1}', None)
+    assert isinstance(value, LazyJSON) is lazy and value == {'id': 1}
+
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('str', ('{"id": 1}', ['{"a": 1}', None, '[]'])),
+    (True, ('{"id": 1}', ['{"a": 1}', None, '[]'])),
+    ('bytes', (b'{"id": 1}', [b'{"a": 1}', None, b'[]'])),
+])
+def test_raw_json_typecasters(monkeypatch, raw, expected):
+    registered = []
+    monkeypatch.setattr(extensions, 'register_type',
+                        lambda typecaster, scope=None: registered.append((typecaster, scope)))
+    cursor = object()
+    register_raw_json(cursor, raw)
+    assert all(scope is cursor for _, scope in registered)
+    typecasters = dict((typecaster.values[0], typecaster) for typecaster, _ in registered)
+    assert sorted(typecasters) == [114, 199, 3802, 3807]
+    value, array = expected
+    for oid, array_oid in ((114, 199), (3802, 3807)):
+        assert typecasters[oid]('{"id": 1}', None) == value
+        assert typecasters[oid](None, None) is None
+        assert typecasters[array_oid]('{"{\\"a\\": 1}",NULL,"[]"}', None) == array
+
+
+def test_raw_json_invalid_mode():
+    for raw in ('text', False, None):
+        with pytest.raises(ValueError):
+            register_raw_json(object(), raw)
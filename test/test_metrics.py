@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.metrics` tests."""
+
+import logging
+import random
+
+import psycopg2.pool
+import pytest
+from psycopg2 import extensions
+
+from pgtools.engine import DBPoolEngine
+from pgtools.metrics import Histogram, Instrumented, PoolHooks, PoolMetrics
+
+
+def exact_percentile(values, percent):
+    values = sorted(values)
+    return values[max(1, int(round(len(values) * percent / 100.0))) - 1]
+
+
+@pytest.mark.parametrize('sub_bits', [3, 5, 7])
+def test_histogram_percentile_accuracy(sub_bits):
+    rand = random.Random(sub_bits)
+    # Log uniform latencies, from 10µs to 10s.
+    values = [10 ** rand.uniform(-5, 1) for _ in range(5000)]
+    hist = Histogram(sub_bits=sub_bits)
+    for value in values:
+        hist.record(value)
+    assert hist.count == 5000
+    assert hist.min == min(values) and hist.max == max(values)
+    assert hist.mean == pytest.approx(sum(values) / 5000)
+    for percent in (1, 10, 50, 90, 99, 99.9, 100):
+        exact = exact_percentile(values, percent)
+        assert abs(hist.percentile(percent) - exact) <= exact * 2 ** -sub_bits + hist.unit
+
+
+def test_histogram_small_values_are_exact():
+    hist = Histogram(unit=1)
+    values = [3, 0, 7, 1, 1, 31, 12]
+    for value in values:
+        hist.record(value)
+    for percent in (0, 20, 50, 80, 100):
+        assert hist.percentile(percent) == exact_percentile(values, percent)
+    # Negative durations (clock steps) are counted as zero.
+    hist.record(-5)
+    assert hist.counts[0] == 2 and hist.percentile(20) == 0
+
+
+def test_histogram_snapshot_and_reset():
+    hist = Histogram(unit=1, sub_bits=4)
+    assert hist.percentile(50) is None and hist.mean is None
+    hist.record(10)
+    assert hist.snapshot() == {
+        'count': 1, 'min': 10, 'max': 10, 'mean': 10.0, 'p50': 10, 'p90': 10, 'p99': 10,
+    }
+    hist.reset()
+    assert hist.count == 0 and not hist.counts and hist.unit == 1 and hist.sub_bits == 4
+
+
+class Source(Instrumented):
+
+    def __init__(self):
+        self.metrics = PoolMetrics()
+        self.hooks = [self.metrics]
+
+
+def test_failing_hook_is_logged(caplog):
+
+    class Broken(PoolHooks):
+        def on_commit(self, source, duration):
+            raise RuntimeError('broken hook')
+
+    class Recorder(PoolHooks):
+        def __init__(self):
+            self.events = []
+
+        def on_commit(self, source, duration):
+            self.events.append((source, duration))
+
+    source = Source()
+    broken, recorder = Broken(), Recorder()
+    source.add_hook(broken)
+    source.add_hook(recorder)
+    with caplog.at_level(logging.ERROR, logger='pgtools.metrics'):
+        source.emit('on_commit', 0.5)
+    # Later hooks still run.
+    assert source.metrics.commits == 1 and recorder.events == [(source, 0.5)]
+    assert 'on_commit' in caplog.text and 'broken hook' in caplog.text
+    source.remove_hook(broken)
+    source.emit('on_commit', 0.25)
+    assert source.metrics.commits == 2 and len(recorder.events) == 2
+
+
+class FakeInfo(object):
+    transaction_status = extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection(object):
+    closed = 0
+    info = FakeInfo()
+
+    def close(self):
+        self.closed = 1
+
+
+def test_engine_stats(monkeypatch):
+    # `stats` reads the `psycopg2.pool` private `_used` and `_pool` members.
+    monkeypatch.setattr(psycopg2, 'connect', lambda *args, **kwargs: FakeConnection())
+    engine = DBPoolEngine(pool_size=3, pool_type='threaded')
+    assert engine.stats()['size'] == 0
+    engine._init_connection()
+    assert isinstance(engine.db._used, dict) and isinstance(engine.db._pool, list)
+    first = engine.db.getconn()
+    second = engine.db.getconn()
+    stats = engine.stats()
+    assert (stats['size'], stats['maxsize'], stats['in_use'], stats['idle'], stats['waiters']) == (
+        2, 3, 2, 0, 0
+    )
+    engine.db.putconn(first)
+    engine.db.putconn(second)
+    stats = engine.stats()
+    assert (stats['size'], stats['in_use'], stats['idle']) == (1, 0, 1)
+    engine.emit('on_checkout', 0.001)
+    stats = engine.stats()
+    assert stats['acquire_wait']['count'] == 1
+    assert set(stats) == {'size', 'maxsize', 'in_use', 'idle', 'waiters', 'acquire_wait',
+                          'query_time', 'rows', 'commits', 'rollbacks'}
@@ -0,0 +1,595 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.pool` tests, against fake connections."""
+
+import array
+import time
+
+import gevent
+import pytest
+from psycopg2 import extensions, OperationalError, ProgrammingError
+
+from pgtools.dbapi import APIQuery
+from pgtools.errors import PoolOverloadError, PoolTimeoutError
+from pgtools.pool import ClientPool, gevent_wait_callback
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection, name=None, cursor_factory=None):
+        self.connection = connection
+        self.name = name
+        self.rowcount = -1
+        self.description = None
+        self.rows = []
+        connection.cursors.append(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def mogrify(self, sql, params=None):
+        def quote(value):
+            return extensions.adapt(value).getquoted().decode()
+
+        if isinstance(params, dict):
+            quoted = {key: quote(value) for key, value in params.items()}
+        else:
+            quoted = tuple(quote(value) for value in params or ())
+        return (sql % quoted).encode()
+
+    def execute(self, sql, params=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        self.connection.executed.append(sql)
+        if sql.startswith('EXECUTE') and self.connection.failures:
+            self.connection.failures -= 1
+            raise ProgrammingError('cached plan must not change result type')
+        if 'pg_sleep' in sql:
+            try:
+                gevent.sleep(1)
+            except BaseException:
+                # As psycopg2, close the connection when the wait callback fails.
+                self.connection.closed = 2
+                raise
+        if self.connection.fail_on is not None and self.connection.fail_on in sql:
+            raise ProgrammingError('duplicate key value violates unique constraint')
+        self.rows = list(self.connection.results.pop(0)) if self.connection.results else []
+        self.rowcount = len(self.rows)
+        self.description = self.connection.description
+
+    def fetchmany(self, size):
+        self.connection.fetched.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def copy_expert(self, sql, file, size=8192):
+        # As psycopg2, refuse to start with a wait callback installed.
+        if extensions.get_wait_callback() is not None:
+            raise ProgrammingError('copy_expert cannot be used with an asynchronous callback.')
+        self.connection.executed.append(sql)
+        if 'FROM STDIN' in sql:
+            self.rowcount = 0
+            while file.read(size):
+                self.rowcount += 1
+        else:
+            for index in range(3):
+                file.write(b'%d\n' % index)
+            self.rowcount = 3
+
+
+class FakeConnection(object):
+    encoding = 'UTF8'
+    isolation_level = None
+
+    def __init__(self):
+        self.closed = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.cursors = []
+        self.executed = []
+        self.fetched = []
+        self.results = []
+        self.description = None
+        self.failures = 0
+        self.fail_on = None
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self, *args, **kwargs)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool(ClientPool):
+
+    def create_connection(self):
+        return FakeConnection()
+
+
+def watch_wait_callback(seen, switches=10):
+    for _ in range(switches):
+        seen.append(extensions.get_wait_callback())
+        gevent.sleep(0)
+
+
+def test_copy_out_generator_keeps_wait_callback():
+    pool = FakePool(maxsize=2)
+    seen = []
+    watcher = gevent.spawn(watch_wait_callback, seen)
+    # One chunk buffer, so the producer switches on every row.
+    assert list(pool.copy_out('SELECT 1', maxchunks=1)) == ['0\n', '1\n', '2\n']
+    watcher.join()
+    assert seen and all(callback is gevent_wait_callback for callback in seen)
+    assert extensions.get_wait_callback() is gevent_wait_callback
+
+
+def test_copy_out_sink_keeps_wait_callback():
+    pool = FakePool(maxsize=2)
+    seen = []
+
+    class Sink(object):
+        chunks = []
+
+        def write(self, data):
+            self.chunks.append(data)
+            gevent.sleep(0)
+
+    watcher = gevent.spawn(watch_wait_callback, seen)
+    sink = Sink()
+    assert pool.copy_out('SELECT 1', sink=sink) == 3
+    watcher.join()
+    assert sink.chunks == [b'0\n', b'1\n', b'2\n']
+    assert seen and all(callback is gevent_wait_callback for callback in seen)
+
+
+@pytest.mark.parametrize('maxchunks', [1, 2])
+def test_copy_out_abandoned_generator(maxchunks):
+    pool = FakePool(maxsize=1)
+    rows = pool.copy_out('SELECT 1', maxchunks=maxchunks)
+    assert next(rows) == '0\n'
+    with gevent.Timeout(1):
+        rows.close()
+    assert pool.size == 1 and pool.pool.qsize() == 1
+
+
+def test_copy_in_generator_keeps_wait_callback():
+    pool = FakePool(maxsize=2)
+    seen = []
+
+    def rows():
+        for index in range(5):
+            # Streamed ingest doing gevent I/O between rows.
+            gevent.sleep(0)
+            yield (index, 'row')
+
+    watcher = gevent.spawn(watch_wait_callback, seen)
+    assert pool.copy_in('items', rows(), batch_size=2, buffer_size=1) == 5
+    watcher.join()
+    assert seen and all(callback is gevent_wait_callback for callback in seen)
+
+
+def test_get_reuses_idle_connections():
+    pool = FakePool(maxsize=2)
+    conn = pool.get()
+    assert pool.size == 1
+    pool.put(conn)
+    assert pool.get() is conn
+    assert pool.size == 1
+
+
+def test_get_hands_off_in_fifo_order():
+    pool = FakePool(maxsize=1)
+    conn = pool.get()
+    order = []
+
+    def wait(name):
+        got = pool.get()
+        order.append(name)
+        pool.put(got)
+
+    waiters = [gevent.spawn(wait, name) for name in ('first', 'second', 'third')]
+    gevent.sleep(0)
+    assert len(pool._waiters) == 3
+    pool.put(conn)
+    gevent.joinall(waiters)
+    assert order == ['first', 'second', 'third']
+    assert pool.size == 1 and pool.pool.qsize() == 1
+
+
+def test_released_slot_goes_to_waiter():
+    pool = FakePool(maxsize=1)
+    conn = pool.get()
+    waiter = gevent.spawn(pool.get)
+    gevent.sleep(0)
+    pool.discard(conn)
+    new = waiter.get()
+    assert new is not conn and not new.closed
+    assert pool.size == 1
+
+
+def test_get_timeout():
+    pool = FakePool(maxsize=1, acquire_timeout=0.01)
+    pool.get()
+    with pytest.raises(PoolTimeoutError):
+        pool.get()
+    with pytest.raises(PoolTimeoutError):
+        pool.get(acquire_timeout=0.01)
+    assert not pool._waiters
+    assert pool.size == 1
+
+
+def test_get_zero_timeout():
+    pool = FakePool(maxsize=1, acquire_timeout=60)
+    pool.get()
+    with gevent.Timeout(1):
+        with pytest.raises(PoolTimeoutError):
+            pool.get(acquire_timeout=0)
+    assert not pool._waiters
+
+
+def test_get_overload_policies():
+    pool = FakePool(maxsize=1, overload='fail')
+    pool.get()
+    with pytest.raises(PoolOverloadError):
+        pool.get()
+
+    pool = FakePool(maxsize=1, max_waiters=1)
+    pool.get()
+    waiter = gevent.spawn(pool.get)
+    gevent.sleep(0)
+    with pytest.raises(PoolOverloadError):
+        pool.get()
+    waiter.kill()
+    assert not pool._waiters
+
+
+def test_killed_waiter_returns_handed_connection():
+    pool = FakePool(maxsize=1, acquire_timeout=0.05)
+    conn = pool.get()
+    waiter = gevent.spawn(pool.get)
+    gevent.sleep(0)
+    # Killed after the hand-off, before resuming: the kill is delivered
+    # before the hand-off notification.
+    waiter.kill(block=False)
+    pool.put(conn)
+    waiter.join()
+    assert isinstance(waiter.value, gevent.GreenletExit)
+    assert pool.size == 1 and pool.pool.qsize() == 1
+    assert pool.get() is conn
+
+
+def test_killed_waiter_releases_handed_slot():
+    pool = FakePool(maxsize=1, acquire_timeout=0.05)
+    conn = pool.get()
+    waiter = gevent.spawn(pool.get)
+    gevent.sleep(0)
+    waiter.kill(block=False)
+    pool.discard(conn)
+    waiter.join()
+    assert isinstance(waiter.value, gevent.GreenletExit)
+    assert pool.size == 0
+    assert pool.get() is not conn
+
+
+def test_outer_timeout_is_not_converted():
+    pool = FakePool(maxsize=1)
+    pool.get()
+    timeout = gevent.Timeout(0.01)
+    with pytest.raises(gevent.Timeout) as raised:
+        with timeout:
+            pool.get()
+    assert raised.value is timeout
+    assert not pool._waiters
+
+
+def test_gather_reports_checkout_timeouts():
+    pool = FakePool(maxsize=1)
+    conn = pool.get()
+    results = pool.gather(['SELECT 1', 'SELECT 2'], timeout=0.01, return_exceptions=True)
+    assert all(isinstance(result, gevent.Timeout) for result in results)
+    with pytest.raises(gevent.Timeout):
+        pool.gather(['SELECT 1', 'SELECT 2'], timeout=0.01)
+    pool.put(conn)
+    assert not pool._waiters
+    assert pool.size == 1 and pool.get() is conn
+
+
+def test_gather_timeout_discards_its_connection_only():
+    pool = FakePool(maxsize=3)
+    conns = [pool.get() for _ in range(3)]
+    for conn in conns:
+        pool.put(conn)
+    results = pool.gather(['SELECT pg_sleep(1)', 'SELECT 1'], timeout=0.05,
+                          return_exceptions=True)
+    assert isinstance(results[0], gevent.Timeout) and results[1] == []
+    assert [bool(conn.closed) for conn in conns] == [True, False, False]
+    assert pool.size == 2 and pool.pool.qsize() == 2 and not pool._waiters
+
+
+def test_closed_connection_failure_closes_idle_connections():
+    pool = FakePool(maxsize=2)
+    first, second = pool.get(), pool.get()
+    pool.put(second)
+    with pytest.raises(OperationalError):
+        with pool.connection() as conn:
+            assert conn is second
+            conn.closed = 2
+            raise OperationalError('server closed the connection unexpectedly')
+    assert second.closed and pool.size == 1 and pool.pool.qsize() == 0
+    assert not first.closed
+
+
+def test_gather_results():
+    pool = FakePool(maxsize=2)
+    assert pool.gather(['SELECT 1', 'SELECT 2', 'SELECT 3']) == [[], [], []]
+    assert pool.size == pool.pool.qsize() and not pool._waiters
+
+
+def test_fetchiter_streams_through_named_cursor():
+    pool = FakePool(maxsize=1, itersize=2)
+    conn = pool.get()
+    pool.put(conn)
+    conn.results = [[(index, ) for index in range(5)]]
+    assert list(pool.fetchiter('SELECT id FROM items')) == [(index, ) for index in range(5)]
+    assert conn.cursors == ['pgtools_cursor_1']
+    assert conn.fetched == [2, 2, 2, 2]
+    assert conn.commits == 1 and conn.rollbacks == 0
+
+    conn.results = [[(index, ) for index in range(5)]]
+    del conn.fetched[:]
+    assert list(pool.fetchiter('SELECT id FROM items', itersize=3, server_side=False)) == [
+        (index, ) for index in range(5)
+    ]
+    assert conn.cursors[1:] == [None] and conn.fetched == [3, 3, 3]
+
+
+def test_fetchiter_closed_early_returns_connection():
+    pool = FakePool(maxsize=1, itersize=2)
+    conn = pool.get()
+    pool.put(conn)
+    conn.results = [[(index, ) for index in range(5)]]
+    rows = pool.fetchiter('SELECT id FROM items')
+    assert next(rows) == (0, )
+    assert pool.pool.qsize() == 0
+    rows.close()
+    assert conn.fetched == [2]
+    assert conn.commits == 0 and conn.rollbacks == 1
+    assert pool.size == 1 and pool.pool.qsize() == 1 and pool.get() is conn
+
+
+def test_failed_prepared_statement_is_prepared_again():
+    pool = FakePool(maxsize=1)
+    query = APIQuery('SELECT * FROM public.get_user(%s);', (1,))
+    pool.execute(query)
+    conn = pool.get()
+    pool.put(conn)
+    conn.failures = 1
+    with pytest.raises(ProgrammingError):
+        pool.execute(query)
+    assert not pool._statements[conn]
+    del conn.executed[:]
+    pool.execute(query)
+    assert conn.executed == [
+        'DEALLOCATE pgtools_1;',
+        'PREPARE pgtools_2 AS SELECT * FROM public.get_user($1);',
+        'EXECUTE pgtools_2(%s);',
+    ]
+
+
+def test_execute_batch_values_pages():
+    pool = FakePool(maxsize=1)
+    conn = pool.get()
+    pool.put(conn)
+    conn.results = [[None, None], [None]]
+    params = [(1, 'a'), (2, "b'c"), (3, None)]
+    assert pool.execute_batch("INSERT INTO t (id, name) VALUES %s ON CONFLICT DO NOTHING",
+                              params, page_size=2) == 3
+    assert conn.executed == [
+        "INSERT INTO t (id, name) VALUES (1, 'a'),(2, 'b''c') ON CONFLICT DO NOTHING",
+        "INSERT INTO t (id, name) VALUES (3, NULL) ON CONFLICT DO NOTHING",
+    ]
+    assert conn.commits == 1
+
+    del conn.executed[:]
+    pool.execute_batch("INSERT INTO t (id, name) VALUES %s", iter([{'id': 1, 'name': 'a'}]),
+                       template="(%(id)s, %(name)s || '%%')")
+    assert conn.executed == ["INSERT INTO t (id, name) VALUES (1, 'a' || '%')"]
+
+
+def test_execute_batch_returning():
+    pool = FakePool(maxsize=1)
+    conn = pool.get()
+    pool.put(conn)
+    conn.results = [[(10, ), (11, )], [(12, )]]
+    assert pool.execute_batch("INSERT INTO t (name) VALUES %s RETURNING id",
+                              [('a', ), ('b', ), ('c', )], page_size=2, fetch=True) == [
+        (10, ), (11, ), (12, )
+    ]
+    assert conn.executed == [
+        "INSERT INTO t (name) VALUES ('a'),('b') RETURNING id",
+        "INSERT INTO t (name) VALUES ('c') RETURNING id",
+    ]
+
+
+def test_execute_batch_joined_statements():
+    pool = FakePool(maxsize=1)
+    conn = pool.get()
+    pool.put(conn)
+    params = [('a', 1), ('b', 2), ('c', 3)]
+    assert pool.execute_batch('UPDATE t SET name = %s WHERE id = %s', params, page_size=2) is None
+    assert conn.executed == [
+        "UPDATE t SET name = 'a' WHERE id = 1;UPDATE t SET name = 'b' WHERE id = 2",
+        "UPDATE t SET name = 'c' WHERE id = 3",
+    ]
+    with pytest.raises(ValueError):
+        pool.execute_batch('UPDATE t SET name = %s RETURNING id', params, fetch=True)
+    assert conn.commits == 1 and len(conn.executed) == 2
+
+
+def test_execute_batch_failed_page_rolls_back():
+    pool = FakePool(maxsize=1)
+    conn = pool.get()
+    pool.put(conn)
+    conn.fail_on = '(3)'
+    with pytest.raises(ProgrammingError):
+        pool.execute_batch('INSERT INTO t (id) VALUES %s', [(1, ), (2, ), (3, ), (4, )],
+                           page_size=2)
+    # The first page shared the failed transaction.
+    assert conn.executed == [
+        'INSERT INTO t (id) VALUES (1),(2)', 'INSERT INTO t (id) VALUES (3),(4)',
+    ]
+    assert conn.commits == 0 and conn.rollbacks == 1
+    assert pool.size == 1 and pool.pool.qsize() == 1
+
+
+def test_start_warms_up_to_minsize():
+    pool = FakePool(maxsize=4, minsize=2, maintenance_interval=0)
+    pool.start()
+    assert pool.size == 2 and pool.pool.qsize() == 2
+    assert pool._maintainer is None
+    pool.warmup()
+    assert pool.size == 2
+
+
+def test_failed_warmup_releases_slots():
+
+    class BrokenPool(FakePool):
+        def create_connection(self):
+            raise OperationalError('could not connect to server')
+
+    pool = BrokenPool(maxsize=4, minsize=2)
+    pool.warmup()
+    assert pool.size == 0 and pool.pool.qsize() == 0
+
+
+def test_maintain_discards_expired_idle_and_broken_connections():
+    pool = FakePool(maxsize=4, minsize=1, max_lifetime=60, max_idle=10)
+    old, idle, broken, kept = [pool.get() for _ in range(4)]
+    for conn in (old, idle, broken, kept):
+        pool.put(conn)
+    now = time.time()
+    pool._created[old] = now - 61
+    pool._idle_since[idle] = now - 11
+    broken.fail_on = 'SELECT 1;'
+    pool.maintain()
+    assert old.closed and idle.closed and broken.closed and not kept.closed
+    assert pool.size == 1 and pool.get() is kept
+    assert kept.executed == ['SELECT 1;'] and kept.rollbacks == 1
+
+
+def test_maintain_keeps_minsize():
+    pool = FakePool(maxsize=4, minsize=2, max_idle=10)
+    first, second = pool.get(), pool.get()
+    pool.put(first)
+    pool.put(second)
+    pool._idle_since[first] = pool._idle_since[second] = time.time() - 11
+    pool.maintain()
+    # Idle connections are kept at `minsize`, expired ones are replaced.
+    assert not first.closed and not second.closed and pool.size == 2
+    pool._created[first] = 0
+    pool.max_lifetime = 60
+    pool.maintain()
+    gevent.sleep(0)
+    assert first.closed and pool.size == 2 and pool.pool.qsize() == 2
+
+
+def test_close_stops_maintenance():
+    pool = FakePool(maxsize=2, minsize=1, max_lifetime=60, maintenance_interval=0.01)
+    pool.start()
+    conn = pool.get()
+    pool.put(conn)
+    maintainer = pool._maintainer
+    pool._created[conn] = 0
+    gevent.sleep(0.05)
+    assert conn.closed and pool.size == 1
+    pool.close()
+    assert maintainer.dead and pool._maintainer is None
+    assert pool.size == 0 and pool.pool.qsize() == 0
+    gevent.sleep(0.05)
+    assert pool.size == 0
+
+
+def test_stats():
+    pool = FakePool(maxsize=3)
+    first, second, third = pool.get(), pool.get(), pool.get()
+    waiter = gevent.spawn(pool.get)
+    gevent.sleep(0)
+    assert pool.stats()['waiters'] == 1
+    pool.put(third)
+    pool.put(waiter.get())
+    list(pool.fetchiter('SELECT 1'))
+    stats = pool.stats()
+    assert (stats['size'], stats['maxsize'], stats['in_use'], stats['idle'], stats['waiters']) == (
+        3, 3, 2, 1, 0
+    )
+    assert stats['acquire_wait']['count'] == 1 and stats['query_time']['count'] == 1
+    assert stats['rows']['count'] == 1 and stats['rows']['max'] == 0
+    assert (stats['commits'], stats['rollbacks']) == (1, 0)
+
+
+def test_raw_json_is_cursor_scoped(monkeypatch):
+    registered = []
+    monkeypatch.setattr(extensions, 'register_type',
+                        lambda typecaster, scope=None: registered.append((typecaster, scope)))
+    pool = FakePool(maxsize=1)
+    with pool.cursor(raw_json='bytes') as cursor:
+        pass
+    assert len(registered) == 4 and all(scope is cursor for _, scope in registered)
+    assert all(typecaster.name.startswith('RAWJSONBYTES') for typecaster, _ in registered)
+
+    del registered[:]
+    assert pool.query('SELECT doc FROM t', raw_json=True) == []
+    assert len(registered) == 4
+    assert all(isinstance(scope, FakeCursor) and scope is not cursor for _, scope in registered)
+    # The next call is decoded again.
+    del registered[:]
+    pool.query('SELECT doc FROM t')
+    assert not registered
+
+
+def test_fetch_columns():
+    pool = FakePool(maxsize=1, itersize=2)
+    conn = pool.get()
+    pool.put(conn)
+    conn.description = [('id', 20), ('score', 701), ('active', 16), ('name', 25), ('rank', 23)]
+    conn.results = [[(1, 0.5, True, 'a', 1), (2, 1.5, False, None, 2), (3, 2.5, True, 'c', None)]]
+    columns = pool.fetch_columns('SELECT * FROM t')
+    assert list(columns) == ['id', 'score', 'active', 'name', 'rank']
+    assert columns['id'] == array.array('q', [1, 2, 3])
+    assert columns['score'] == array.array('d', [0.5, 1.5, 2.5])
+    assert columns['active'] == array.array('B', [1, 0, 1])
+    assert columns['name'] == ['a', None, 'c']
+    # A NULL in a later batch switches the column to a list.
+    assert columns['rank'] == [1, 2, None]
+    assert conn.cursors == ['pgtools_cursor_1'] and conn.fetched == [2, 2, 2]
+
+
+def test_fetch_columns_numpy():
+    numpy = pytest.importorskip('numpy')
+    pool = FakePool(maxsize=1)
+    conn = pool.get()
+    pool.put(conn)
+    conn.description = [('id', 23), ('active', 16), ('name', 25)]
+    conn.results = [[(1, True, 'a'), (2, False, 'b')]]
+    columns = pool.fetch_columns('SELECT * FROM t', numpy=True, server_side=False)
+    assert isinstance(columns['id'], numpy.ndarray) and columns['id'].dtype == numpy.int32
+    assert columns['id'].tolist() == [1, 2] and columns['active'].tolist() == [True, False]
+    assert columns['name'] == ['a', 'b']
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.profiler` tests."""
+
+import pytest
+
+from pgtools.profiler import QueryProfiler, fingerprint
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT * FROM users WHERE id = 1 AND name = 'bob'",
+     "select * from users where id = ? and name = ?"),
+    ("SELECT 'it''s', E'a\\'b', -1.5e3, x'1F', TRUE, null",
+     "select ?, ?, ?, ?, ?, ?"),
+    ("SELECT $$a 'quoted' $x$ body$$, $fn$ select 1; $fn$",
+     "select ?, ?"),
+    ("SELECT * FROM t WHERE id = $1 AND a = %s AND b = %(name)s",
+     "select * from t where id = ? and a = ? and b = ?"),
+    ("SELECT * FROM t WHERE id IN (1, 2,3) OR id IN ( 'a' )",
+     "select * from t where id in (?) or id in (?)"),
+    ("INSERT INTO t (a, b) VALUES (1, 'x'), (2, 'y'),(3, NULL)",
+     "insert into t (a, b) values (?)"),
+    ("SELECT  col1,\n\t t2.col FROM t2",
+     "select col1, t2.col from t2"),
+    (b"SELECT 1", "select ?"),
+])
+def test_fingerprint(sql, expected):
+    assert fingerprint(sql) == expected
+
+
+def test_fingerprints_are_grouped():
+    profiler = QueryProfiler()
+    profiler.on_execute(None, 'SELECT * FROM t WHERE id = 1', None, 0.1, 1)
+    profiler.on_execute(None, 'SELECT * FROM t WHERE id = 2', None, 0.3, 1)
+    profiler.on_execute(None, 'SELECT * FROM t WHERE id IN (1, 2)', None, 0.2, 2)
+    profiler.on_execute(None, 'INSERT INTO t VALUES (1)', None, 0.05, -1)
+    report = profiler.report()
+    assert [row['fingerprint'] for row in report] == [
+        'select * from t where id = ?',
+        'select * from t where id in (?)',
+        'insert into t values (?)',
+    ]
+    assert report[0]['count'] == 2 and report[0]['rows'] == 2
+    assert report[0]['total'] == pytest.approx(0.4) and report[0]['mean'] == pytest.approx(0.2)
+    assert report[0]['max'] == 0.3 and report[2]['rows'] == 0
+    assert profiler.report(limit=1, order='count') == report[:1]
+
+
+def test_fingerprint_cap():
+    profiler = QueryProfiler(max_fingerprints=2)
+    for table in ('a', 'b', 'c', 'd'):
+        profiler.on_execute(None, 'SELECT * FROM {} WHERE id = 1'.format(table), None, 0.1, 1)
+    profiler.on_execute(None, 'SELECT * FROM a WHERE id = 2', None, 0.1, 1)
+    counts = {row['fingerprint']: row['count'] for row in profiler.report()}
+    assert counts == {
+        'select * from a where id = ?': 2,
+        'select * from b where id = ?': 1,
+        '<other>': 2,
+    }
+
+
+def test_fingerprint_cache_is_bounded():
+    profiler = QueryProfiler()
+    profiler.fingerprint_cache_size = 2
+    for index in range(5):
+        assert profiler.fingerprint('SELECT {}'.format(index)) == 'select ?'
+    assert len(profiler._fingerprints) <= 2
+
+
+def test_slowest_executions():
+    profiler = QueryProfiler(slowest=3, threshold=0.1)
+    for index, duration in enumerate([0.5, 0.05, 0.2, 0.9, 0.1, 0.3, 0.2]):
+        profiler.on_execute(None, 'SELECT %s', (index, ), duration, 1)
+    slowest = profiler.slowest_executions()
+    assert [(row['duration'], row['params']) for row in slowest] == [
+        (0.9, (3, )), (0.5, (0, )), (0.3, (5, )),
+    ]
+    assert slowest[0]['fingerprint'] == 'select ?' and slowest[0]['query'] == 'SELECT %s'
+    # Executions below the threshold are still aggregated.
+    assert profiler.report()[0]['count'] == 7
+
+    profiler.reset()
+    assert not profiler.slowest_executions() and not profiler.report()
+    profiler.slowest = 0
+    profiler.on_execute(None, 'SELECT 1', None, 1, 1)
+    assert not profiler.slowest_executions()
+
+
+def test_slowest_ties_keep_the_first():
+    profiler = QueryProfiler(slowest=2)
+    for index in range(4):
+        profiler.on_execute(None, 'SELECT %s', (index, ), 0.1, 1)
+    assert [row['params'] for row in profiler.slowest_executions()] == [(1, ), (0, )]
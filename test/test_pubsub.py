@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.pubsub` tests, against fake LISTEN connections."""
+
+import socket
+
+import gevent
+import psycopg2
+import pytest
+from psycopg2 import extensions
+
+from pgtools.cache import ResultCache
+from pgtools.pubsub import CacheInvalidator, Listener
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, sql, params=None):
+        self.connection.log.append(sql)
+
+
+class FakeConnection(object):
+
+    def __init__(self, log):
+        self.log = log
+        self.autocommit = False
+        self.notifies = []
+        self.broken = False
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def poll(self):
+        if self.broken:
+            raise psycopg2.OperationalError('server closed the connection')
+        try:
+            self.reader.recv(1024)
+        except socket.error:
+            pass
+        return extensions.POLL_OK
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+    def notify(self, channel, payload=''):
+        self.notifies.append(extensions.Notify(1, channel, payload))
+        self.writer.send(b'!')
+
+    def fail(self):
+        self.broken = True
+        self.writer.send(b'!')
+
+
+class Connections(list):
+    """Opened fake connections, sharing a statements `log`."""
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    log = []
+    connections = Connections()
+
+    def connect(*args, **kwargs):
+        log.append('connect')
+        connections.append(FakeConnection(log))
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    connections.log = log
+    return connections
+
+
+def test_listener_multiplexes_channels(connections):
+    listener = Listener('dbname=test')
+    first = listener.subscribe(['orders', 'Users'])
+    second = listener.subscribe('orders', maxsize=1)
+    gevent.sleep(0.01)
+    assert len(connections) == 1
+    assert sorted(connections.log[1:]) == ['LISTEN "Users";', 'LISTEN "orders";']
+
+    connections[0].notify('orders', '1')
+    connections[0].notify('orders', '2')
+    connections[0].notify('Users', '3')
+    gevent.sleep(0.01)
+    assert [first.get(timeout=0).payload for _ in range(3)] == ['1', '2', '3']
+    assert second.get(timeout=0).payload == '1'
+    assert second.dropped == 1
+
+    first.close()
+    gevent.sleep(0.01)
+    assert connections.log[-1] == 'UNLISTEN "Users";'
+    assert listener.listening == {'orders'}
+    listener.close()
+
+
+def test_listener_handler_greenlet(connections):
+    listener = Listener('dbname=test')
+    received = []
+    listener.subscribe('jobs', handler=lambda notify: received.append(notify.payload))
+    gevent.sleep(0.01)
+    connections[0].notify('jobs', 'a')
+    connections[0].notify('jobs', 'b')
+    gevent.sleep(0.01)
+    assert received == ['a', 'b']
+    listener.close()
+
+
+def test_listener_gap_after_listening_again(connections):
+    listener = Listener('dbname=test')
+    listener.retry_interval = 0.01
+    gaps = []
+    listener.subscribe('jobs', on_gap=lambda: gaps.append(list(connections.log)))
+    gevent.sleep(0.01)
+
+    connections[0].fail()
+    gevent.sleep(0.05)
+    assert len(connections) == 2
+    # Called on failure, then once the channel is listened again.
+    assert gaps[0] == ['connect', 'LISTEN "jobs";']
+    assert gaps[-1] == ['connect', 'LISTEN "jobs";', 'connect', 'LISTEN "jobs";']
+
+    received = []
+    listener.subscribe('jobs', handler=lambda notify: received.append(notify.payload))
+    gevent.sleep(0.01)
+    connections[1].notify('jobs', 'x')
+    gevent.sleep(0.01)
+    assert received == ['x']
+    listener.close()
+
+
+def test_listener_survives_connect_errors(connections, monkeypatch):
+    attempts = []
+
+    def connect(*args, **kwargs):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError('no watcher')
+        connections.append(FakeConnection(connections.log))
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    listener = Listener('dbname=test')
+    listener.retry_interval = 0.01
+    subscription = listener.subscribe('jobs')
+    gevent.sleep(0.05)
+    assert len(attempts) == 2 and not listener.greenlet.dead
+    connections[0].notify('jobs', 'x')
+    assert subscription.get(timeout=1).payload == 'x'
+    listener.close()
+
+
+def test_cache_invalidator(connections):
+    cache = ResultCache()
+    listener = Listener('dbname=test')
+    listener.retry_interval = 0.05
+    invalidator = CacheInvalidator(listener, cache=cache, dependencies={
+        'public.users': ['api.get_user', 'api.count_users'],
+    }).start()
+    gevent.sleep(0.01)
+    for field in ('api.get_user', 'api.count_users', 'api.get_order', 'api.settings'):
+        cache.set(field, (), [field])
+
+    connections[0].notify('pgtools_invalidate', 'public.users')
+    gevent.sleep(0.01)
+    assert len(cache) == 2 and invalidator.evicted == 2
+    connections[0].notify('pgtools_invalidate', 'api.get_*, api.settings')
+    gevent.sleep(0.01)
+    assert len(cache) == 0
+
+    connections[0].fail()
+    gevent.sleep(0.01)
+    # Cached while nobody listens, evicted once listening again.
+    cache.set('api.settings', (), ['stale'])
+    gevent.sleep(0.1)
+    assert len(connections) == 2 and len(cache) == 0
+    invalidator.stop()
+    listener.close()
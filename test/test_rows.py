@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""`pgtools.rows` row factory tests."""
+
+import array
+from collections import OrderedDict
+
+import psycopg2.extras
+import pytest
+from psycopg2 import extensions
+
+from pgtools.rows import (ColumnBuffers, NamedTupleCursor, Record, RecordCursor, namedtuple_class,
+                          record_class, row_factory)
+
+
+class FakeCursor(object):
+    """Stands for the cursor `_make_nt` reads the `description` of."""
+
+    def __init__(self, *columns):
+        self.description = [(name, 23, None, None, None, None, None) for name in columns]
+
+
+def test_record_class():
+    cls = record_class(('id', 'self', 'class', '?column?', '?column?', '_x', '1st'))
+    assert cls._fields == ('id', 'self', 'f2_class', 'f3__column_', 'f4__column_', 'f5__x',
+                           'f6__1st')
+    record = cls(1, 2, 3, 4, 5, 6, 7)
+    assert record.self == 2 and record['f4__column_'] == 5 and record[-1] == 7
+    assert record[1:3] == (2, 3) and len(record) == 7
+    assert cls._make(range(7))._asdict()['self'] == 1
+    assert record_class(['id', 'self', 'class', '?column?', '?column?', '_x', '1st']) is cls
+    with pytest.raises(AttributeError):
+        record.other = 1
+
+
+def test_record_equality():
+    record = record_class(('x', 'y'))(1, 2)
+    assert record == (1, 2) and record == [1, 2] and (1, 2) == record
+    assert record == record_class(('a', 'b'))(1, 2)
+    assert record != (2, 1) and not record != (1, 2)
+    for other in (None, 3, 'ab', {'x': 1}):
+        assert record != other and not record == other
+    with pytest.raises(TypeError):
+        hash(record)
+
+
+def test_record_cursor_rows():
+    cls = RecordCursor._make_nt(FakeCursor('?column?', '?column?', 'name'))
+    assert issubclass(cls, Record)
+    assert cls._make((1, 2, 'a')) == (1, 2, 'a')
+    assert cls._fields == ('f0__column_', 'f1__column_', 'name')
+    # One class per column list.
+    assert RecordCursor._make_nt(FakeCursor('?column?', '?column?', 'name')) is cls
+    assert RecordCursor._make_nt(FakeCursor())._make(()) == ()
+
+
+def test_namedtuple_cursor_duplicate_columns():
+    # `psycopg2.extras.NamedTupleCursor` fails on these names.
+    with pytest.raises(ValueError):
+        psycopg2.extras.NamedTupleCursor._do_make_nt(('?column?', '?column?'))
+    cls = NamedTupleCursor._make_nt(FakeCursor('?column?', '?column?', 'name'))
+    row = cls._make((1, 2, 'a'))
+    assert row == (1, 2, 'a') and row.f1__column_ == 2 and row.name == 'a'
+    assert namedtuple_class(('?column?', '?column?', 'name')) is cls
+
+
+@pytest.mark.parametrize('cursor_type, expected', [
+    ('tuple', extensions.cursor),
+    ('namedtuple', NamedTupleCursor),
+    ('record', RecordCursor),
+    ('dict', psycopg2.extras.RealDictCursor),
+    ('DictCursor', psycopg2.extras.DictCursor),
+    (RecordCursor, RecordCursor),
+    (None, None),
+])
+def test_row_factory(cursor_type, expected):
+    assert row_factory(cursor_type) is expected
+
+
+def test_unknown_row_factory():
+    with pytest.raises(ValueError):
+        row_factory('records')
+
+
+@pytest.mark.parametrize('oid, typecode, values', [
+    (16, 'B', [True, False]),
+    (20, 'q', [2 ** 40, -1]),
+    (21, 'h', [1, -2]),
+    (23, 'i', [2 ** 31 - 1, 0]),
+    (26, 'I', [2 ** 32 - 1, 1]),
+    (700, 'f', [0.5, -1.0]),
+    (701, 'd', [1e300, 2.5]),
+])
+def test_column_buffers_typecodes(oid, typecode, values):
+    buffers = ColumnBuffers([('value', oid, None, None, None, None, None)])
+    buffers.extend([(value, ) for value in values])
+    column = buffers.result()['value']
+    assert isinstance(column, array.array) and column.typecode == typecode
+    assert column.tolist() == [int(value) if typecode == 'B' else value for value in values]
+
+
+def test_column_buffers_null_switches_to_list():
+    buffers = ColumnBuffers([('id', 23), ('flag', 16), ('name', 25), ('data', 3802)])
+    buffers.extend([(1, True, 'a', {}), (2, None, None, [])])
+    buffers.extend([(None, False, 'c', None), (4, True, 'd', 1)])
+    assert buffers.result() == OrderedDict([
+        ('id', [1, 2, None, 4]),
+        ('flag', [True, None, False, True]),
+        ('name', ['a', None, 'c', 'd']),
+        ('data', [{}, [], None, 1]),
+    ])
+
+
+def test_column_buffers_empty():
+    assert ColumnBuffers([('id', 23)]).result() == OrderedDict([('id', array.array('i'))])
+    assert ColumnBuffers(()).result() == OrderedDict()
+
+
+def test_column_buffers_numpy_shares_memory():
+    numpy = pytest.importorskip('numpy')
+    buffers = ColumnBuffers([('id', 20), ('flag', 16), ('score', 700), ('rank', 23)])
+    buffers.extend([(1, True, 0.5, 1), (2, False, 1.5, None)])
+    columns = buffers.result(numpy=True)
+    assert columns['id'].dtype == numpy.int64 and columns['flag'].dtype == numpy.bool_
+    assert columns['score'].dtype == numpy.float32 and columns['rank'] == [1, None]
+    # Zero copy views of the `array.array` buffers.
+    buffers.columns[0][0] = 10
+    assert columns['id'].tolist() == [10, 2]
+    assert columns['flag'].tolist() == [True, False]